@@ -26,7 +26,8 @@ setup(
     author_email="alan@inconshreveable.com",
     url="https://github.com/inconshreveable/sqltap",
     packages=["sqltap"],
-    package_data={"sqltap": ["templates/*.mako"]},
+    package_data={"sqltap": ["templates/*.mako", "templates/static/*"]},
+    entry_points={"pytest11": ["sqltap = sqltap.pytest_plugin"]},
     install_requires=[
         "SQLAlchemy >= 1.4",
         "Mako >= 0.4.1",
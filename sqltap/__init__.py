@@ -3,4 +3,9 @@
 
 from __future__ import absolute_import
 
-from .sqltap import format_sql, start, report, QueryStats, QueryGroup, ProfilingSession  # noqa
+from .sqltap import (  # noqa
+    format_sql, start, report, QueryStats, QueryGroup, ProfilingSession,
+    ParamsTable, SpaceSaving, HeavyHitters, TimeSeries, PoolStats,
+    TransactionInfo, TransactionStats, analyze_transactions, DuplicateQuery,
+    find_duplicates, CallTree, fingerprint, OverheadGovernor,
+    CacheSimulation, simulate_cache, group_by_fingerprint)
@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+
+import asyncio
+
+from . import dashboard
+
+
+class SQLTapMiddleware(dashboard.Dashboard):
+    """ SQLTap dashboard middleware for ASGI applications.
+
+    For example, with Starlette or FastAPI::
+
+        app = SQLTapMiddleware(app)
+
+    The dashboard is served from ``/__sqltap__``, like with the WSGI
+    middleware. Requests to the dashboard, including the rendering of the
+    report, are handled in a thread pool so that they never block the
+    event loop. Queries run with an ``AsyncEngine`` are profiled along
+    with those of the other engines, their stacks reaching up to the
+    awaiting coroutines.
+
+    :param app: An ASGI application object to be wrap.
+    :param path: A path prefix for access. Default is `'/__sqltap__'`
+    :param pool_events: Also report connection pool statistics.
+    :param refresh_interval: The minimum number of seconds between two
+        renders of the dashboard, see :class:`sqltap.dashboard.Dashboard`.
+    :param offline: Inline the stylesheet of the dashboard instead of
+        loading it from a CDN.
+    :param executor: The :class:`concurrent.futures.Executor` in which
+        requests are handled, the event loop's default executor if None.
+    """
+
+    def __init__(self, app, path='/__sqltap__', pool_events=False,
+                 refresh_interval=5.0, offline=False, executor=None):
+        super(SQLTapMiddleware, self).__init__(path, pool_events,
+                                               refresh_interval, offline)
+        self.app = app
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and self.matches(scope['path']):
+            await self.render(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+    async def render(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+
+        headers = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                       for name, value in scope.get('headers', ()))
+        loop = asyncio.get_running_loop()
+        status, headers, content = await loop.run_in_executor(
+            self.executor, self.handle, scope['method'], b''.join(body),
+            headers)
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers],
+        })
+        await send({'type': 'http.response.body', 'body': content})
@@ -0,0 +1,291 @@
+from __future__ import absolute_import
+
+import binascii
+import gzip
+import os
+import threading
+import time
+
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from . import sqltap
+
+
+class Dashboard(object):
+    """ The state and request handling of the SQLTap dashboard, shared by
+    the WSGI and ASGI middlewares.
+
+    Requests to the dashboard are handled by :meth:`handle`, independently
+    of the server interface: it takes the method and body of the request
+    and returns the status, headers and body of the response.
+
+    Viewing the dashboard serves the last rendered page. When queries were
+    collected since, a new page is rendered in a background thread, at
+    most once every `refresh_interval` seconds, and shown by the next
+    views. Only one page is rendered at a time, whatever the number of
+    concurrent views. The first view, and the views following a change
+    of the on/off switch or a clear, wait for an up to date page. When the
+    page fails to render, the views waiting for it get a 500 response and
+    the render is not attempted again until the data changes.
+
+    Each rendered page is compressed once, with gzip and, if the brotli
+    package is installed, brotli, and served according to the
+    Accept-Encoding header. Pages carry an ETag derived from the version
+    of the data they show, so reloading an unchanged dashboard returns a
+    304 Not Modified.
+
+    :param path: A path prefix for access. Default is `'/__sqltap__'`
+    :param pool_events: Also report connection pool statistics.
+    :param refresh_interval: The minimum number of seconds between two
+        background renders.
+    :param offline: Inline the stylesheet instead of loading it from a
+        CDN, see :class:`sqltap.sqltap.HTMLReporter`.
+    """
+
+    def __init__(self, path='/__sqltap__', pool_events=False,
+                 refresh_interval=5.0, offline=False):
+        self.path = path.rstrip('/')
+        self.on = False
+        self.collector = queue.Queue(0)
+        self.stats = []
+        self.params_table = sqltap.ParamsTable()
+        self.profiler = sqltap.ProfilingSession(collect_fn=self.collector.put,
+                                                pool_events=pool_events)
+        self.refresh_interval = refresh_interval
+        self.offline = offline
+        # version of the data shown by the dashboard, and of the snapshot
+        self.version = 0
+        self._snapshot = None
+        self._snapshot_version = -1
+        # the version which failed to render, and its error
+        self._failed_version = -1
+        self._error = None
+        self._rendered_at = 0
+        self._rendering = False
+        self._waiters = 0
+        self._cond = threading.Condition()
+        # tells the ETags of different processes apart
+        self._etag_prefix = binascii.hexlify(os.urandom(4)).decode('ascii')
+
+    def matches(self, path):
+        return path == self.path or path == self.path + '/'
+
+    def start(self):
+        if not self.on:
+            self.on = True
+            self.profiler.start()
+            self.invalidate()
+
+    def stop(self):
+        if self.on:
+            self.on = False
+            self.profiler.stop()
+            self.invalidate()
+
+    def clear(self):
+        del self.stats[:]
+        self.params_table = sqltap.ParamsTable()
+        if self.profiler.pool_stats is not None:
+            self.profiler.pool_stats.clear()
+        self.invalidate()
+
+    def collect(self):
+        """ Move the queries collected by the profiler to :attr:`stats` """
+        count = len(self.stats)
+        try:
+            while True:
+                self.stats.append(self.collector.get(block=False))
+        except queue.Empty:
+            pass
+        if len(self.stats) != count:
+            self.invalidate()
+
+    def invalidate(self):
+        """ Mark the rendered page as out of date """
+        with self._cond:
+            self.version += 1
+
+    def handle(self, verb, body=b'', headers=None):
+        """ Handle a request to the dashboard.
+
+        :param verb: The request method.
+        :param body: The request body, form encoded.
+        :param headers: A dict of the request headers, with lower case
+            names. Accept-Encoding and If-None-Match are used.
+        :return: A ``(status, headers, body)`` tuple, with an int status,
+            a list of header tuples and a bytes body.
+        """
+        headers = headers or {}
+        verb = verb.strip().upper()
+        if verb not in ('GET', 'POST'):
+            return (405, [('Content-Type', 'text/plain; charset=utf-8'),
+                          ('Allow', 'GET, POST')],
+                    b'405 Method Not Allowed')
+
+        # handle on/off switch
+        if verb == 'POST':
+            form = urlparse.parse_qs(body.decode('utf-8'))
+            # the page changed, only its encoding is negotiated
+            headers = {'accept-encoding': headers.get('accept-encoding', '')}
+            if form.get('clear', None):
+                self.clear()
+                return self.report_response(wait=True, headers=headers)
+
+            turn = form.get('turn', ' ')[0].strip().lower()
+            if turn not in ('on', 'off'):
+                return (400, [('Content-Type', 'text/plain; charset=utf-8')],
+                        b'400 Bad Request: parameter "turn=(on|off)" required')
+            if turn == 'on':
+                self.start()
+            else:
+                self.stop()
+            self.collect()
+            return self.report_response(wait=True, headers=headers)
+
+        self.collect()
+        return self.report_response(headers=headers)
+
+    def report(self):
+        """ Render the dashboard page """
+        return sqltap.report(list(self.stats), middleware=self,
+                             report_format="wsgi",
+                             params_table=self.params_table,
+                             pool_stats=self.profiler.pool_stats,
+                             session=self.profiler,
+                             timeline_end=time.time(),
+                             offline=self.offline)
+
+    def report_response(self, wait=False, headers=None):
+        """ Return the response with the last rendered page.
+
+        :param wait: If True, wait for a page showing the current data.
+        :param headers: The request headers, see :meth:`handle`.
+        """
+        with self._cond:
+            if self._snapshot is None:
+                wait = True
+            if self._snapshot_version != self.version:
+                self._render()
+            if wait:
+                version = self.version
+                self._waiters += 1
+                # wake up a render waiting for the refresh interval
+                self._cond.notify_all()
+                try:
+                    while self._snapshot_version < version and \
+                            self._failed_version < version:
+                        self._render()
+                        self._cond.wait()
+                finally:
+                    self._waiters -= 1
+                if self._snapshot_version < version:
+                    return (500, [('Content-Type',
+                                   'text/plain; charset=utf-8')],
+                            ('500 Internal Server Error: the dashboard could '
+                             'not be rendered: %r' % (self._error,)
+                             ).encode('utf-8'))
+            snapshot = self._snapshot
+            version = self._snapshot_version
+
+        headers = headers or {}
+        encoding = self._encoding(headers.get('accept-encoding', ''),
+                                  snapshot)
+        etag = '"%s-%d-%s"' % (self._etag_prefix, version, encoding)
+        response_headers = [('Content-Type', 'text/html; charset=utf-8'),
+                            ('ETag', etag),
+                            ('Vary', 'Accept-Encoding'),
+                            ('Cache-Control', 'no-cache')]
+        if encoding != 'identity':
+            response_headers.append(('Content-Encoding', encoding))
+
+        if_none_match = headers.get('if-none-match', '')
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        if etag in tags or '*' in tags:
+            return (304, response_headers[1:4], b'')
+        return (200, response_headers, snapshot[encoding])
+
+    @staticmethod
+    def _encoding(accept_encoding, snapshot):
+        """ The best encoding of `snapshot` allowed by `accept_encoding` """
+        accepted = {}
+        for item in accept_encoding.split(','):
+            parts = item.split(';')
+            name = parts[0].strip().lower()
+            quality = 1.0
+            for param in parts[1:]:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[name] = quality
+        for encoding in ('br', 'gzip'):
+            if encoding in snapshot:
+                if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                    return encoding
+        return 'identity'
+
+    @staticmethod
+    def _compress(content):
+        """ Return the encodings of `content` keyed by their name """
+        encoded = {'identity': content,
+                   'gzip': gzip.compress(content, compresslevel=6)}
+        if brotli is not None:
+            encoded['br'] = brotli.compress(content, quality=5)
+        return encoded
+
+    def _render(self):
+        """ Start the background render, unless it is running or the page
+        failed to render with the current data """
+        if not self._rendering and self._failed_version != self.version:
+            self._rendering = True
+            thread = threading.Thread(target=self._render_loop,
+                                      name="sqltap-dashboard")
+            thread.daemon = True
+            thread.start()
+
+    def _render_loop(self):
+        with self._cond:
+            try:
+                while self._snapshot_version != self.version and \
+                        self._failed_version != self.version:
+                    next_render = self._rendered_at + self.refresh_interval
+                    delay = next_render - time.time()
+                    if delay > 0 and not self._waiters:
+                        self._cond.wait(delay)
+                        continue
+                    version = self.version
+                    self._cond.release()
+                    error = None
+                    try:
+                        content = self._compress(
+                            self.report().encode('utf-8'))
+                    except Exception as e:
+                        error = e
+                    finally:
+                        self._cond.acquire()
+                    if error is not None:
+                        self._failed_version = version
+                        self._error = error
+                    else:
+                        self._snapshot = content
+                        self._snapshot_version = version
+                    self._rendered_at = time.time()
+                    self._cond.notify_all()
+            finally:
+                self._rendering = False
+                self._cond.notify_all()
@@ -0,0 +1,289 @@
+""" Compare two sqltap captures to catch query regressions.
+
+A capture is summarized per statement :func:`sqltap.fingerprint` and saved
+as JSON, for example at the end of a test run::
+
+    sqltap.diff.CaptureSummary.from_stats(profiler.collect()).save(
+        "queries.json")
+
+Two summaries can then be compared from Python, e.g. in a test::
+
+    sqltap.diff.assert_no_regressions("baseline.json", stats)
+
+or from the command line, which exits with status 1 on regressions::
+
+    python -m sqltap.diff baseline.json queries.json
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import json
+import sys
+
+import mako.exceptions
+
+from . import sqltap
+
+
+class GroupSummary(object):
+    """ The aggregates of the queries sharing a fingerprint in a capture """
+
+    FIELDS = ("fingerprint", "text", "first_word", "count", "sum", "mean",
+              "p95", "max", "rows")
+
+    def __init__(self, fingerprint, text, first_word, count, sum, mean, p95,
+                 max, rows):
+        self.fingerprint = fingerprint
+        self.text = text
+        self.first_word = first_word
+        self.count = count
+        self.sum = sum
+        self.mean = mean
+        self.p95 = p95
+        self.max = max
+        self.rows = rows
+
+    @classmethod
+    def from_group(cls, fingerprint, group):
+        return cls(fingerprint, group.text, group.first_word, group.count,
+                   group.sum, group.mean, group.quantile(0.95), group.max,
+                   group.rows)
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+
+class CaptureSummary(object):
+    """ A capture summarized per statement fingerprint.
+
+    :param groups: A dict of :class:`GroupSummary` keyed by fingerprint.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    @classmethod
+    def from_stats(cls, stats):
+        """ Summarize a list of :class:`sqltap.QueryStats`. """
+        groups = sqltap.group_by_fingerprint(stats)
+        return cls(collections.OrderedDict(
+            (key, GroupSummary.from_group(key, group))
+            for key, group in groups.items()))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(collections.OrderedDict(
+            (g["fingerprint"], GroupSummary(**g)) for g in data["groups"]))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"groups": [g.to_dict() for g in self.groups.values()]},
+                      f, indent=2)
+
+    @classmethod
+    def coerce(cls, capture):
+        """ Accept a summary, the path of a saved summary or a list of
+        :class:`sqltap.QueryStats`. """
+        if isinstance(capture, cls):
+            return capture
+        if isinstance(capture, str):
+            return cls.load(capture)
+        return cls.from_stats(capture)
+
+
+class GroupDiff(object):
+    """ The change of a fingerprint between two captures. Either side is
+    None for new or disappeared groups. """
+
+    METRICS = ("count", "sum", "p95", "rows")
+
+    def __init__(self, fingerprint, before, after):
+        self.fingerprint = fingerprint
+        self.before = before
+        self.after = after
+        self.regressions = []
+
+    @property
+    def text(self):
+        return (self.after or self.before).text
+
+    def value(self, side, metric):
+        summary = getattr(self, side)
+        return getattr(summary, metric) if summary is not None else 0
+
+    def change(self, metric):
+        """ Relative change of `metric`, None if it was 0 before. """
+        before = self.value("before", metric)
+        after = self.value("after", metric)
+        if not before:
+            return None if after else 0.0
+        return (after - before) / before
+
+
+class CaptureDiff(object):
+    """ The result of :func:`compare`.
+
+    - :attr:`new`: :class:`GroupDiff` of the fingerprints only found after.
+    - :attr:`removed`: the fingerprints only found before.
+    - :attr:`changed`: the fingerprints found in both captures.
+    - :attr:`regressions`: the diffs exceeding a threshold. Their
+      ``regressions`` attribute lists the offending metrics.
+    """
+
+    def __init__(self, new, removed, changed, thresholds):
+        self.new = new
+        self.removed = removed
+        self.changed = changed
+        self.thresholds = thresholds
+        self.regressions = [d for d in new + changed if d.regressions]
+
+    def __bool__(self):
+        """ True if there are regressions """
+        return bool(self.regressions)
+
+    __nonzero__ = __bool__
+
+    def report(self, **kwargs):
+        """ Render the diff with the diff.mako template. """
+        return DiffReporter(self, **kwargs).report()
+
+
+#: Default thresholds of :func:`compare`
+DEFAULT_THRESHOLDS = {
+    "count": 0.0,
+    "rows": 0.0,
+    "sum": 0.5,
+    "p95": 0.5,
+    "min_time": 0.01,
+    "new_groups": True,
+}
+
+
+def compare(before, after, **thresholds):
+    """ Compare two captures by statement fingerprint.
+
+    :param before: The baseline: a :class:`CaptureSummary`, the path of a
+        saved summary, or a list of :class:`sqltap.QueryStats`.
+    :param after: The capture to check, in the same forms.
+
+    The thresholds are keyword arguments:
+
+    :param count: Maximum relative increase of the query count of a group
+        (0.0, the default, flags any increase). None disables the check.
+    :param rows: Maximum relative increase of the rows of a group.
+    :param sum: Maximum relative increase of the total time of a group.
+    :param p95: Maximum relative increase of the 95th percentile latency.
+    :param min_time: Time changes of groups spending less than this many
+        seconds in both captures are ignored as noise.
+    :param new_groups: If True, new fingerprints are regressions.
+
+    :return: A :class:`CaptureDiff`, which is true if there are
+        regressions.
+    """
+    unknown = set(thresholds) - set(DEFAULT_THRESHOLDS)
+    if unknown:
+        raise TypeError("Unknown thresholds: %s" % ", ".join(sorted(unknown)))
+    limits = dict(DEFAULT_THRESHOLDS, **thresholds)
+    before = CaptureSummary.coerce(before)
+    after = CaptureSummary.coerce(after)
+
+    new, removed, changed = [], [], []
+    for key, summary in after.groups.items():
+        diff = GroupDiff(key, before.groups.get(key), summary)
+        if diff.before is None:
+            if limits["new_groups"]:
+                diff.regressions.append("new")
+            new.append(diff)
+        else:
+            changed.append(diff)
+    for key, summary in before.groups.items():
+        if key not in after.groups:
+            removed.append(GroupDiff(key, summary, None))
+
+    for diff in changed:
+        for metric in GroupDiff.METRICS:
+            limit = limits[metric]
+            if limit is None:
+                continue
+            if metric in ("sum", "p95") and max(
+                    diff.before.sum, diff.after.sum) < limits["min_time"]:
+                continue
+            change = diff.change(metric)
+            if change is None or change > limit:
+                diff.regressions.append(metric)
+
+    changed.sort(key=lambda d: d.after.sum - d.before.sum, reverse=True)
+    return CaptureDiff(new, removed, changed, limits)
+
+
+def assert_no_regressions(before, after, **thresholds):
+    """ Compare two captures with :func:`compare` and raise an
+    :class:`AssertionError` describing the regressions, if any. """
+    diff = compare(before, after, **thresholds)
+    if diff:
+        raise AssertionError(diff.report())
+    return diff
+
+
+class DiffReporter(sqltap.Reporter):
+    """ A SQLTap Reporter rendering a :class:`CaptureDiff` """
+
+    REPORT_TITLE = "SQLTap Capture Diff"
+
+    def __init__(self, diff, report_file=None, report_dir=".",
+                 template_file="diff.mako", template_dir=None, **kwargs):
+        super(DiffReporter, self).__init__(
+            [],
+            report_file=report_file,
+            report_dir=report_dir,
+            template_file=template_file,
+            template_dir=template_dir,
+            **kwargs)
+        self.diff = diff
+        self._init_template(template_filters=['unicode'])
+
+    def _process_stats(self):
+        pass
+
+    def render(self):
+        try:
+            return self.template.render(diff=self.diff,
+                                        report_title=self.REPORT_TITLE,
+                                        **self.kwargs)
+        except Exception:
+            return mako.exceptions.text_error_template().render()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m sqltap.diff",
+        description="Compare two sqltap capture summaries and exit with "
+                    "status 1 if the second one regressed.")
+    parser.add_argument("before", help="baseline capture summary (JSON)")
+    parser.add_argument("after", help="capture summary to check (JSON)")
+    for metric in ("count", "rows", "sum", "p95"):
+        parser.add_argument(
+            "--max-%s-increase" % metric, type=float, dest=metric,
+            default=DEFAULT_THRESHOLDS[metric], metavar="RATIO",
+            help="maximum relative increase of %s per group (default %s)"
+                 % (metric, DEFAULT_THRESHOLDS[metric]))
+    parser.add_argument(
+        "--min-time", type=float, default=DEFAULT_THRESHOLDS["min_time"],
+        help="ignore time changes of groups faster than this (seconds)")
+    parser.add_argument(
+        "--allow-new", dest="new_groups", action="store_false",
+        help="do not treat new statements as regressions")
+    args = parser.parse_args(argv)
+
+    diff = compare(args.before, args.after, count=args.count, rows=args.rows,
+                   sum=args.sum, p95=args.p95, min_time=args.min_time,
+                   new_groups=args.new_groups)
+    print(diff.report())
+    return 1 if diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
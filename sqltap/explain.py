@@ -0,0 +1,213 @@
+from __future__ import absolute_import
+
+import re
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import sqltap
+
+#: EXPLAIN prefix for each supported dialect
+EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ",
+    "mysql": "EXPLAIN ",
+    "mariadb": "EXPLAIN ",
+}
+
+_SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?(.*)$')
+_POSTGRESQL_SCAN = re.compile(r'Seq Scan on "?(\w+)"?')
+
+
+class QueryPlan(object):
+    """ The plan of a query group, as captured by :class:`ExplainCapture`.
+
+    :param fingerprint: The :func:`sqltap.fingerprint` of the query.
+    :param text: The statement that was explained.
+    :param rows: The lines of the plan, as strings.
+    :param full_scans: Names of the tables read with a full table scan.
+    :param error: The error message if the statement could not be
+        explained, in which case `rows` is empty.
+    """
+
+    def __init__(self, fingerprint, text, rows=(), full_scans=(), error=None):
+        self.fingerprint = fingerprint
+        self.text = text
+        self.rows = list(rows)
+        self.full_scans = list(full_scans)
+        self.error = error
+
+    def __repr__(self):
+        return "<%s full_scans=%r error=%r>" % (
+            self.__class__.__name__, self.full_scans, self.error)
+
+
+def _plan_lines(dialect_name, result):
+    """ Return ``(rows, full_scans)`` for the result of an EXPLAIN """
+    rows = []
+    full_scans = []
+    if dialect_name == "sqlite":
+        # (id, parent, notused, detail)
+        for row in result:
+            rows.append(row[-1])
+            # "SCAN t USING INDEX i" reads an index, not the table
+            match = _SQLITE_SCAN.match(row[-1])
+            if match and "USING" not in match.group(2):
+                full_scans.append(match.group(1))
+    elif dialect_name == "postgresql":
+        for row in result:
+            rows.append(row[0])
+            full_scans.extend(_POSTGRESQL_SCAN.findall(row[0]))
+    else:
+        keys = list(result.keys())
+        for row in result:
+            line = dict(zip(keys, row))
+            rows.append(", ".join("%s=%s" % (k, line[k]) for k in keys))
+            if line.get("type") == "ALL":
+                full_scans.append(line.get("table"))
+    return rows, full_scans
+
+
+class ExplainCapture(object):
+    """ Capture the query plans of the heaviest query groups.
+
+    Plans are obtained by running EXPLAIN (EXPLAIN QUERY PLAN on SQLite)
+    of the statement executed with the most frequent parameter set of a
+    group, as sent to the database. This happens in a
+    background thread, on a connection of its own, at most once every
+    `min_interval` seconds, so the requests of the application are never
+    delayed. Plans are cached per :func:`sqltap.fingerprint`.
+
+    Pass an instance to :func:`sqltap.report` with the `explain` argument
+    to request the plans of the `top` heaviest groups and show the plans
+    already captured. Plans requested by a report are shown by the next
+    reports, or by this one after a call to :meth:`wait`.
+
+    Example usage::
+
+        explain = ExplainCapture(engine)
+        sqltap.report(statistics, "report.html", explain=explain)
+
+    The queries run by the capture are not profiled.
+
+    :param engine: The engine on which to run EXPLAIN. With in-memory
+        SQLite databases, make sure the engine's pool shares the
+        connection between threads.
+    :param top: How many groups, by total time, to explain per report.
+    :param min_interval: Minimum number of seconds between two EXPLAIN.
+    :param statement_types: The first keywords of the statements that may
+        be explained. Only SELECT by default, since on some databases
+        EXPLAIN of a data modifying statement has side effects.
+    """
+
+    def __init__(self, engine, top=10, min_interval=1.0,
+                 statement_types=("SELECT",)):
+        self.engine = engine
+        self.top = top
+        self.min_interval = min_interval
+        self.statement_types = tuple(t.upper() for t in statement_types)
+        self.plans = {}
+        self._pending = set()
+        self._queue = queue.Queue(0)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_run = 0
+
+    def get(self, group):
+        """ Return the :class:`QueryPlan` of `group`, or None if it was not
+        captured yet. """
+        return self.plans.get(sqltap.fingerprint(group.text))
+
+    def submit(self, group):
+        """ Request the plan of `group` unless it is already known.
+
+        :return: True if the group was queued for EXPLAIN.
+        """
+        if not group.queries:
+            return False
+        if group.first_word.upper() not in self.statement_types:
+            return False
+        if self.engine.dialect.name not in EXPLAIN_PREFIXES:
+            return False
+
+        key = sqltap.fingerprint(group.text)
+
+        with self._lock:
+            if key in self.plans or key in self._pending:
+                return False
+            self._pending.add(key)
+            self._start()
+
+        # an execution with the most frequent parameter set of the group
+        params_hash = None
+        if group.params_hashes:
+            params_hash = max(group.params_hashes,
+                              key=lambda k: group.params_hashes[k][0])[1]
+        executed = [q for q in group.queries
+                    if q.executed_statement is not None]
+        if not executed:
+            with self._lock:
+                self._pending.discard(key)
+            return False
+        q = next((q for q in executed if q.params_hash == params_hash),
+                 executed[0])
+        self._queue.put((key, q.executed_statement, q.executed_params))
+        return True
+
+    def submit_groups(self, groups):
+        """ Request the plans of the `top` groups with the largest total
+        time. """
+        candidates = [g for g in groups if g.queries]
+        candidates = [g for g in candidates
+                      if g.first_word.upper() in self.statement_types]
+        candidates.sort(key=lambda g: g.sum, reverse=True)
+        for group in candidates[:self.top]:
+            self.submit(group)
+
+    def wait(self):
+        """ Block until all requested plans were captured. """
+        self._queue.join()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="sqltap-explain")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            key, text, params = self._queue.get()
+            try:
+                delay = self._last_run + self.min_interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                plan = self.explain(key, text, params)
+                self._last_run = time.time()
+                with self._lock:
+                    self.plans[key] = plan
+                    self._pending.discard(key)
+            finally:
+                self._queue.task_done()
+
+    def explain(self, key, statement, params):
+        """ Run EXPLAIN for `statement` with `params`, as sent to the
+        driver (see :attr:`sqltap.QueryStats.executed_statement`), and
+        return its :class:`QueryPlan`. """
+        dialect_name = self.engine.dialect.name
+        if params is None:
+            params = () if self.engine.dialect.positional else {}
+
+        try:
+            with self.engine.connect() as conn:
+                conn = conn.execution_options(sqltap_ignore=True)
+                result = conn.exec_driver_sql(
+                    EXPLAIN_PREFIXES[dialect_name] + statement, params)
+                rows, full_scans = _plan_lines(dialect_name, result)
+        except Exception as e:
+            return QueryPlan(key, statement, error=str(e).strip())
+        return QueryPlan(key, statement, rows, full_scans)
@@ -0,0 +1,338 @@
+""" Index suggestions from the predicates of the captured queries.
+
+The statements of the heaviest query groups are parsed with sqlparse to
+find the columns they filter and join on, per table. Those columns are
+turned into candidate indexes, weighted by the time and rows of the
+queries needing them, and checked against the indexes of the database::
+
+    advisor = sqltap.indexes.IndexAdvisor(engine)
+    for suggestion in advisor.suggest_stats(statistics):
+        if suggestion.existing is None:
+            print(suggestion.ddl())
+
+Pass the advisor to :func:`sqltap.report` with the `indexes` argument to
+add the suggestions to the report.
+"""
+from __future__ import absolute_import
+
+import collections
+import functools
+import threading
+
+import sqlalchemy
+import sqlparse
+import sqlparse.sql
+import sqlparse.tokens
+
+from . import sqltap
+
+#: The comparison operators of equality predicates, usable by any column
+#: of an index, and of range predicates, usable by its last column.
+EQUALITY_OPERATORS = frozenset(("=", "==", "IN", "IS"))
+RANGE_OPERATORS = frozenset(("<", "<=", ">", ">=", "LIKE", "BETWEEN"))
+
+_T = sqlparse.tokens
+
+
+def _column(token):
+    """ Return ``(qualifier, name)`` if `token` is a plain column
+    reference, None otherwise. """
+    if not isinstance(token, sqlparse.sql.Identifier):
+        return None
+    first = token.token_first(skip_cm=True)
+    if first is None or first.ttype not in (_T.Name, _T.Literal.String.Symbol):
+        return None
+    name = token.get_real_name()
+    if name is None:
+        return None
+    parent = token.get_parent_name()
+    return (parent.lower() if parent else None, name.lower())
+
+
+def _is_subquery(token):
+    if not isinstance(token, sqlparse.sql.Parenthesis):
+        return False
+    for t in token.tokens[1:]:
+        if not t.is_whitespace:
+            return t.ttype is _T.DML
+    return False
+
+
+class _Scope(object):
+    """ The tables and predicates of one SELECT, UPDATE or DELETE """
+
+    def __init__(self):
+        self.aliases = collections.OrderedDict()
+        self.predicates = []
+
+    def add_table(self, identifier):
+        if not isinstance(identifier, sqlparse.sql.Identifier):
+            return
+        name = identifier.get_real_name()
+        if name is None or _is_subquery(identifier.token_first()):
+            return
+        alias = identifier.get_alias() or name
+        self.aliases[alias.lower()] = name.lower()
+
+    def add(self, column, kind):
+        self.predicates.append((column, kind))
+
+    def resolve(self):
+        """ Yield the ``(table, column, kind)`` of the predicates """
+        tables = set(self.aliases.values())
+        for (qualifier, name), kind in self.predicates:
+            if qualifier is not None:
+                table = self.aliases.get(qualifier)
+            elif len(tables) == 1:
+                table = next(iter(tables))
+            else:
+                table = None
+            if table is not None:
+                yield table, name, kind
+
+
+def _walk(tokens, scope, scopes, in_from=False):
+    """ Collect the tables and predicates of `tokens` into `scope`, and
+    the subqueries into new scopes appended to `scopes`. """
+    tokens = [t for t in tokens if not t.is_whitespace]
+    # the assignments of an UPDATE are not predicates
+    in_set = False
+    for i, token in enumerate(tokens):
+        if token.ttype in _T.Keyword:
+            value = token.normalized
+            in_from = value.endswith("JOIN")
+            if value in ("FROM", "UPDATE", "INTO"):
+                in_from = True
+            in_set = value == "SET"
+            # "column IN (...)", "column IS NULL", "column BETWEEN ..."
+            column = _column(tokens[i - 1]) if i else None
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            negated = False
+            if following is not None:
+                negated = following.normalized.startswith("NOT")
+            if column is not None and not negated:
+                if value in EQUALITY_OPERATORS:
+                    scope.add(column, "eq")
+                elif value in RANGE_OPERATORS:
+                    scope.add(column, "range")
+            continue
+        if in_from:
+            if isinstance(token, sqlparse.sql.IdentifierList):
+                for identifier in token.get_identifiers():
+                    scope.add_table(identifier)
+            else:
+                scope.add_table(token)
+            in_from = False
+        if _is_subquery(token):
+            sub = _Scope()
+            scopes.append(sub)
+            _walk(token.tokens[1:-1], sub, scopes)
+        elif isinstance(token, sqlparse.sql.Comparison):
+            if not in_set:
+                _comparison(token, scope)
+        elif isinstance(token, (sqlparse.sql.Where,
+                                sqlparse.sql.Parenthesis)):
+            _walk(token.tokens, scope, scopes)
+        elif isinstance(token, sqlparse.sql.Identifier):
+            # "(SELECT ...) AS alias"
+            for sub in token.tokens:
+                if _is_subquery(sub):
+                    _walk([sub], scope, scopes)
+
+
+def _comparison(token, scope):
+    left, right = _column(token.left), _column(token.right)
+    operator = None
+    for t in token.tokens:
+        if t.ttype is _T.Operator.Comparison:
+            operator = t.normalized.upper()
+    if left is not None and right is not None:
+        scope.add(left, "join")
+        scope.add(right, "join")
+    elif left is not None or right is not None:
+        column = left if left is not None else right
+        if operator in EQUALITY_OPERATORS:
+            scope.add(column, "eq")
+        elif operator in RANGE_OPERATORS:
+            scope.add(column, "range")
+
+
+@functools.lru_cache(maxsize=1024)
+def extract_predicates(sql):
+    """ Return the columns `sql` filters or joins on, as a tuple of
+    ``(table, column, kind)`` with lower case names. `kind` is ``"eq"``
+    for equality and IN predicates, ``"range"`` for comparisons, LIKE and
+    BETWEEN, and ``"join"`` for comparisons between two columns.
+
+    Unqualified columns are only attributed to the table of statements
+    reading a single table.
+    """
+    predicates = []
+    for statement in sqlparse.parse(sql):
+        scopes = [_Scope()]
+        _walk(statement.tokens, scopes[0], scopes)
+        for scope in scopes:
+            for predicate in scope.resolve():
+                if predicate not in predicates:
+                    predicates.append(predicate)
+    return tuple(predicates)
+
+
+class IndexSuggestion(object):
+    """ A candidate index, and the queries which would use it.
+
+    :param table: The name of the table.
+    :param equal: The columns compared for equality, which come first in
+        the index, in any order.
+    :param range: The column compared with a range, which comes last,
+        or None.
+    """
+
+    def __init__(self, table, equal, range=None):
+        self.table = table
+        self.equal = equal
+        self.range = range
+        #: the indexed columns
+        self.columns = equal + ((range,) if range is not None else ())
+        #: total time and rows of the queries using the index
+        self.time = 0.0
+        self.rows = 0
+        self.count = 0
+        self.fingerprints = []
+        #: name of an existing index covering the columns, if any
+        self.existing = None
+
+    def add(self, fingerprint, group):
+        self.time += group.sum
+        self.rows += group.rows
+        self.count += group.count
+        if fingerprint not in self.fingerprints:
+            self.fingerprints.append(fingerprint)
+
+    def ddl(self):
+        """ The CREATE INDEX statement of the suggestion """
+        return "CREATE INDEX ix_%s_%s ON %s (%s)" % (
+            self.table, "_".join(self.columns), self.table,
+            ", ".join(self.columns))
+
+    def __repr__(self):
+        return "<%s %s(%s) time=%.3f existing=%r>" % (
+            self.__class__.__name__, self.table, ", ".join(self.columns),
+            self.time, self.existing)
+
+
+def _candidates(predicates):
+    """ Yield the ``(table, equal, range)`` of the indexes for
+    `predicates`: one for the filters of each table, and one for each
+    join column not already in it. """
+    by_table = collections.OrderedDict()
+    for table, column, kind in predicates:
+        by_table.setdefault(table, []).append((column, kind))
+    for table, columns in by_table.items():
+        equal = tuple(sorted(set(c for c, kind in columns if kind == "eq")))
+        ranges = [c for c, kind in columns
+                  if kind == "range" and c not in equal]
+        range = ranges[0] if ranges else None
+        if equal or range is not None:
+            yield table, equal, range
+        for column, kind in columns:
+            if kind == "join" and column not in equal and column != range:
+                yield table, (column,), None
+
+
+class IndexAdvisor(object):
+    """ Suggest indexes for the columns filtered and joined on by the
+    heaviest query groups.
+
+    :param engine: If given, the engine whose database is inspected for
+        existing indexes. Suggestions are then only made for the tables of
+        the database, and those covered by an index get its name as their
+        ``existing`` attribute. The inspection is done once, for all
+        tables, until :meth:`refresh`, on a connection which is not
+        profiled.
+    :param top: The number of query groups, by total time, analyzed.
+    """
+
+    def __init__(self, engine=None, top=20):
+        self.engine = engine
+        self.top = top
+        self._indexes = None
+        self._lock = threading.Lock()
+
+    def suggest(self, groups):
+        """ Return the :class:`IndexSuggestion` for a list of
+        :class:`sqltap.QueryGroup`, heaviest first. """
+        groups = sorted((g for g in groups if g.queries),
+                        key=lambda g: g.sum, reverse=True)
+        suggestions = collections.OrderedDict()
+        for group in groups[:self.top]:
+            key = sqltap.fingerprint(group.text)
+            for candidate in _candidates(extract_predicates(group.text)):
+                suggestion = suggestions.get(candidate)
+                if suggestion is None:
+                    suggestion = suggestions[candidate] = \
+                        IndexSuggestion(*candidate)
+                suggestion.add(key, group)
+
+        result = list(suggestions.values())
+        if self.engine is not None:
+            indexes = self.indexes()
+            result = [s for s in result if s.table in indexes]
+            for suggestion in result:
+                suggestion.existing = self._covering(
+                    indexes[suggestion.table], suggestion)
+        result.sort(key=lambda s: (s.time, s.rows), reverse=True)
+        return result
+
+    def suggest_stats(self, stats):
+        """ Return the suggestions for a list of :class:`sqltap.QueryStats`,
+        grouped by :func:`sqltap.fingerprint`. """
+        return self.suggest(sqltap.group_by_fingerprint(stats).values())
+
+    def indexes(self):
+        """ Return the indexes of the database, as a dict of lists of
+        ``(name, columns)`` keyed by lower case table name. The primary
+        key and unique constraints are included. """
+        with self._lock:
+            if self._indexes is None:
+                self._indexes = self._inspect()
+            return self._indexes
+
+    def refresh(self):
+        """ Forget the indexes inspected, e.g. after creating some. """
+        with self._lock:
+            self._indexes = None
+
+    def _inspect(self):
+        indexes = {}
+        with self.engine.connect() as conn:
+            conn = conn.execution_options(sqltap_ignore=True)
+            inspector = sqlalchemy.inspect(conn)
+            for table in inspector.get_table_names():
+                found = []
+                pk = inspector.get_pk_constraint(table)
+                if pk and pk.get("constrained_columns"):
+                    found.append((pk.get("name") or "PRIMARY KEY",
+                                  pk["constrained_columns"]))
+                for unique in inspector.get_unique_constraints(table):
+                    found.append((unique["name"], unique["column_names"]))
+                for index in inspector.get_indexes(table):
+                    found.append((index["name"], index["column_names"]))
+                indexes[table.lower()] = [
+                    (name, [c.lower() for c in columns if c is not None])
+                    for name, columns in found]
+        return indexes
+
+    @staticmethod
+    def _covering(indexes, suggestion):
+        """ The name of the first of `indexes` starting with the columns
+        of `suggestion`. """
+        count = len(suggestion.equal)
+        for name, indexed in indexes:
+            if len(indexed) < len(suggestion.columns):
+                continue
+            if set(indexed[:count]) != set(suggestion.equal):
+                continue
+            if suggestion.range is None or indexed[count] == suggestion.range:
+                return name
+        return None
@@ -0,0 +1,209 @@
+""" A pytest plugin profiling the queries issued by tests.
+
+The plugin is registered automatically when sqltap is installed. Tests are
+profiled when run with ``--sqltap``, or when they carry one of the markers
+below. By default a test is profiled in counting-only mode, which only
+keeps the number and total duration of its queries; ``--sqltap-full``
+captures a :class:`sqltap.QueryStats` per query, and ``--sqltap-report``
+writes all of them to a report at the end of the session.
+
+Markers::
+
+    @pytest.mark.max_queries(5)
+    def test_listing(client):
+        client.get("/items")
+
+    @pytest.mark.max_query_time(0.5)
+    def test_search(client):
+        client.get("/search?q=spam")
+
+Fixtures:
+
+- ``sqltap_profiler``: a started :class:`sqltap.ProfilingSession` for the
+  duration of the test, whose queries are available from ``collect()``.
+- ``assert_max_queries``: returns a context manager failing the test if
+  more queries than given are issued within it::
+
+      def test_detail(client, assert_max_queries):
+          with assert_max_queries(2):
+              client.get("/items/1")
+
+With ``--sqltap``, a summary of the tests spending the most time in the
+database is printed at the end of the session.
+"""
+from __future__ import absolute_import
+
+import contextlib
+
+import pytest
+import sqlalchemy.engine
+
+from . import sqltap
+
+
+class TestQueries(object):
+    """ The queries issued by one test """
+
+    __test__ = False
+
+    def __init__(self, nodeid, count, time):
+        self.nodeid = nodeid
+        self.count = count
+        self.time = time
+
+
+class SQLTapPlugin(object):
+    """ Profiles the test calls and records a :class:`TestQueries` per
+    profiled test in :attr:`results`. """
+
+    def __init__(self, config):
+        self.profile_all = config.getoption("sqltap")
+        self.report_file = config.getoption("sqltap_report")
+        self.full = config.getoption("sqltap_full") or bool(self.report_file)
+        self.top = config.getoption("sqltap_top")
+        self.results = []
+        self.stats = []
+        # (item, session, limits) of the test being profiled
+        self._current = None
+
+    def _limits(self, item):
+        limits = {}
+        for name in ("max_queries", "max_query_time"):
+            marker = item.get_closest_marker(name)
+            if marker is not None:
+                if len(marker.args) != 1:
+                    raise pytest.UsageError(
+                        "%s of %s takes a single argument"
+                        % (name, item.nodeid))
+                limits[name] = marker.args[0]
+        return limits
+
+    # an old-style hook wrapper, which works with every version of pluggy;
+    # it must not raise, the limits are checked by check_limits
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item):
+        limits = self._limits(item)
+        if not limits and not self.profile_all:
+            yield
+            return
+
+        if self.full:
+            session = sqltap.ProfilingSession(
+                user_context_fn=lambda *args: item.nodeid,
+                collect_fn=self.stats.append)
+        else:
+            session = sqltap.ProfilingSession(count_only=True)
+        session.start()
+        self._current = (item, session, limits)
+        try:
+            yield
+        finally:
+            # the test failed before its limits were checked
+            self._finish(item)
+
+    def _finish(self, item):
+        """ Stop profiling `item` and return its ``(session, limits)``,
+        or None if it is not being profiled. """
+        current, self._current = self._current, None
+        if current is None or current[0] is not item:
+            return None
+        item, session, limits = current
+        session.stop()
+        self.results.append(TestQueries(
+            item.nodeid, session.query_count, session.query_time))
+        return session, limits
+
+    def check_limits(self, item):
+        """ Stop profiling `item`, which passed, and fail it if it
+        exceeded its limits. """
+        finished = self._finish(item)
+        if finished is None:
+            return
+        session, limits = finished
+        max_queries = limits.get("max_queries")
+        if max_queries is not None and session.query_count > max_queries:
+            pytest.fail("%s issued %d queries, expected at most %d"
+                        % (item.nodeid, session.query_count, max_queries),
+                        pytrace=False)
+        max_time = limits.get("max_query_time")
+        if max_time is not None and session.query_time > max_time:
+            pytest.fail("%s spent %.3fs in queries, expected at most %.3fs"
+                        % (item.nodeid, session.query_time, max_time),
+                        pytrace=False)
+
+    def pytest_sessionfinish(self, session):
+        if self.report_file and self.stats:
+            sqltap.report(self.stats, self.report_file)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.profile_all or not self.results:
+            return
+        results = sorted(self.results, key=lambda r: r.time, reverse=True)
+        terminalreporter.write_sep("=", "sqltap: slowest tests by query time")
+        for r in results[:self.top]:
+            terminalreporter.write_line("%8.3fs %6d queries  %s"
+                                        % (r.time, r.count, r.nodeid))
+        terminalreporter.write_line(
+            "%8.3fs %6d queries  total for %d tests"
+            % (sum(r.time for r in results), sum(r.count for r in results),
+               len(results)))
+        if self.report_file:
+            terminalreporter.write_line("report written to %s"
+                                        % self.report_file)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("sqltap", "query profiling with sqltap")
+    group.addoption(
+        "--sqltap", action="store_true", default=False,
+        help="profile the queries of every test and summarize them")
+    group.addoption(
+        "--sqltap-full", action="store_true", default=False,
+        help="capture the statistics of each query instead of only "
+             "counting them")
+    group.addoption(
+        "--sqltap-report", metavar="PATH", default=None,
+        help="write an HTML report of the queries of all profiled tests "
+             "(implies --sqltap-full)")
+    group.addoption(
+        "--sqltap-top", metavar="N", type=int, default=10,
+        help="number of tests shown in the summary (default 10)")
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_call(item):
+    """ Runs after the test function, only if it passed """
+    plugin = item.config.pluginmanager.get_plugin("sqltap-plugin")
+    if plugin is not None:
+        plugin.check_limits(item)
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "max_queries(n): fail if the test issues more than n "
+                   "SQL queries")
+    config.addinivalue_line(
+        "markers", "max_query_time(seconds): fail if the test spends more "
+                   "than this in SQL queries")
+    config.pluginmanager.register(SQLTapPlugin(config), "sqltap-plugin")
+
+
+@pytest.fixture
+def sqltap_profiler():
+    """ A :class:`sqltap.ProfilingSession` started for the test """
+    with sqltap.ProfilingSession() as profiler:
+        yield profiler
+
+
+@pytest.fixture
+def assert_max_queries():
+    """ Return a context manager failing the test if the code it wraps
+    issues more than `n` queries. """
+    @contextlib.contextmanager
+    def assert_max_queries(n, engine=sqlalchemy.engine.Engine):
+        with sqltap.ProfilingSession(engine, count_only=True) as session:
+            yield session
+        if session.query_count > n:
+            pytest.fail("%d queries issued, expected at most %d"
+                        % (session.query_count, n), pytrace=False)
+    return assert_max_queries
@@ -0,0 +1,316 @@
+""" Replay a sqltap capture against an engine, to benchmark schema or index
+changes with a realistic workload.
+
+The statements of a capture are executed again with their parameters,
+keeping their original timing or at a faster rate, by a pool of threads.
+The replay is profiled by a :class:`sqltap.ProfilingSession`, so that it
+can be reported on, or compared with the capture::
+
+    result = sqltap.replay.replay(statistics, copy_engine, speed=10,
+                                  concurrency=4)
+    sqltap.diff.compare(statistics, result.stats)
+
+Captures saved by the NDJSON or JSON (with ``include_queries=True``)
+reporters can be replayed from the command line::
+
+    python -m sqltap.replay queries.ndjson sqlite:///copy.db --speed 10
+
+The statements are replayed as they were sent to the database, with
+their IN lists expanded (see :attr:`sqltap.QueryStats.executed_statement`),
+so the target must use the same dialect as the captured engine, e.g. a
+local copy of the database. Statements run with several parameter sets
+(``executemany``) are replayed with the last one.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import json
+import re
+import sys
+import time
+
+import sqlalchemy
+
+from . import sqltap
+
+
+class ReplayQuery(object):
+    """ A statement of a capture to replay.
+
+    :param statement: The SQL, as sent to the database.
+    :param params: A dict of the parameters, in the order of the
+        placeholders for dialects with positional parameters. A parameter
+        used twice then appears twice, under different names.
+    :param start_time: When the statement was originally executed.
+    """
+
+    @staticmethod
+    def _params(params):
+        """ The parameters sent to the driver as a dict, see `params` """
+        if isinstance(params, (list, tuple)):
+            return collections.OrderedDict(
+                ("p%d" % i, value) for i, value in enumerate(params))
+        return params or {}
+
+    def __init__(self, statement, params, start_time):
+        self.statement = statement
+        self.params = params
+        self.start_time = start_time
+        words = statement.split(None, 1)
+        self.first_word = words[0].upper() if words else ""
+
+    @classmethod
+    def from_stats(cls, q):
+        """ The query of a :class:`sqltap.QueryStats` """
+        if q.executed_statement is not None:
+            return cls(q.executed_statement, cls._params(q.executed_params),
+                       q.start_time)
+        # not executed through SQLAlchemy, the compiled text is the best
+        # approximation
+        params = q.params or {}
+        positiontup = getattr(q.text, "positiontup", None)
+        if positiontup:
+            params = [params.get(name) for name in positiontup]
+        return cls(str(q.text), cls._params(params), q.start_time)
+
+    @classmethod
+    def from_record(cls, record):
+        """ The query of a record written by :func:`sqltap.query_record` """
+        if record.get("executed_statement") is not None:
+            return cls(record["executed_statement"],
+                       cls._params(record.get("executed_params")),
+                       record["start_time"])
+        return cls(record["statement"], cls._params(record.get("params")),
+                   record["start_time"])
+
+
+def load(path):
+    """ Load the queries of a capture written by the NDJSON reporter, or by
+    the JSON reporter with ``include_queries=True`` if the name of the
+    file ends with ``.json`` (``.json.gz``). """
+    with sqltap._open_report(path, "r") as f:
+        if path.endswith((".json", ".json.gz")):
+            records = json.load(f)["queries"]
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        return [ReplayQuery.from_record(record) for record in records]
+
+
+class ReplayResult(object):
+    """ The outcome of :func:`replay`.
+
+    - :attr:`count`: the number of statements replayed.
+    - :attr:`errors`: ``(query, message)`` of the statements which failed.
+    - :attr:`elapsed`: the duration of the replay, in seconds.
+    - :attr:`max_lag`: how late, at most, a statement started compared to
+      its schedule, when the target or the pool could not keep up.
+    - :attr:`stats`: the :class:`sqltap.QueryStats` of the replay, if it
+      was profiled.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = []
+        self.elapsed = 0.0
+        self.max_lag = 0.0
+        self.stats = []
+
+    @property
+    def rate(self):
+        """ The number of statements replayed per second """
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return "<%s count=%d errors=%d elapsed=%.3f max_lag=%.3f>" % (
+            self.__class__.__name__, self.count, len(self.errors),
+            self.elapsed, self.max_lag)
+
+
+def _coerce(capture):
+    """ Accept a list of :class:`ReplayQuery` or :class:`sqltap.QueryStats`,
+    or the path of a capture. """
+    if isinstance(capture, str):
+        return load(capture)
+    return [q if isinstance(q, ReplayQuery) else ReplayQuery.from_stats(q)
+            for q in capture]
+
+
+_PLACEHOLDERS = {
+    "qmark": r"\?",
+    "format": r"%s",
+    "numeric": r":\d+",
+    "pyformat": r"%\((?P<name>\w+)\)s",
+}
+
+# quoted strings and identifiers, with or without backslash escapes
+_QUOTED = r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`(?:[^`]|``)*`"
+_QUOTED_BACKSLASH = (r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\""
+                     r"|`(?:[^`]|``)*`")
+
+
+@functools.lru_cache(maxsize=None)
+def _tokenizer(paramstyle, backslash_escapes):
+    """ The regex matching the quoted parts, the placeholders and the other
+    colons of the statements of `paramstyle`. """
+    pattern = "(?P<quoted>%s)" % (
+        _QUOTED_BACKSLASH if backslash_escapes else _QUOTED)
+    if paramstyle in _PLACEHOLDERS:
+        pattern += "|(?P<placeholder>%s)|(?P<colon>:)" % (
+            _PLACEHOLDERS[paramstyle])
+    return re.compile(pattern, re.S)
+
+
+def _text(q, dialect):
+    """ Return `q` as a :func:`sqlalchemy.text` clause with named bind
+    parameters, which unlike driver level SQL is seen by the execute events
+    sqltap listens to.
+
+    :raises ValueError: If the statement has more placeholders than `q`
+        has parameters.
+    """
+    paramstyle = dialect.paramstyle
+    names = iter(q.params)
+
+    def replace(match):
+        if match.group("quoted") is not None:
+            # text() would take ":word" for a bind parameter
+            return match.group("quoted").replace(":", "\\:")
+        if match.group("colon") is not None:
+            return "\\:"
+        if paramstyle == "pyformat":
+            return ":" + match.group("name")
+        name = next(names, None)
+        if name is None:
+            raise ValueError("the statement has more placeholders than its "
+                             "%d parameters" % len(q.params))
+        return ":" + name
+
+    tokenizer = _tokenizer(paramstyle,
+                           dialect.name in ("mysql", "mariadb"))
+    sql = tokenizer.sub(replace, q.statement)
+    if paramstyle in ("format", "pyformat"):
+        # text() escapes the percent signs again
+        sql = sql.replace("%%", "%")
+    return sqlalchemy.text(sql)
+
+
+def _execute(engine, q, due):
+    """ Execute `q` in a transaction of its own. Return how late it started
+    and the error message if it failed. """
+    lag = max(time.time() - due, 0.0) if due is not None else 0.0
+    try:
+        clause = _text(q, engine.dialect)
+    except ValueError as e:
+        return lag, str(e)
+    try:
+        with engine.begin() as conn:
+            result = conn.execute(clause, dict(q.params))
+            if result.returns_rows:
+                result.fetchall()
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        return lag, str(e).strip()
+    return lag, None
+
+
+def replay(capture, engine, speed=1.0, concurrency=1, statement_types=None,
+           profile=True):
+    """ Execute the statements of a capture against `engine`.
+
+    :param capture: A list of :class:`sqltap.QueryStats`, as returned by
+        :meth:`sqltap.ProfilingSession.collect`, a list of
+        :class:`ReplayQuery`, or the path of a capture, see :func:`load`.
+    :param engine: The engine on which to replay the statements.
+    :param speed: How much faster than originally the statements are
+        started, e.g. 1 for the original timing or 10 for ten times
+        faster. With None, each statement starts as soon as a thread is
+        available.
+    :param concurrency: The number of threads executing the statements,
+        each on a connection of its own.
+    :param statement_types: If given, only replay the statements with
+        these first keywords, e.g. ``["SELECT"]`` for a read only replay.
+    :param profile: Profile the replay with a
+        :class:`sqltap.ProfilingSession`.
+
+    :return: A :class:`ReplayResult`.
+    """
+    queries = sorted(_coerce(capture), key=lambda q: q.start_time)
+    if statement_types is not None:
+        types = set(t.upper() for t in statement_types)
+        queries = [q for q in queries if q.first_word in types]
+
+    result = ReplayResult()
+    result.count = len(queries)
+    profiler = sqltap.ProfilingSession(engine) if profile else None
+    executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    if profiler is not None:
+        profiler.start()
+    start = time.time()
+    try:
+        futures = []
+        for q in queries:
+            due = None
+            if speed:
+                due = start + (q.start_time - queries[0].start_time) / speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(_execute, engine, q, due))
+        for q, future in zip(queries, futures):
+            lag, error = future.result()
+            result.max_lag = max(result.max_lag, lag)
+            if error is not None:
+                result.errors.append((q, error))
+    finally:
+        executor.shutdown(wait=True)
+        result.elapsed = time.time() - start
+        if profiler is not None:
+            profiler.stop()
+    if profiler is not None:
+        result.stats = profiler.collect()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m sqltap.replay",
+        description="Replay a sqltap capture against a database and report "
+                    "on the replay.")
+    parser.add_argument("capture", help="capture written by the ndjson "
+                                        "reporter, or the json one (.json)")
+    parser.add_argument("url", help="SQLAlchemy URL of the target database")
+    parser.add_argument(
+        "--speed", type=float, default=1.0,
+        help="replay this many times faster than captured, 0 for as fast "
+             "as possible (default 1)")
+    parser.add_argument(
+        "--concurrency", type=int, default=1,
+        help="number of threads executing the statements (default 1)")
+    parser.add_argument(
+        "--statement-type", action="append", dest="statement_types",
+        metavar="KEYWORD",
+        help="only replay statements starting with this keyword, e.g. "
+             "SELECT; may be repeated")
+    parser.add_argument("--report", metavar="PATH",
+                        help="write a report of the replay to this file")
+    args = parser.parse_args(argv)
+
+    engine = sqlalchemy.create_engine(args.url)
+    result = replay(args.capture, engine, speed=args.speed or None,
+                    concurrency=args.concurrency,
+                    statement_types=args.statement_types)
+    print("replayed %d statements in %.3fs (%.1f/s), max lag %.3fs, "
+          "%d errors" % (result.count, result.elapsed, result.rate,
+                         result.max_lag, len(result.errors)))
+    for q, error in result.errors[:10]:
+        print("  %s: %s" % (q.statement.split("\n")[0][:60], error))
+    if args.report:
+        sqltap.report(result.stats, args.report)
+        print("report written to %s" % args.report)
+    return 1 if result.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
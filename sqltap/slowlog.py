@@ -0,0 +1,228 @@
+""" A slow query log for :class:`sqltap.ProfilingSession`.
+
+:class:`SlowQueryLog` is a `collect_fn` emitting a structured
+:mod:`logging` record for every query slower than a threshold::
+
+    slow_log = sqltap.slowlog.SlowQueryLog(threshold=0.2)
+    profiler = sqltap.start(collect_fn=slow_log)
+"""
+from __future__ import absolute_import
+
+import datetime
+import logging
+import logging.handlers
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import sqltap
+
+
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(
+        " ", "seconds")
+
+
+class _LoggerHandler(logging.Handler):
+    """ Hands the records over to a logger, with its own handlers """
+
+    def __init__(self, logger):
+        super(_LoggerHandler, self).__init__()
+        self.logger = logger
+
+    def emit(self, record):
+        self.logger.handle(record)
+
+
+class _Limit(object):
+    """ The records of a fingerprint in the current period """
+
+    __slots__ = ('start', 'emitted', 'suppressed', 'fingerprint')
+
+    def __init__(self, start, fingerprint):
+        self.start = start
+        self.emitted = 0
+        self.suppressed = 0
+        self.fingerprint = fingerprint
+
+
+class SlowQueryLog(object):
+    """ A `collect_fn` logging the queries lasting at least `threshold`
+    seconds.
+
+    The records are handled in a background thread, behind a
+    :class:`logging.handlers.QueueHandler`, so that slow handlers never
+    delay the queries. Besides the message, they carry these attributes,
+    for structured log formatters:
+
+    - ``fingerprint``: the :func:`sqltap.fingerprint` of the statement.
+    - ``duration``: the duration of the query in seconds.
+    - ``caller``: ``"file:line in function"`` of the innermost frame
+      outside of SQLAlchemy, see :meth:`sqltap.QueryGroup.find_user_fn`.
+    - ``params``: the parameters, with long values truncated.
+    - ``suppressed``: 0, or for the summaries of the rate limit, the
+      number of records of the fingerprint dropped.
+    - ``period_start``, ``period_end``: for the summaries, the times, from
+      :func:`time.time`, between which the records were dropped.
+
+    At most `rate` records are emitted per fingerprint every `period`
+    seconds, counted from its first record. Once a period has ended, its
+    state is forgotten and the number of records it dropped is logged by
+    a summary record. Periods are checked for their end as queries go
+    through the log, at least every `period` seconds, and by
+    :meth:`flush`.
+
+    :param threshold: The minimum duration of the logged queries.
+    :param logger: The logger, or its name, handling the records.
+    :param level: The level of the records.
+    :param rate: The number of records per fingerprint and period.
+    :param period: The length in seconds of a rate limiting period.
+    :param max_params: The number of parameters logged per query.
+    :param max_param_length: The length at which parameter values are
+        truncated.
+    :param collect_fn: If given, every query is passed on to it, e.g.
+        to also collect them for a report.
+    """
+
+    def __init__(self, threshold=1.0, logger="sqltap.slowlog",
+                 level=logging.WARNING, rate=1, period=60.0, max_params=10,
+                 max_param_length=80, collect_fn=None):
+        if not isinstance(logger, logging.Logger):
+            logger = logging.getLogger(logger)
+        self.threshold = threshold
+        self.logger = logger
+        self.level = level
+        self.rate = rate
+        self.period = period
+        self.max_params = max_params
+        self.max_param_length = max_param_length
+        self.collect_fn = collect_fn
+        self._limits = {}
+        self._next_expiry = 0.0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(-1)
+        self._handler = logging.handlers.QueueHandler(self._queue)
+        self._listener = None
+
+    def __call__(self, q):
+        if self.collect_fn is not None:
+            self.collect_fn(q)
+        if q.end_time >= self._next_expiry:
+            with self._lock:
+                expired = self._expire(q.end_time)
+            self._summarize(expired)
+        if q.duration < self.threshold:
+            return
+        if not self.logger.isEnabledFor(self.level):
+            return
+
+        key = sqltap.fingerprint(str(q.text))
+        expired = []
+        with self._lock:
+            limit = self._limits.get(key)
+            if limit is not None and q.end_time - limit.start >= self.period:
+                expired.append(self._limits.pop(key))
+                limit = None
+            if limit is None:
+                limit = self._limits[key] = _Limit(q.end_time, key)
+            emit = limit.emitted < self.rate
+            if emit:
+                limit.emitted += 1
+            else:
+                limit.suppressed += 1
+        self._summarize(expired)
+        if not emit:
+            return
+
+        caller = sqltap.QueryGroup.find_user_fn(q.stack or ())
+        if caller is not None:
+            caller = "%s:%s in %s" % (caller[0], caller[1], caller[2])
+        params = self.truncate_params(q.params)
+        self._emit("slow query, %.3fs from %s: %s", (q.duration, caller, key),
+                   {
+                       "fingerprint": key,
+                       "duration": q.duration,
+                       "caller": caller,
+                       "params": params,
+                       "suppressed": 0,
+                       "period_start": None,
+                       "period_end": None,
+                   })
+
+    def _expire(self, now):
+        """ Forget the periods ended at `now` and return their limits.
+        Called with the lock held. """
+        self._next_expiry = now + self.period
+        expired = [limit for limit in self._limits.values()
+                   if now - limit.start >= self.period]
+        for limit in expired:
+            del self._limits[limit.fingerprint]
+        return expired
+
+    def truncate_params(self, params):
+        """ Return the first `max_params` of `params` with their values
+        shortened to `max_param_length` characters. """
+        truncated = {}
+        for name in sorted(params or {}, key=str)[:self.max_params]:
+            value = params[name]
+            if not isinstance(value, (int, float, type(None))):
+                value = str(value)
+                if len(value) > self.max_param_length:
+                    value = value[:self.max_param_length] + "..."
+            truncated[name] = value
+        return truncated
+
+    def flush(self):
+        """ Emit a summary for each fingerprint with records dropped by the
+        rate limit, and restart the rate limiting. """
+        with self._lock:
+            limits = list(self._limits.values())
+            self._limits.clear()
+        self._summarize(limits, time.time())
+
+    def _summarize(self, limits, now=None):
+        """ Emit the summaries of `limits`, whose periods ended, or were
+        interrupted at `now`. """
+        for limit in limits:
+            if not limit.suppressed:
+                continue
+            end = limit.start + self.period
+            if now is not None:
+                end = min(end, now)
+            self._emit("%d more slow queries from %s to %s: %s",
+                       (limit.suppressed, _format_time(limit.start),
+                        _format_time(end), limit.fingerprint), {
+                           "fingerprint": limit.fingerprint,
+                           "duration": None,
+                           "caller": None,
+                           "params": None,
+                           "suppressed": limit.suppressed,
+                           "period_start": limit.start,
+                           "period_end": end,
+                       })
+
+    def close(self):
+        """ :meth:`flush` and wait until all the records were handled. """
+        self.flush()
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+
+    def _start(self):
+        if self._listener is None:
+            self._listener = logging.handlers.QueueListener(
+                self._queue, _LoggerHandler(self.logger))
+            self._listener.start()
+
+    def _emit(self, msg, args, extra):
+        record = self.logger.makeRecord(self.logger.name, self.level,
+                                        __file__, 0, msg, args, None,
+                                        extra=extra)
+        with self._lock:
+            self._start()
+        self._handler.handle(record)
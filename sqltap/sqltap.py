@@ -1,38 +1,196 @@
 from __future__ import division
 
 import collections
+import copy
+import csv
 import datetime
+import fnmatch
+import functools
+import gzip
+import heapq
+import html
+import io
+import itertools
+import json
+import math
 import os
+import random
+import re
 import sys
+import threading
 import time
 import traceback
+import weakref
 
 try:
     import queue
 except ImportError:
     import Queue as queue
 
-import mako.exceptions
-import mako.lookup
-import mako.template
 import sqlalchemy.engine
+import sqlalchemy.engine.cursor
 import sqlalchemy.event
-import sqlparse
+import sqlalchemy.sql.util
+
+# mako and sqlparse are imported when a report is generated, so that
+# capturing queries does not pay for loading them
 
 REPORT_HTML = "html"
 REPORT_WSGI = "wsgi"
 REPORT_TEXT = "text"
+REPORT_JSON = "json"
+REPORT_CSV = "csv"
+REPORT_NDJSON = "ndjson"
 
 _py2 = sys.version_info[0] == 2
+_clock = getattr(time, 'perf_counter', time.time)
 
 
 def format_sql(sql):
+    import sqlparse
     try:
         return sqlparse.format(sql, reindent=True)
     except Exception:
         return sql
 
 
+@functools.lru_cache(maxsize=None)
+def _highlight_classes():
+    import sqlparse.tokens
+    return (
+        (sqlparse.tokens.Comment, "hljs-comment"),
+        (sqlparse.tokens.Keyword, "hljs-keyword"),
+        (sqlparse.tokens.Name.Builtin, "hljs-built_in"),
+        (sqlparse.tokens.Literal.String, "hljs-string"),
+        (sqlparse.tokens.Literal.Number, "hljs-number"),
+        (sqlparse.tokens.Name.Placeholder, "hljs-variable"),
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def highlight_sql(sql):
+    """ Return `sql` as HTML, its tokens wrapped in spans with the classes
+    of highlight.js. The result is cached, so that a report highlights
+    the text of a group once, not on each page view. """
+    import sqlparse.lexer
+    parts = []
+    try:
+        tokens = list(sqlparse.lexer.tokenize(sql))
+    except Exception:
+        return html.escape(sql, quote=False)
+    classes = _highlight_classes()
+    for ttype, value in tokens:
+        value = html.escape(value, quote=False)
+        for parent, css_class in classes:
+            if ttype in parent:
+                value = '<span class="%s">%s</span>' % (css_class, value)
+                break
+        parts.append(value)
+    return "".join(parts)
+
+
+def _module_prefixes(modules):
+    """ Turn module names into the prefixes matched by
+    :func:`_module_matches`. """
+    if not modules:
+        return None
+    return tuple(modules) + tuple(m + '.' for m in modules)
+
+
+def _module_matches(name, prefixes):
+    # a prefix matches a module and its submodules, "sqlalchemy" matches
+    # "sqlalchemy.orm" but not "sqlalchemy_utils"
+    return name in prefixes or name.startswith(prefixes)
+
+
+def _greenlet_parents():
+    """ Yield the frames at which the parents of the current greenlet are
+    suspended. The queries of SQLAlchemy's asyncio extension run in a
+    greenlet whose parent is suspended in the coroutine awaiting them. """
+    greenlet = sys.modules.get('greenlet')
+    if greenlet is None:
+        return
+    parent = greenlet.getcurrent().parent
+    while parent is not None:
+        if parent.gr_frame is not None:
+            yield parent.gr_frame
+        parent = parent.parent
+
+
+def extract_stack(frame=None, depth=None, include=None, exclude=None):
+    """ A cheaper :func:`traceback.extract_stack`.
+
+    The stack is walked from `frame` (the caller's frame by default) with
+    :func:`sys._getframe` and the source lines are only read when the stack
+    is formatted. Frames are filtered by the name of their module while
+    walking, and the walk stops as soon as `depth` frames were kept. When
+    run in a greenlet, e.g. by an ``AsyncEngine``, the stack continues in
+    the parent greenlets, up to the coroutines awaiting the query.
+
+    :param frame: The innermost frame of the stack.
+    :param depth: The maximum number of frames to keep, the innermost ones.
+    :param include: If given, only keep frames of these modules and their
+        submodules.
+    :param exclude: Drop frames of these modules and their submodules.
+
+    :return: A list of :class:`traceback.FrameSummary`, outermost frame
+        first, like :func:`traceback.extract_stack`.
+    """
+    if frame is None:
+        frame = sys._getframe(1)
+    include = _module_prefixes(include)
+    exclude = _module_prefixes(exclude)
+
+    stack = []
+    parents = None
+    while frame is not None:
+        keep = True
+        if include or exclude:
+            module = frame.f_globals.get('__name__') or ''
+            if include and not _module_matches(module, include):
+                keep = False
+            elif exclude and _module_matches(module, exclude):
+                keep = False
+        if keep:
+            code = frame.f_code
+            stack.append(traceback.FrameSummary(
+                code.co_filename, frame.f_lineno, code.co_name,
+                lookup_line=False))
+            if depth is not None and len(stack) >= depth:
+                break
+        frame = frame.f_back
+        if frame is None:
+            if parents is None:
+                parents = _greenlet_parents()
+            frame = next(parents, None)
+    stack.reverse()
+    return stack
+
+
+_FINGERPRINT_SUBS = [
+    # comments
+    (re.compile(r"--[^\n]*|/\*.*?\*/", re.S), " "),
+    # string and numeric literals
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"), "?"),
+    # IN lists and VALUES rows of any length
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"),
+    (re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+"), "(?)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """ Return a normalized form of `sql` with its literals, comments and
+    the length of its IN lists removed, so that statements which only
+    differ by the values they were built with share the same fingerprint.
+    """
+    for regex, repl in _FINGERPRINT_SUBS:
+        sql = regex.sub(repl, sql)
+    return sql.strip()
+
+
 class QueryStats(object):
     """ Statistics about a query
 
@@ -48,9 +206,29 @@ class QueryStats(object):
     :param end_time: End time of the query (from py:func:`time.time`)
     :param user_context: The value returned by the user_context_fn set
         with :func:`sqltap.start`.
-    :param params_dict: a dict of the parameters passed to this query
+    :param params_dict: a dict of the parameters passed to this query, or
+        None if they were not captured, in which case :attr:`params_hash`
+        is None too and the query is left out of the analyses comparing
+        parameters (duplicates, cache simulation, parameter sets).
     :param results: :class:`sqlalchemy.engine.ResultProxy`
         generated by the execution of the query
+
+    The statement and parameters handed to the DBAPI driver, after the
+    expansion of the IN lists, are kept as :attr:`executed_statement` and
+    :attr:`executed_params`. The parameters are a tuple for drivers with
+    positional parameters and a dict otherwise, the last set for statements
+    run with several sets, or None when the session does not capture
+    parameters.
+
+    For statements returning rows, the number of rows is not known when the
+    query completes. When the session counts fetches, the following
+    attributes keep growing as the application reads the result:
+
+    - :attr:`rows_fetched`: rows read from the DBAPI cursor, including
+      rows buffered by SQLAlchemy but never handed to the application.
+    - :attr:`rows_returned`: rows handed to the application.
+    - :attr:`bytes_returned`: estimated size of those rows, or None unless
+      the session was created with ``fetch_bytes=True``.
     """
     def __init__(self, text, stack, start_time, end_time,
                  user_context, params_dict, results):
@@ -63,7 +241,24 @@ class QueryStats(object):
         self.duration = end_time - start_time
         self.user_context = user_context
         self.rowcount = results.rowcount
-        self.params_hash = self.calculate_params_hash(self.params)
+        self.returns_rows = getattr(results, 'returns_rows', False)
+        self.rows_fetched = 0
+        self.rows_returned = 0
+        self.bytes_returned = None
+        self.params_hash = (self.calculate_params_hash(self.params)
+                            if self.params is not None else None)
+        self.executed_statement = None
+        self.executed_params = None
+        # the TransactionInfo this query ran in, if tracked
+        self.transaction = None
+
+    @property
+    def rows(self):
+        """ The rows returned for queries returning rows, the affected row
+        count otherwise. """
+        if self.returns_rows:
+            return self.rows_returned
+        return max(self.rowcount, 0)
 
     @classmethod
     def calculate_params_hash(cls, params):
@@ -76,10 +271,822 @@ class QueryStats(object):
         return (h ^ (h >> 32)) & ((1 << 32) - 1)  # convert to 32-bit unsigned
 
     def __repr__(self):
+        params_hash = ('%08x' % self.params_hash
+                       if self.params_hash is not None else None)
         return ("<%s text='%s...' params=%r "
-                "duration=%.3f rowcount=%d params_hash=%08x>" % (
+                "duration=%.3f rowcount=%d params_hash=%s>" % (
                     self.__class__.__name__, str(self.text)[:40], self.params,
-                    self.duration, self.rowcount, self.params_hash))
+                    self.duration, self.rowcount, params_hash))
+
+
+def _estimate_size(rows):
+    size = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (bytes, bytearray, str)):
+                size += len(value)
+            else:
+                size += 8
+    return size
+
+
+class _CountingCursor(object):
+    """ Proxy of a DBAPI cursor counting the rows fetched through it """
+
+    def __init__(self, cursor, qstats):
+        self._cursor = cursor
+        self._qstats = qstats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._qstats.rows_fetched += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._qstats.rows_fetched += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._qstats.rows_fetched += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _FetchCounter(object):
+    """ Wrapper of the fetch strategy of a result, which counts the rows
+    handed to the application and, through a :class:`_CountingCursor`, the
+    rows read from the DBAPI cursor.
+    """
+
+    def __init__(self, strategy, qstats, fetch_bytes):
+        self._strategy = strategy
+        self._qstats = qstats
+        self._fetch_bytes = fetch_bytes
+        # rows the strategy buffered before we got to wrap it
+        qstats.rows_fetched += len(getattr(strategy, '_rowbuffer', ()))
+
+    @classmethod
+    def install(cls, results, qstats, fetch_bytes=False):
+        strategy = getattr(results, 'cursor_strategy', None)
+        if strategy is None or isinstance(
+                strategy, sqlalchemy.engine.cursor.NoCursorFetchStrategy):
+            return
+        if fetch_bytes and qstats.bytes_returned is None:
+            qstats.bytes_returned = 0
+        results.cursor_strategy = cls(strategy, qstats, fetch_bytes)
+
+    def _returned(self, rows):
+        self._qstats.rows_returned += len(rows)
+        if self._fetch_bytes:
+            self._qstats.bytes_returned += _estimate_size(rows)
+
+    def _cursor(self, dbapi_cursor):
+        return _CountingCursor(dbapi_cursor, self._qstats)
+
+    def fetchone(self, result, dbapi_cursor, hard_close=False):
+        row = self._strategy.fetchone(result, self._cursor(dbapi_cursor),
+                                      hard_close)
+        if row is not None:
+            self._returned((row,))
+        return row
+
+    def fetchmany(self, result, dbapi_cursor, size=None):
+        rows = self._strategy.fetchmany(result, self._cursor(dbapi_cursor),
+                                        size)
+        if rows:
+            self._returned(rows)
+        return rows
+
+    def fetchall(self, result, dbapi_cursor):
+        rows = self._strategy.fetchall(result, self._cursor(dbapi_cursor))
+        if rows:
+            self._returned(rows)
+        return rows
+
+    def yield_per(self, result, dbapi_cursor, num):
+        # this replaces the strategy of the result with a buffered one
+        self._strategy.yield_per(result, self._cursor(dbapi_cursor), num)
+        if result.cursor_strategy is not self:
+            self.install(result, self._qstats, self._fetch_bytes)
+
+    def __getattr__(self, name):
+        return getattr(self._strategy, name)
+
+
+class TransactionInfo(object):
+    """ A database transaction observed by a :class:`ProfilingSession`
+    created with ``track_transactions=True``.
+
+    The queries run inside the transaction reference it through their
+    :attr:`QueryStats.transaction` attribute.
+
+    :param start_time: Begin time of the transaction
+        (from py:func:`time.time`)
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, start_time):
+        self.id = next(self._ids)
+        self.start_time = start_time
+        self.end_time = None
+        # "commit" or "rollback" once the transaction has ended
+        self.outcome = None
+
+    def end(self, outcome):
+        self.end_time = time.time()
+        self.outcome = outcome
+
+    def __repr__(self):
+        return "<%s id=%d outcome=%s>" % (
+            self.__class__.__name__, self.id, self.outcome)
+
+
+class TransactionStats(object):
+    """ Statistics about the queries of a single transaction, as computed by
+    :func:`analyze_transactions`.
+
+    - :attr:`duration`: time from begin to commit or rollback, or to the
+      end of the last query if the transaction had not ended.
+    - :attr:`query_time`: time spent executing queries.
+    - :attr:`idle_time`: time spent idle in transaction, that is
+      :attr:`duration` minus :attr:`query_time`.
+    - :attr:`max_gap`: the longest idle gap between begin, the queries and
+      the end of the transaction.
+    - :attr:`caller`: the user frame which issued the first query.
+    """
+
+    def __init__(self, transaction, queries):
+        self.transaction = transaction
+        self.queries = queries
+        end_time = transaction.end_time
+        if end_time is None:
+            end_time = max(q.end_time for q in queries)
+        self.duration = end_time - transaction.start_time
+        self.query_time = sum(q.duration for q in queries)
+        self.idle_time = max(self.duration - self.query_time, 0)
+
+        self.max_gap = 0
+        last = transaction.start_time
+        for q in queries:
+            self.max_gap = max(self.max_gap, q.start_time - last)
+            last = max(last, q.end_time)
+        self.max_gap = max(self.max_gap, end_time - last)
+        self.caller = QueryGroup.find_user_fn(queries[0].stack)
+
+    @property
+    def query_count(self):
+        return len(self.queries)
+
+
+def analyze_transactions(stats, threshold=0):
+    """ Group the queries of `stats` by the transaction they ran in.
+
+    :param stats: An iterable of :class:`QueryStats` objects collected by
+        a session created with ``track_transactions=True``.
+
+    :param threshold: Only return transactions lasting at least this many
+        seconds.
+
+    :return: A tuple ``(transactions, by_caller)``. `transactions` is a
+        list of :class:`TransactionStats` ordered from the longest
+        transaction. `by_caller` is a list of ``(caller, transactions)``
+        tuples grouping those transactions by the user frame which started
+        them, ordered by decreasing total duration.
+    """
+    queries = collections.OrderedDict()
+    for q in stats:
+        if q.transaction is not None:
+            queries.setdefault(q.transaction, []).append(q)
+
+    transactions = [TransactionStats(t, qs) for t, qs in queries.items()]
+    transactions = [t for t in transactions if t.duration >= threshold]
+    transactions.sort(key=lambda t: t.duration, reverse=True)
+
+    by_caller = collections.OrderedDict()
+    for t in transactions:
+        caller = tuple(t.caller[:3]) if t.caller is not None else None
+        by_caller.setdefault(caller, []).append(t)
+    by_caller = sorted(by_caller.items(),
+                       key=lambda item: sum(t.duration for t in item[1]),
+                       reverse=True)
+    return transactions, by_caller
+
+
+class DuplicateQuery(object):
+    """ A statement executed more than once with the same parameters within
+    the same unit of work, as found by :func:`find_duplicates`.
+
+    :param scope: The unit of work, i.e. the user context or the
+        :class:`TransactionInfo` the queries ran in.
+    :param queries: The identical :class:`QueryStats`, in execution order.
+    """
+
+    def __init__(self, scope, queries):
+        self.scope = scope
+        self.queries = queries
+        self.text = str(queries[0].text)
+        self.params = queries[0].params
+        self.count = len(queries)
+        # only the first execution was needed
+        self.wasted_time = sum(q.duration for q in queries[1:])
+        callers = collections.OrderedDict()
+        for q in queries:
+            caller = QueryGroup.find_user_fn(q.stack)
+            if caller is not None:
+                callers[tuple(caller[:3])] = None
+        self.callers = list(callers)
+
+    def __repr__(self):
+        return "<%s text='%s...' count=%d wasted_time=%.3f>" % (
+            self.__class__.__name__, self.text[:40], self.count,
+            self.wasted_time)
+
+
+_DUPLICATES_SCOPES = {
+    "context": lambda q: q.user_context,
+    "transaction": lambda q: q.transaction,
+}
+
+
+def find_duplicates(stats, scope="context"):
+    """ Find the statements executed several times with the same parameters
+    within the same unit of work. These are missed caching opportunities.
+    Queries whose parameters were not captured are ignored.
+
+    :param stats: An iterable of :class:`QueryStats` objects.
+
+    :param scope: What a unit of work is: ``"context"`` for queries with
+        equal :attr:`QueryStats.user_context`, ``"transaction"`` for
+        queries run in the same transaction (see `track_transactions` of
+        :class:`ProfilingSession`), or a function returning the scope of a
+        :class:`QueryStats`. Queries whose scope is None are ignored.
+
+    :return: A list of :class:`DuplicateQuery` ordered by decreasing
+        wasted time.
+    """
+    if callable(scope):
+        scope_fn = scope
+    elif scope in _DUPLICATES_SCOPES:
+        scope_fn = _DUPLICATES_SCOPES[scope]
+    else:
+        raise ValueError("Unknown duplicates scope: %r" % (scope,))
+
+    executions = collections.OrderedDict()
+    scopes = {}
+    for q in stats:
+        unit = scope_fn(q)
+        if unit is None or q.params_hash is None:
+            continue
+        try:
+            hash(unit)
+            unit_key = (True, unit)
+        except TypeError:
+            # unhashable contexts, e.g. dicts, are compared by identity
+            unit_key = (False, id(unit))
+        key = (unit_key, str(q.text), q.params_hash)
+        executions.setdefault(key, []).append(q)
+        scopes[key] = unit
+
+    duplicates = [DuplicateQuery(scopes[key], queries)
+                  for key, queries in executions.items() if len(queries) > 1]
+    duplicates.sort(key=lambda d: d.wasted_time, reverse=True)
+    return duplicates
+
+
+def _find_tables(clause, text):
+    """ The lower case names of the tables used by the statement `clause`.
+    For textual statements, this is every word of `text`, a function
+    returning the text of the statement. """
+    tables = set()
+    if isinstance(clause, sqlalchemy.sql.ClauseElement):
+        for table in sqlalchemy.sql.util.find_tables(
+                clause, include_aliases=True, include_joins=True,
+                include_crud=True):
+            if isinstance(table, sqlalchemy.Table):
+                tables.add(table.name.lower())
+                tables.add(table.fullname.lower())
+    if not tables:
+        tables.update(re.findall(r'\w+', str(text()).lower()))
+    return tables
+
+
+class CacheSimulation(object):
+    """ The outcome of replaying queries through a simulated application
+    cache, see :func:`simulate_cache`.
+
+    :param size: The number of entries of the LRU cache.
+    :param ttl: The number of seconds entries stay valid, or None.
+    """
+
+    class Group(object):
+        """ The lookups of the queries sharing a fingerprint """
+
+        def __init__(self, fingerprint, text):
+            self.fingerprint = fingerprint
+            self.text = text
+            self.lookups = 0
+            self.hits = 0
+            #: the time of the queries answered by the cache
+            self.saved_time = 0.0
+
+        @property
+        def hit_rate(self):
+            return self.hits / self.lookups if self.lookups else 0.0
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.lookups = 0
+        self.hits = 0
+        self.saved_time = 0.0
+        #: entries dropped because a statement wrote to their tables
+        self.invalidations = 0
+        #: :class:`CacheSimulation.Group` keyed by fingerprint
+        self.groups = {}
+        # key -> (time stored, tables), least recently used first
+        self._entries = collections.OrderedDict()
+        self._by_table = collections.defaultdict(set)
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def top_groups(self, n=None):
+        """ The groups by decreasing saved time """
+        groups = sorted(self.groups.values(), key=lambda g: g.saved_time,
+                        reverse=True)
+        return groups[:n]
+
+    def read(self, key, group, q, tables):
+        self.lookups += 1
+        group.lookups += 1
+        entry = self._entries.get(key)
+        if entry is not None:
+            if self.ttl is None or q.start_time - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                group.hits += 1
+                self.saved_time += q.duration
+                group.saved_time += q.duration
+                return
+            self._remove(key)
+        self._entries[key] = (q.end_time, tables)
+        for table in tables:
+            self._by_table[table].add(key)
+        if len(self._entries) > self.size:
+            self._remove(next(iter(self._entries)))
+
+    def write(self, tables):
+        for table in tables:
+            for key in list(self._by_table.get(table, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def _remove(self, key):
+        stored, tables = self._entries.pop(key)
+        for table in tables:
+            keys = self._by_table[table]
+            keys.discard(key)
+            if not keys:
+                del self._by_table[table]
+
+    def __repr__(self):
+        return "<%s size=%d ttl=%r hit_rate=%.2f saved_time=%.3f>" % (
+            self.__class__.__name__, self.size, self.ttl, self.hit_rate,
+            self.saved_time)
+
+
+#: The (size, ttl) of the caches simulated by default
+DEFAULT_CACHE_CONFIGS = ((100, None), (1000, None), (1000, 60.0))
+
+
+def simulate_cache(stats, configs=DEFAULT_CACHE_CONFIGS):
+    """ Replay queries through simulated application caches, to find the
+    read queries worth caching.
+
+    The SELECT statements are looked up, in execution order, in LRU caches
+    keyed by their exact text and :attr:`QueryStats.params_hash`. A hit
+    saves the duration of the query. The lookups are summed up per
+    :func:`fingerprint`. Read queries whose parameters were not captured
+    are left out. The other statements invalidate
+    the cached results of the tables they use.
+
+    :param stats: An iterable of :class:`QueryStats` objects.
+    :param configs: The ``(size, ttl)`` of each cache to simulate, the
+        `ttl` in seconds or None.
+
+    :return: A list of :class:`CacheSimulation`, one per config.
+    """
+    simulations = [CacheSimulation(size, ttl) for size, ttl in configs]
+    statements = {}
+    for q in sorted(stats, key=lambda q: q.start_time):
+        text = str(q.text)
+        statement = statements.get(text)
+        if statement is None:
+            clause = getattr(q.text, 'statement', None)
+            words = text.split(None, 1)
+            is_select = getattr(clause, 'is_select', False) is True
+            if not is_select and words:
+                is_select = words[0].upper() == 'SELECT'
+            statement = statements[text] = (
+                fingerprint(text), is_select,
+                frozenset(_find_tables(clause, lambda: text)))
+        group_key, is_select, tables = statement
+        for simulation in simulations:
+            if not is_select:
+                simulation.write(tables)
+                continue
+            if q.params_hash is None:
+                continue
+            group = simulation.groups.get(group_key)
+            if group is None:
+                group = simulation.groups[group_key] = CacheSimulation.Group(
+                    group_key, text)
+            # statements with different literals share a fingerprint,
+            # not their results
+            simulation.read((text, q.params_hash), group, q, tables)
+    return simulations
+
+
+class PoolStats(object):
+    """ Statistics about the connection pool of the profiled engines.
+
+    A :class:`ProfilingSession` created with ``pool_events=True`` fills one
+    of these in as connections are created, checked out, checked in and
+    invalidated. It is available as :attr:`ProfilingSession.pool_stats` and
+    may be passed to :func:`sqltap.report` with the `pool_stats` argument.
+
+    Durations are summarized as :class:`PoolStats.Timing` objects:
+
+    - :attr:`checkout_wait`: time spent waiting for the pool to hand out a
+      connection, including the time to open new connections. This is
+      only measured when profiling a specific engine instance.
+    - :attr:`hold`: time between checkout and checkin of a connection.
+    - :attr:`hold_by_context`: the hold times, keyed by the value returned
+      by the session's `pool_context_fn` at checkout.
+    """
+
+    class Timing(object):
+        """ Count, total, mean and max of a set of durations """
+
+        def __init__(self):
+            self.count = 0
+            self.sum = 0
+            self.max = 0
+            self.mean = 0
+
+        def add(self, duration):
+            self.count += 1
+            self.sum += duration
+            self.max = max(self.max, duration)
+            self.mean = self.sum / self.count
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Reset all the statistics """
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.checkout_wait = PoolStats.Timing()
+            self.hold = PoolStats.Timing()
+            self.hold_by_context = collections.defaultdict(PoolStats.Timing)
+
+    def add_checkout_wait(self, duration):
+        with self._lock:
+            self.checkout_wait.add(duration)
+
+    def add_hold(self, context, duration):
+        with self._lock:
+            self.checkins += 1
+            self.hold.add(duration)
+            self.hold_by_context[context].add(duration)
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+def _wrap_pool_connect(pool, pool_stats):
+    """ Time `pool.connect` calls into `pool_stats`. The wrapper is shared
+    by all sessions measuring the same pool. """
+    sinks = pool.__dict__.get('_sqltap_pool_stats')
+    if sinks is None:
+        sinks = pool._sqltap_pool_stats = []
+        connect = pool.connect
+
+        def timed_connect():
+            start_time = time.time()
+            try:
+                return connect()
+            finally:
+                duration = time.time() - start_time
+                for sink in list(sinks):
+                    sink.add_checkout_wait(duration)
+
+        pool.connect = timed_connect
+    sinks.append(pool_stats)
+
+
+def _unwrap_pool_connect(pool, pool_stats):
+    sinks = pool.__dict__.get('_sqltap_pool_stats')
+    if sinks is None:
+        return
+    sinks.remove(pool_stats)
+    if not sinks:
+        del pool.connect
+        del pool._sqltap_pool_stats
+
+
+class _Execution(object):
+    """ The raw data of one query execution. It is captured once per engine
+    and handed to every started session, the costly parts (compiled text,
+    parameters, stacks) being computed on first use and shared. """
+
+    def __init__(self, conn, clause, multiparams, params, results, frame):
+        self.end_time = time.time()
+        self.start_time = getattr(conn, '_sqltap_query_start_time',
+                                  self.end_time)
+        self.duration = self.end_time - self.start_time
+        self.conn = conn
+        self.clause = clause
+        self.multiparams = multiparams
+        self.params = params
+        self.results = results
+        self.frame = frame
+        self._text = None
+        self._executed = None
+        self._first_word = None
+        self._tables = None
+        self._stacks = {}
+        self._qstats = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            try:
+                self._text = self.clause.compile(
+                    dialect=self.conn.engine.dialect)
+            except AttributeError:
+                self._text = self.clause
+        return self._text
+
+    @property
+    def executed(self):
+        """ The ``(statement, parameters)`` handed to the DBAPI driver """
+        if self._executed is None:
+            context = self.results.context
+            parameters = getattr(context, 'parameters', None) or [None]
+            params = parameters[-1]
+            if isinstance(params, dict):
+                params = dict(params)
+            elif params is not None:
+                params = tuple(params)
+            self._executed = (context.statement, params)
+        return self._executed
+
+    @property
+    def first_word(self):
+        """ The statement type, in upper case """
+        if self._first_word is None:
+            clause = self.clause
+            for attr, word in (('is_select', 'SELECT'),
+                               ('is_insert', 'INSERT'),
+                               ('is_update', 'UPDATE'),
+                               ('is_delete', 'DELETE')):
+                if getattr(clause, attr, False) is True:
+                    self._first_word = word
+                    break
+            else:
+                # textual statements and DDL
+                text = clause if isinstance(clause, str) else getattr(
+                    clause, 'text', None)
+                if not isinstance(text, str):
+                    text = str(self.text)
+                words = text.split(None, 1)
+                self._first_word = words[0].upper() if words else ''
+        return self._first_word
+
+    @property
+    def tables(self):
+        """ The lower case names of the tables used by the statement. For
+        textual statements, this is every word of the statement. """
+        if self._tables is None:
+            self._tables = _find_tables(self.clause, lambda: self.text)
+        return self._tables
+
+    @property
+    def url(self):
+        """ The URL of the engine, without password """
+        return self.conn.engine.url.render_as_string(hide_password=True)
+
+    def called_from(self, prefixes):
+        """ True if a frame of the stack belongs to one of the modules of
+        `prefixes`, see :func:`_module_prefixes`. """
+        frame = self.frame
+        parents = None
+        while frame is not None:
+            if _module_matches(frame.f_globals.get('__name__') or '',
+                               prefixes):
+                return True
+            frame = frame.f_back
+            if frame is None:
+                if parents is None:
+                    parents = _greenlet_parents()
+                frame = next(parents, None)
+        return False
+
+    def stack(self, depth=None, include=None, exclude=None):
+        key = (depth, tuple(include or ()), tuple(exclude or ()))
+        stack = self._stacks.get(key)
+        if stack is None:
+            stack = self._stacks[key] = extract_stack(
+                self.frame, depth, include, exclude)
+        return stack
+
+    def query_stats(self, stack, user_context, params=True):
+        """ Return a new :class:`QueryStats` of this execution. Sessions
+        get their own objects, which share the text and parameters.
+
+        :param params: If False, the parameters are not extracted.
+        """
+        if not params:
+            qstats = QueryStats(self.text, stack, self.start_time,
+                                self.end_time, user_context, None,
+                                self.results)
+            qstats.executed_statement = self.executed[0]
+            return qstats
+        if self._qstats is None:
+            params_dict = {}
+            for p in getattr(self.results.context, 'compiled_parameters', []):
+                params_dict.update(p)
+            self._qstats = QueryStats(self.text, stack, self.start_time,
+                                      self.end_time, user_context,
+                                      params_dict, self.results)
+            (self._qstats.executed_statement,
+             self._qstats.executed_params) = self.executed
+            return self._qstats
+        qstats = copy.copy(self._qstats)
+        qstats.stack = qstats.stack_text = stack
+        qstats.user_context = user_context
+        qstats.transaction = None
+        # the fetches are counted by the _FetchCounter of each session
+        qstats.rows_fetched = 0
+        qstats.rows_returned = 0
+        qstats.bytes_returned = None
+        return qstats
+
+
+class _Dispatcher(object):
+    """ Listens to the execution events of an engine (or of the Engine
+    class) on behalf of all the sessions started on it.
+
+    The listeners are registered with the first session and stay in place,
+    so starting and stopping a session only updates :attr:`sessions`, a
+    tuple replaced as a whole under a lock and read without one. While no
+    session is started, each query costs a single test.
+    """
+
+    _lock = threading.Lock()
+    _dispatchers = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def get(cls, target):
+        with cls._lock:
+            dispatcher = cls._dispatchers.get(target)
+            if dispatcher is None:
+                dispatcher = cls._dispatchers[target] = cls(target)
+            return dispatcher
+
+    def __init__(self, target):
+        self.sessions = ()
+        sqlalchemy.event.listen(target, "before_execute", self._before_exec)
+        sqlalchemy.event.listen(target, "after_execute", self._after_exec)
+
+    def add(self, session):
+        with self._lock:
+            self.sessions += (session,)
+
+    def remove(self, session):
+        with self._lock:
+            self.sessions = tuple(s for s in self.sessions if s is not session)
+
+    def _before_exec(self, conn, clause, multiparams, params,
+                     execution_options):
+        """ SQLAlchemy event hook """
+        if self.sessions:
+            conn._sqltap_query_start_time = time.time()
+
+    def _after_exec(self, conn, clause, multiparams, params,
+                    execution_options, results):
+        """ SQLAlchemy event hook """
+        sessions = self.sessions
+        if not sessions or execution_options.get('sqltap_ignore'):
+            return
+        execution = _Execution(conn, clause, multiparams, params, results,
+                               sys._getframe(1))
+        for session in sessions:
+            session._record(execution)
+
+
+class OverheadGovernor(object):
+    """ Keeps the overhead of a :class:`ProfilingSession`, the time spent
+    recording queries relative to the time of the queries, within a
+    budget, by adapting what the session captures.
+
+    Every `interval` seconds the overhead of the last interval is compared
+    to the budget. Above it, the governor moves to the next of its
+    :attr:`LEVELS`, which capture less: only the calling frame instead of
+    the whole stack, then no parameters either, then one query out of 2,
+    4, ... 64. Below a quarter of the budget, it moves back one level.
+    Queries are still counted in :attr:`ProfilingSession.query_count`
+    when they are not captured.
+
+    Example usage::
+
+        profiler = sqltap.start(governor=sqltap.OverheadGovernor(0.01))
+
+    :param budget: The maximum overhead, as a fraction of the query time.
+    :param interval: The number of seconds between two adjustments.
+    """
+
+    #: (sample one query out of, whole stack, parameters, description)
+    LEVELS = (
+        (1, True, True, "full"),
+        (1, False, True, "calling frame only"),
+        (1, False, False, "calling frame only, no parameters"),
+    ) + tuple((n, False, False, "1/%d of the queries" % n)
+              for n in (2, 4, 8, 16, 32, 64))
+
+    # the frames skipped to find the calling frame
+    CALLER_EXCLUDE = ("sqlalchemy", __name__)
+
+    def __init__(self, budget=0.01, interval=1.0):
+        self.budget = budget
+        self.interval = interval
+        self.level = 0
+        #: the overhead of the last complete interval
+        self.overhead = 0.0
+        #: number of queries not captured because of sampling
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._window_start = None
+        self._window_overhead = 0.0
+        self._window_time = 0.0
+
+    @property
+    def description(self):
+        return self.LEVELS[self.level][3]
+
+    @property
+    def capture_stack(self):
+        return self.LEVELS[self.level][1]
+
+    @property
+    def capture_params(self):
+        return self.LEVELS[self.level][2]
+
+    def sample(self):
+        """ Return True if the next query should be captured """
+        every = self.LEVELS[self.level][0]
+        if every == 1:
+            return True
+        self._counter += 1
+        if self._counter % every:
+            self.skipped += 1
+            return False
+        return True
+
+    def add(self, query_time, overhead_time, now):
+        """ Account for a query lasting `query_time` and recorded in
+        `overhead_time` seconds, adjusting the level once per interval. """
+        with self._lock:
+            if self._window_start is None:
+                self._window_start = now
+            self._window_time += query_time
+            self._window_overhead += overhead_time
+            if now - self._window_start < self.interval:
+                return
+            overhead = (self._window_overhead / self._window_time
+                        if self._window_time else 0.0)
+            self.overhead = overhead
+            if overhead > self.budget:
+                self.level = min(self.level + 1, len(self.LEVELS) - 1)
+            elif overhead < self.budget / 4:
+                self.level = max(self.level - 1, 0)
+            self._window_start = now
+            self._window_time = self._window_overhead = 0.0
 
 
 class ProfilingSession(object):
@@ -105,8 +1112,13 @@ class ProfilingSession(object):
     results continually, you may do so by passing your own collection
     function to the session's constructor.
 
+    The sessions started on the same engine share a single pair of
+    SQLAlchemy listeners: each query is compiled, and its stack captured,
+    once for all of them.
+
     You may start, stop, and restart a profiling session as much as you
-    like. Calling start on an already started session or stop on an
+    like, from any thread; this is cheap once the engine's listeners are
+    in place. Calling start on an already started session or stop on an
     already stopped session will raise an :class:`AssertionError`.
 
     You may use a profiling session object like a context manager. This
@@ -135,12 +1147,18 @@ class ProfilingSession(object):
     """
 
     def __init__(self, engine=sqlalchemy.engine.Engine, user_context_fn=None,
-                 collect_fn=None):
+                 collect_fn=None, pool_events=False, pool_context_fn=None,
+                 track_transactions=False, count_fetches=True,
+                 fetch_bytes=False, stack_depth=None, stack_include=None,
+                 stack_exclude=None, count_only=False, statement_types=None,
+                 tables=None, urls=None, min_duration=None,
+                 context_filter=None, caller_modules=None, governor=None):
         """ Create a new :class:`ProfilingSession` object
 
         :param engine: The sqlalchemy engine on which you want to
             profile queries. The default is sqlalchemy.engine.Engine
-            which will profile queries across all engines.
+            which will profile queries across all engines. An
+            ``AsyncEngine`` is resolved to its ``sync_engine``.
 
         :param user_context_fn: A function which returns a value to be stored
             with the query statistics. The function takes the same parameters
@@ -151,10 +1169,108 @@ class ProfilingSession(object):
             argument. If specified, the :class:`ProfilingSession` will not
             save queries in an internal queue and will instead pass them
             to this function immediately.
+
+        :param pool_events: If True, also listen to the connection pool
+            events of the engine and record them in :attr:`pool_stats`.
+
+        :param pool_context_fn: A function without arguments called when a
+            connection is checked out. The connection hold times are
+            reported per returned value, e.g. per request.
+
+        :param track_transactions: If True, listen to the begin, commit and
+            rollback events of connections and attach a
+            :class:`TransactionInfo` to the queries run in a transaction.
+
+        :param count_fetches: If True, count the rows fetched from the
+            results of the queries returning rows, see :class:`QueryStats`.
+
+        :param fetch_bytes: If True, also estimate the size of the fetched
+            rows.
+
+        :param stack_depth: The maximum number of frames of the stack
+            captured with each query, the closest to the query being kept.
+            The whole stack is captured by default.
+
+        :param stack_include: A list of module names. If given, only the
+            frames of these modules and their submodules are captured.
+
+        :param stack_exclude: A list of module names whose frames, and the
+            frames of their submodules, are not captured, for example
+            ``["sqlalchemy", "werkzeug"]``.
+
+        :param count_only: If True, only maintain :attr:`query_count` and
+            :attr:`query_time`. No :class:`QueryStats` is built, so this
+            mode is much cheaper, but `collect_fn` is never called.
+
+        The following filters restrict the queries captured by the session.
+        They are evaluated, cheapest first, before the stack is captured
+        and the :class:`QueryStats` built, so that the queries which are
+        filtered out cost little. Queries filtered out are not counted
+        either.
+
+        :param statement_types: Only capture these types of statements,
+            e.g. ``["SELECT"]``. The type is the first word of the
+            statement, as in :attr:`QueryGroup.first_word`.
+
+        :param tables: Only capture statements using one of these tables.
+
+        :param urls: Only capture queries run on engines whose URL, without
+            password, matches one of these :mod:`fnmatch` patterns, e.g.
+            ``["postgresql://*@replica/*"]``. Mostly useful when profiling
+            all engines.
+
+        :param min_duration: Only capture queries lasting at least this
+            many seconds.
+
+        :param context_filter: A function called with the value returned by
+            `user_context_fn`; the query is captured if it returns True.
+
+        :param caller_modules: Only capture queries issued from these
+            modules or their submodules, i.e. with a frame of one of them
+            in their stack, e.g. ``["myapp.views.search"]``.
+
+        :param governor: An :class:`OverheadGovernor` adapting what the
+            session captures to stay within an overhead budget, or the
+            budget itself, e.g. 0.01 for 1% of the query time. The
+            overhead is measured, see :attr:`overhead`, in any case.
         """
         self.started = False
+        if not isinstance(engine, type):
+            # AsyncEngine
+            engine = getattr(engine, 'sync_engine', engine)
         self.engine = engine
         self.user_context_fn = user_context_fn
+        self.pool_context_fn = pool_context_fn
+        self.pool_stats = PoolStats() if pool_events else None
+        self._pool_info_key = 'sqltap_checkout_%x' % id(self)
+        self.track_transactions = track_transactions
+        self._transaction_attr = '_sqltap_transaction_%x' % id(self)
+        self.count_fetches = count_fetches
+        self.fetch_bytes = fetch_bytes
+        self.stack_depth = stack_depth
+        self.stack_include = stack_include
+        self.stack_exclude = stack_exclude
+        self.count_only = count_only
+        self.statement_types = (frozenset(t.upper() for t in statement_types)
+                                if statement_types else None)
+        self.tables = (frozenset(t.lower() for t in tables)
+                       if tables else None)
+        self.urls = tuple(urls) if urls else None
+        self.min_duration = min_duration
+        self.context_filter = context_filter
+        self.caller_modules = _module_prefixes(caller_modules)
+        if governor is not None and not isinstance(governor,
+                                                   OverheadGovernor):
+            governor = OverheadGovernor(governor)
+        self.governor = governor
+        # time spent recording queries, and time of the queries seen
+        self.overhead_time = 0.0
+        self.observed_time = 0.0
+        # number and total duration of the queries seen while started
+        self.query_count = 0
+        self.query_time = 0.0
+        self._count_lock = threading.Lock()
+        self._state_lock = threading.Lock()
 
         if collect_fn:
             # the user said they want to do their own collecting
@@ -171,33 +1287,161 @@ class ProfilingSession(object):
 
     def _after_exec(self, conn, clause, multiparams, params, execution_options, results):
         """ SQLAlchemy event hook """
-        # calculate the query time
-        end_time = time.time()
-        start_time = getattr(conn, '_sqltap_query_start_time', end_time)
-
-        # get the user's context
-        context = (None if not self.user_context_fn
-                   else self.user_context_fn(
-                        conn, clause, multiparams, params, results))
-
-        try:
-            text = clause.compile(dialect=conn.engine.dialect)
-        except AttributeError:
-            text = clause
+        if execution_options.get('sqltap_ignore'):
+            return
+        self._record(_Execution(conn, clause, multiparams, params, results,
+                                sys._getframe(1)))
+
+    def _accept(self, execution):
+        """ Evaluate the filters of the session, except `context_filter` """
+        if self.min_duration is not None:
+            if execution.duration < self.min_duration:
+                return False
+        if self.statement_types is not None:
+            if execution.first_word not in self.statement_types:
+                return False
+        if self.urls is not None:
+            url = execution.url
+            if not any(fnmatch.fnmatchcase(url, p) for p in self.urls):
+                return False
+        if self.tables is not None:
+            if self.tables.isdisjoint(execution.tables):
+                return False
+        if self.caller_modules is not None:
+            if not execution.called_from(self.caller_modules):
+                return False
+        return True
+
+    @property
+    def overhead(self):
+        """ The time spent recording queries, as a fraction of the time of
+        the queries seen by the session. """
+        if not self.observed_time:
+            return 0.0
+        return self.overhead_time / self.observed_time
+
+    def _record(self, execution):
+        """ Record an :class:`_Execution` of a query, measuring the time
+        spent doing so. """
+        start = _clock()
+        counted = self._capture(execution)
+        overhead = _clock() - start
+        with self._count_lock:
+            self.overhead_time += overhead
+            self.observed_time += execution.duration
+            if counted:
+                self.query_count += 1
+                self.query_time += execution.duration
+        if self.governor is not None:
+            self.governor.add(execution.duration, overhead,
+                              execution.end_time)
+
+    def _user_context(self, execution):
+        if self.user_context_fn is None:
+            return None
+        return self.user_context_fn(
+            execution.conn, execution.clause, execution.multiparams,
+            execution.params, execution.results)
+
+    def _capture(self, execution):
+        """ Capture an :class:`_Execution` of a query.
+
+        :return: False if the query was filtered out.
+        """
+        if not self._accept(execution):
+            return False
+
+        context = None
+        if self.context_filter is not None:
+            context = self._user_context(execution)
+            if not self.context_filter(context):
+                return False
+
+        if self.count_only:
+            return True
+
+        stack_depth = self.stack_depth
+        stack_exclude = self.stack_exclude
+        capture_params = True
+        governor = self.governor
+        if governor is not None:
+            if not governor.sample():
+                return True
+            if not governor.capture_stack:
+                stack_depth = 1
+                stack_exclude = governor.CALLER_EXCLUDE
+            capture_params = governor.capture_params
+
+        if self.context_filter is None:
+            context = self._user_context(execution)
+
+        stack = execution.stack(stack_depth, self.stack_include,
+                                stack_exclude)
+        qstats = execution.query_stats(stack, context, capture_params)
+        if self.track_transactions:
+            transaction = getattr(execution.conn, self._transaction_attr,
+                                  None)
+            if transaction is not None and transaction.outcome is None:
+                qstats.transaction = transaction
+        if self.count_fetches and qstats.returns_rows:
+            _FetchCounter.install(execution.results, qstats,
+                                  self.fetch_bytes)
 
-        params_dict = self._extract_parameters_from_results(results)
+        self.collect_fn(qstats)
+        return True
 
-        stack = traceback.extract_stack()[:-1]
-        qstats = QueryStats(text, stack, start_time, end_time,
-                            context, params_dict, results)
+    def _begin(self, conn):
+        """ SQLAlchemy event hook """
+        setattr(conn, self._transaction_attr, TransactionInfo(time.time()))
 
-        self.collect_fn(qstats)
+    def _commit(self, conn):
+        """ SQLAlchemy event hook """
+        self._end_transaction(conn, "commit")
 
-    def _extract_parameters_from_results(self, query_results):
-        params_dict = {}
-        for p in getattr(query_results.context, 'compiled_parameters', []):
-            params_dict.update(p)
-        return params_dict
+    def _rollback(self, conn):
+        """ SQLAlchemy event hook """
+        self._end_transaction(conn, "rollback")
+
+    def _end_transaction(self, conn, outcome):
+        transaction = getattr(conn, self._transaction_attr, None)
+        if transaction is not None and transaction.outcome is None:
+            transaction.end(outcome)
+
+    def _transaction_listeners(self):
+        return (("begin", self._begin),
+                ("commit", self._commit),
+                ("rollback", self._rollback))
+
+    def _pool_connect(self, dbapi_connection, connection_record):
+        """ SQLAlchemy pool event hook """
+        self.pool_stats.increment('connects')
+
+    def _pool_checkout(self, dbapi_connection, connection_record,
+                       connection_proxy):
+        """ SQLAlchemy pool event hook """
+        self.pool_stats.increment('checkouts')
+        context = self.pool_context_fn() if self.pool_context_fn else None
+        connection_record.info[self._pool_info_key] = (time.time(), context)
+
+    def _pool_checkin(self, dbapi_connection, connection_record):
+        """ SQLAlchemy pool event hook """
+        if connection_record is None:
+            return
+        checkout = connection_record.info.pop(self._pool_info_key, None)
+        if checkout is not None:
+            checkout_time, context = checkout
+            self.pool_stats.add_hold(context, time.time() - checkout_time)
+
+    def _pool_invalidate(self, dbapi_connection, connection_record,
+                         exception):
+        """ SQLAlchemy pool event hook """
+        self.pool_stats.increment('invalidations')
+
+    def _pool_listeners(self):
+        return (("connect", self._pool_connect),
+                ("checkout", self._pool_checkout),
+                ("checkin", self._pool_checkin),
+                ("invalidate", self._pool_invalidate))
 
     def collect(self):
         """ Return all queries collected by this profiling session so far.
@@ -223,13 +1467,12 @@ class ProfilingSession(object):
         :raises AssertionError: If calling this function when the session
             is already started.
         """
-        if self.started is True:
-            raise AssertionError("Profiling session is already started!")
-
-        self.started = True
-        sqlalchemy.event.listen(self.engine, "before_execute",
-                                self._before_exec)
-        sqlalchemy.event.listen(self.engine, "after_execute", self._after_exec)
+        with self._state_lock:
+            if self.started is True:
+                raise AssertionError("Profiling session is already started!")
+            self.started = True
+            self._listen(sqlalchemy.event.listen, _wrap_pool_connect)
+            _Dispatcher.get(self.engine).add(self)
 
     def stop(self):
         """ Stop profiling
@@ -237,13 +1480,24 @@ class ProfilingSession(object):
         :raises AssertionError: If calling this function when the session
             is already stopped.
         """
-        if self.started is False:
-            raise AssertionError("Profiling session is already stopped")
-
-        self.started = False
-        sqlalchemy.event.remove(self.engine, "before_execute",
-                                self._before_exec)
-        sqlalchemy.event.remove(self.engine, "after_execute", self._after_exec)
+        with self._state_lock:
+            if self.started is False:
+                raise AssertionError("Profiling session is already stopped")
+            self.started = False
+            _Dispatcher.get(self.engine).remove(self)
+            self._listen(sqlalchemy.event.remove, _unwrap_pool_connect)
+
+    def _listen(self, listen, wrap_pool_connect):
+        """ Register or remove the transaction and pool listeners """
+        if self.track_transactions:
+            for name, fn in self._transaction_listeners():
+                listen(self.engine, name, fn)
+
+        if self.pool_stats is not None:
+            for name, fn in self._pool_listeners():
+                listen(self.engine, name, fn)
+            if isinstance(self.engine, sqlalchemy.engine.Engine):
+                wrap_pool_connect(self.engine.pool, self.pool_stats)
 
     def __enter__(self, *args, **kwargs):
         """ context manager """
@@ -262,26 +1516,94 @@ class ProfilingSession(object):
         return decorated
 
 
+class ParamsTable(object):
+    """ A ParamsTable assigns small, stable ids to the distinct parameter
+    sets seen by a report.
+
+    Ids are handed out in order of first appearance, starting from 1, and
+    are keyed by the query text and :attr:`QueryStats.params_hash` so that
+    identical parameter sets of different queries get different ids.
+
+    Each :class:`Reporter` owns a table by default. Pass the same table to
+    successive reports (as the WSGI dashboard does) to keep the ids of
+    already seen parameter sets unchanged between refreshes. A table may
+    be shared by reporters running in different threads.
+
+    :param capacity: If given, only the ids of the `capacity` most
+        recently used parameter sets are kept. A forgotten parameter set
+        gets a new id when seen again; ids are never reused.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self._ids = collections.OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def get_id(self, key):
+        """ Return the id of the parameter set identified by `key`,
+        allocating a new one if it was not seen before.
+        """
+        params_id = self._ids.get(key)
+        if params_id is None or self.capacity is not None:
+            with self._lock:
+                params_id = self._ids.get(key)
+                if params_id is None:
+                    params_id = self._ids[key] = self._next_id
+                    self._next_id += 1
+                    if self.capacity is not None and \
+                            len(self._ids) > self.capacity:
+                        self._ids.popitem(last=False)
+                elif self.capacity is not None:
+                    self._ids.move_to_end(key)
+        return params_id
+
+    def __len__(self):
+        return len(self._ids)
+
+
 class QueryGroup(object):
     """ A QueryGroup stores profiling statistics data on a set of similar
     queries, including their query text/time/count, backtrace stacks.
-    """
 
-    ParamsID = 1
+    :param params_table: The :class:`ParamsTable` used to number the
+        parameter sets of the group. A private table is created if omitted.
+    :param sample_size: If given, :attr:`queries` is a uniform sample of at
+        most this many queries of the group, and at most this many distinct
+        stacks and parameter sets are kept. The counters still cover every
+        query.
+    """
 
-    def __init__(self):
+    def __init__(self, params_table=None, sample_size=None):
+        self.params_table = (params_table if params_table is not None
+                             else ParamsTable())
+        self.sample_size = sample_size
         self.queries = []
         self.stacks = collections.defaultdict(int)
         self.params_hashes = {}
         self.callers = {}
+        self.count = 0
         self.max = 0
         self.min = sys.maxsize
         self.sum = 0
         self.rowcounts = 0
+        self.rows = 0
+        self.rows_fetched = 0
+        self.rows_returned = 0
+        self.bytes_returned = 0
         self.mean = 0
         self.median = 0
-
-    def find_user_fn(self, stack):
+        # upper bounds of the count and time missed by a bounded
+        # HeavyHitters tracker before this group was admitted
+        self.count_error = 0
+        self.time_error = 0
+        # a TimeSeries filled in by the Reporter
+        self.timeline = None
+        # an explain.QueryPlan attached by the Reporter
+        self.plan = None
+
+    @staticmethod
+    def find_user_fn(stack):
         """ rough heuristic to try to figure out what user-defined func
             in the call stack (i.e. not sqlalchemy) issued the query
         """
@@ -295,39 +1617,86 @@ class QueryGroup(object):
             self.text = str(q.text)
             self.formatted_text = format_sql(self.text)
             self.first_word = self.text.split()[0]
-        self.queries.append(q)
-        self.stacks[q.stack_text] += 1
-        self.callers[q.stack_text] = self.find_user_fn(q.stack)
-
+        if self._keeps(self.queries):
+            self.queries.append(q)
+        else:
+            # reservoir sampling, self.count queries were seen before q
+            idx = random.randrange(self.count + 1)
+            if idx < self.sample_size:
+                self.queries[idx] = q
+        if q.stack_text in self.stacks or self._keeps(self.stacks):
+            self.stacks[q.stack_text] += 1
+            self.callers[q.stack_text] = self.find_user_fn(q.stack)
+
+        self.count += 1
         self.max = max(self.max, q.duration)
         self.min = min(self.min, q.duration)
         self.sum += q.duration
         self.rowcounts += q.rowcount
-        self.mean = self.sum / len(self.queries)
+        self.rows += q.rows
+        self.rows_fetched += q.rows_fetched
+        self.rows_returned += q.rows_returned
+        self.bytes_returned += q.bytes_returned or 0
+        self.mean = self.sum / self.count
 
         self.add_params(q)
 
+    def fold(self, group):
+        """ Merge the aggregate counters of `group` into this group, without
+        keeping its individual queries, stacks or parameter sets.
+        """
+        self.count += group.count
+        self.max = max(self.max, group.max)
+        self.min = min(self.min, group.min)
+        self.sum += group.sum
+        self.rowcounts += group.rowcounts
+        self.rows += group.rows
+        self.rows_fetched += group.rows_fetched
+        self.rows_returned += group.rows_returned
+        self.bytes_returned += group.bytes_returned
+        self.mean = self.sum / self.count if self.count else 0
+
+    def _keeps(self, sized):
+        """ True if there is room for one more item in `sized` """
+        return self.sample_size is None or len(sized) < self.sample_size
+
     def add_params(self, q):
-        key = (hash(q.text), q.params_hash)
+        if q.params_hash is None:
+            # the parameters were not captured
+            return
+        key = (hash(str(q.text)), q.params_hash)
+        if key not in self.params_hashes and \
+                not self._keeps(self.params_hashes):
+            return
         count, params_id, params = self.params_hashes.get(
             key, (0, None, q.params))
         if params_id is None:
-            self.__class__.ParamsID += 1
-            params_id = self.ParamsID
+            params_id = self.params_table.get_id(key)
         self.params_hashes[key] = (count + 1, params_id, params)
-        q.params_id = q.params_id or params_id
+        q.params_id = params_id
 
     def calc_median(self):
         queries = sorted(self.queries, key=lambda q: q.duration,
                          reverse=True)
         length = len(queries)
-        if not length % 2:
+        if not length:
+            self.median = 0
+        elif not length % 2:
             x1 = queries[length // 2].duration
             x2 = queries[length // 2 - 1].duration
             self.median = (x1 + x2) / 2
         else:
             self.median = queries[length // 2].duration
 
+    def quantile(self, q):
+        """ Return the `q` quantile (0 < q <= 1) of the query durations of
+        the group, using the nearest rank method. """
+        durations = sorted(query.duration for query in self.queries)
+        if not durations:
+            return 0
+        rank = max(int(math.ceil(q * len(durations))), 1)
+        return durations[rank - 1]
+
     def get_param_names(self):
         """
         Aggregate param names from all queries in the group
@@ -335,18 +1704,490 @@ class QueryGroup(object):
         """
         names = set()
         for query in self.queries:
-            names |= set(query.params.keys())
+            names |= set((query.params or {}).keys())
 
         return sorted(list(names))
 
 
+def _group_key(q):
+    """ Prepare `q` to be added to a :class:`QueryGroup`, by formatting
+    its stack, and return its :func:`fingerprint`. """
+    if q.stack_text is q.stack:
+        q.stack_text = ''.join(traceback.format_list(q.stack)).strip()
+    return fingerprint(str(q.text))
+
+
+def group_by_fingerprint(stats, params_table=None):
+    """ Group queries by the :func:`fingerprint` of their statement.
+
+    :param stats: An iterable of :class:`QueryStats` objects.
+    :param params_table: The :class:`ParamsTable` shared by the groups.
+
+    :return: An ordered dict of :class:`QueryGroup` keyed by fingerprint,
+        in order of first appearance.
+    """
+    groups = collections.OrderedDict()
+    for q in stats:
+        key = _group_key(q)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = QueryGroup(params_table)
+        group.add(q)
+    return groups
+
+
+class SpaceSaving(object):
+    """ Approximate weighted top-k counter using the Space-Saving algorithm.
+
+    At most `capacity` keys are monitored. When a new key arrives and the
+    summary is full, the key with the smallest count is evicted and the
+    new key inherits its count as an error bound. The count of a monitored
+    key overestimates its true weight by at most its error, which itself
+    is never larger than ``total / capacity``.
+
+    :param capacity: The maximum number of monitored keys.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("SpaceSaving capacity must be positive")
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        self._heap = []
+        self._seq = itertools.count()
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, weight=1):
+        """ Add `weight` to the count of `key`.
+
+        :return: The key that was evicted to make room for `key`, or None.
+        """
+        self.total += weight
+        evicted = None
+        count = self.counts.get(key)
+        if count is None:
+            count = 0
+            if len(self.counts) >= self.capacity:
+                evicted, count = self._pop_min()
+            self.errors[key] = count
+        count += weight
+        self.counts[key] = count
+        heapq.heappush(self._heap, (count, next(self._seq), key))
+        if len(self._heap) > 4 * self.capacity:
+            self._compact()
+        return evicted
+
+    def top(self, n=None):
+        """ Return up to `n` ``(key, count, error)`` tuples ordered by
+        decreasing count.
+        """
+        keys = sorted(self.counts, key=self.counts.get, reverse=True)
+        return [(k, self.counts[k], self.errors[k]) for k in keys[:n]]
+
+    def _pop_min(self):
+        # heap entries are invalidated lazily whenever a count changes
+        while True:
+            count, _, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                del self.errors[key]
+                return key, count
+
+    def _compact(self):
+        self._heap = [(c, next(self._seq), k) for k, c in self.counts.items()]
+        heapq.heapify(self._heap)
+
+
+class HeavyHitters(object):
+    """ A bounded replacement for grouping every distinct query text.
+
+    Queries are grouped by :func:`fingerprint`, and only the groups that
+    are among the heaviest `capacity` fingerprints, either by total time or
+    by query count, are kept as :class:`QueryGroup` objects. The statistics
+    of groups pushed out of both rankings are folded into the
+    :attr:`other` group. Call sites are ranked by total time the same way.
+
+    The groups keep a sample of `sample_size` queries, stacks and parameter
+    sets, and the parameter sets are numbered by a table of bounded
+    capacity, so that memory use is bounded by `capacity` and
+    `sample_size` no matter how many queries and distinct statements are
+    seen. :meth:`add` may be used directly as the `collect_fn` of a
+    :class:`ProfilingSession`.
+
+    :param capacity: The number of fingerprints and call sites tracked
+        per ranking.
+    :param params_table: The :class:`ParamsTable` shared by the groups. A
+        table remembering the parameter sets the groups can hold is created
+        if omitted.
+    :param sample_size: The `sample_size` of the groups, see
+        :class:`QueryGroup`, or None to keep all of their queries.
+    """
+
+    def __init__(self, capacity=100, params_table=None, sample_size=100):
+        if params_table is None:
+            # up to capacity groups per ranking
+            params_table = ParamsTable(
+                2 * capacity * sample_size if sample_size else None)
+        self.params_table = params_table
+        self.sample_size = sample_size
+        self.by_time = SpaceSaving(capacity)
+        self.by_count = SpaceSaving(capacity)
+        self.call_sites = SpaceSaving(capacity)
+        self.groups = {}
+        self.other = QueryGroup(self.params_table)
+        self.other.text = self.other.formatted_text = "other"
+        self.other.first_word = "other"
+        self._lock = threading.Lock()
+
+    def add(self, q):
+        key = _group_key(q)
+
+        with self._lock:
+            for evicted in (self.by_time.add(key, q.duration),
+                            self.by_count.add(key)):
+                if evicted in self.by_time or evicted in self.by_count:
+                    continue
+                evicted_group = self.groups.pop(evicted, None)
+                if evicted_group is not None:
+                    self.other.fold(evicted_group)
+
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = QueryGroup(self.params_table,
+                                                      self.sample_size)
+                group.count_error = self.by_count.errors.get(key, 0)
+                group.time_error = self.by_time.errors.get(key, 0)
+            group.add(q)
+
+            caller = QueryGroup.find_user_fn(q.stack)
+            if caller is not None:
+                self.call_sites.add(tuple(caller[:3]), q.duration)
+
+    def top_groups(self, n=None, key="sum"):
+        """ Return up to `n` tracked groups ordered by decreasing `key`,
+        which is either ``"sum"`` or ``"count"``.
+        """
+        groups = sorted(self.groups.values(),
+                        key=lambda g: getattr(g, key), reverse=True)
+        return groups[:n]
+
+    def top_callers(self, n=None):
+        """ Return up to `n` ``((filename, lineno, function), time, error)``
+        tuples for the call sites that spent the most time in queries.
+        """
+        return self.call_sites.top(n)
+
+
+class TimeSeries(object):
+    """ Tumbling-window statistics of a set of queries kept in a ring buffer.
+
+    Each window of `window` seconds records the number of queries, their
+    total time and a log-scale latency histogram from which quantiles are
+    estimated within about 20%. Only the last `size` windows are kept, so
+    the memory used does not depend on how many queries are added.
+    Statistics over a sliding window are obtained by merging the last few
+    tumbling windows.
+
+    :param window: The width of a window, in seconds.
+    :param size: The number of windows kept.
+    """
+
+    # histogram buckets grow by a factor of sqrt(2) from 10us to ~100s
+    HIST_BASE = 1e-5
+    HIST_FACTOR = math.sqrt(2)
+    HIST_BUCKETS = 48
+
+    def __init__(self, window=10.0, size=360):
+        self.window = window
+        self.size = size
+        self._epochs = [None] * size
+        self._counts = [0] * size
+        self._sums = [0.0] * size
+        self._hists = [None] * size
+
+    def add(self, timestamp, duration):
+        epoch = int(timestamp // self.window)
+        slot = epoch % self.size
+        if self._epochs[slot] != epoch:
+            if self._epochs[slot] is not None and self._epochs[slot] > epoch:
+                # older than anything the ring still holds
+                return
+            self._epochs[slot] = epoch
+            self._counts[slot] = 0
+            self._sums[slot] = 0.0
+            self._hists[slot] = [0] * self.HIST_BUCKETS
+        self._counts[slot] += 1
+        self._sums[slot] += duration
+        self._hists[slot][self._bucket(duration)] += 1
+
+    def _bucket(self, duration):
+        if duration <= self.HIST_BASE:
+            return 0
+        idx = int(math.log(duration / self.HIST_BASE, self.HIST_FACTOR)) + 1
+        return min(idx, self.HIST_BUCKETS - 1)
+
+    def _bucket_value(self, idx):
+        # geometric middle of the bucket
+        return self.HIST_BASE * self.HIST_FACTOR ** (idx - 0.5)
+
+    def _slots(self, now):
+        """ Yield the slot of each of the last `size` windows, oldest first,
+        or None for windows without queries. """
+        last = int(now // self.window)
+        for epoch in range(last - self.size + 1, last + 1):
+            slot = epoch % self.size
+            yield slot if self._epochs[slot] == epoch else None
+
+    def counts(self, now=None):
+        """ Return the number of queries in each window, oldest first. """
+        now = time.time() if now is None else now
+        return [0 if s is None else self._counts[s] for s in self._slots(now)]
+
+    def rates(self, now=None):
+        """ Return the queries per second of each window, oldest first. """
+        return [c / self.window for c in self.counts(now)]
+
+    def totals(self, now=None):
+        """ Return the total query time of each window, oldest first. """
+        now = time.time() if now is None else now
+        return [0.0 if s is None else self._sums[s] for s in self._slots(now)]
+
+    def quantiles(self, q, now=None):
+        """ Return the estimated `q` latency quantile (0 < q <= 1) of each
+        window, oldest first. Windows without queries yield 0. """
+        now = time.time() if now is None else now
+        return [0.0 if s is None else self._quantile(self._hists[s], q)
+                for s in self._slots(now)]
+
+    def quantile(self, q, now=None, last=None):
+        """ Return the estimated `q` latency quantile over the sliding
+        window made of the `last` windows (all of them by default). """
+        now = time.time() if now is None else now
+        slots = [s for s in self._slots(now) if s is not None]
+        if last is not None:
+            slots = slots[-last:]
+        merged = [0] * self.HIST_BUCKETS
+        for s in slots:
+            for idx, n in enumerate(self._hists[s]):
+                merged[idx] += n
+        return self._quantile(merged, q)
+
+    def _quantile(self, hist, q):
+        total = sum(hist)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for idx, n in enumerate(hist):
+            seen += n
+            if seen >= rank:
+                return self._bucket_value(idx)
+        return self._bucket_value(len(hist) - 1)
+
+    @staticmethod
+    def sparkline(values, width=180, height=24):
+        """ Return an inline SVG polyline of `values`. """
+        if not values:
+            return ''
+        top = max(values) or 1
+        step = width / max(len(values) - 1, 1)
+        points = " ".join(
+            "%.1f,%.1f" % (i * step, height - 1 - (height - 2) * v / top)
+            for i, v in enumerate(values))
+        return ('<svg class="sparkline" width="%d" height="%d" '
+                'viewBox="0 0 %d %d"><polyline fill="none" stroke="#337ab7" '
+                'stroke-width="1" points="%s" /></svg>'
+                % (width, height, width, height, points))
+
+
+class CallTree(object):
+    """ A prefix tree of the stacks of queries, weighted by query time and
+    count, for a cross-group view of the code paths spending DB time.
+
+    Each node is a frame, identified by its function, file and line. The
+    leaves under the frame which issued a query are labelled with the
+    :func:`fingerprint` of the statement.
+
+    Example usage::
+
+        tree = CallTree.from_stats(statistics)
+        with open("queries.folded", "w") as f:
+            f.write(tree.collapsed())  # for flamegraph.pl or inferno
+        with open("queries.speedscope.json", "w") as f:
+            json.dump(tree.speedscope(), f)
+    """
+
+    class Node(object):
+        def __init__(self, name, frame=None):
+            self.name = name
+            self.frame = frame
+            self.children = collections.OrderedDict()
+            self.time = 0
+            self.count = 0
+            self.self_time = 0
+            self.self_count = 0
+
+    def __init__(self):
+        self.root = CallTree.Node("all")
+
+    @classmethod
+    def from_stats(cls, stats):
+        tree = cls()
+        for q in stats:
+            tree.add(q)
+        return tree
+
+    @staticmethod
+    def frame_name(frame):
+        # ";" separates frames in the collapsed format
+        return ("%s (%s:%d)" % (frame[2], os.path.basename(frame[0]),
+                                frame[1])).replace(";", ":")
+
+    def add(self, q):
+        """ Add the stack of the :class:`QueryStats` `q` to the tree. """
+        node = self.root
+        path = [node]
+        for frame in q.stack:
+            name = self.frame_name(frame)
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = CallTree.Node(name, frame)
+            node = child
+            path.append(node)
+
+        leaf_name = fingerprint(str(q.text))[:80].replace(";", ":")
+        leaf = node.children.get(leaf_name)
+        if leaf is None:
+            leaf = node.children[leaf_name] = CallTree.Node(leaf_name)
+        path.append(leaf)
+
+        for node in path:
+            node.time += q.duration
+            node.count += 1
+        leaf.self_time += q.duration
+        leaf.self_count += 1
+
+    def walk(self):
+        """ Yield ``(path, node)`` for every node but the root, depth first.
+        `path` is the list of nodes from the root's child to `node`. """
+        stack = [([child], child)
+                 for child in reversed(list(self.root.children.values()))]
+        while stack:
+            path, node = stack.pop()
+            yield path, node
+            for child in reversed(list(node.children.values())):
+                stack.append((path + [child], child))
+
+    def collapsed(self, weight="time"):
+        """ Return the tree in the collapsed stack format of flamegraph.pl:
+        one ``frame;frame;...;statement value`` line per leaf. Values are
+        microseconds when `weight` is ``"time"``, query counts when it is
+        ``"count"``. """
+        lines = []
+        for path, node in self.walk():
+            if weight == "count":
+                value = node.self_count
+            else:
+                value = int(round(node.self_time * 1e6))
+            if value:
+                lines.append("%s %d" % (";".join(n.name for n in path), value))
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name="sqltap"):
+        """ Return the tree as a speedscope sampled profile, ready to be
+        serialized with :func:`json.dump`. Weights are seconds. """
+        frames = []
+        frame_ids = {}
+        samples = []
+        weights = []
+        for path, node in self.walk():
+            if not node.self_count:
+                continue
+            sample = []
+            for n in path:
+                if n.name not in frame_ids:
+                    frame_ids[n.name] = len(frames)
+                    frame = {"name": n.name}
+                    if n.frame is not None:
+                        frame["file"] = n.frame[0]
+                        frame["line"] = n.frame[1]
+                    frames.append(frame)
+                sample.append(frame_ids[n.name])
+            samples.append(sample)
+            weights.append(node.self_time)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "sqltap",
+            "name": name,
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+    def icicle(self, min_width=0.002):
+        """ Return the nodes to draw in an icicle chart, as a list of
+        ``(depth, offset, width, node)`` tuples where `offset` and `width`
+        are fractions of the total query time. Nodes narrower than
+        `min_width` are left out. """
+        total = self.root.time
+        if not total:
+            return []
+        boxes = []
+        stack = [(0, 0.0, self.root)]
+        while stack:
+            depth, offset, node = stack.pop()
+            for child in node.children.values():
+                width = child.time / total
+                if width >= min_width:
+                    boxes.append((depth, offset, width, child))
+                    stack.append((depth + 1, offset, child))
+                offset += width
+        return boxes
+
+
+def _open_report(path, mode, **kwargs):
+    """ Open a report file, gzip compressed if its name ends with ``.gz``. """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', **kwargs)
+    return open(path, mode, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _template_lookup(template_dir, template_filters):
+    """ The lookup of the templates of `template_dir`, shared by the
+    reports so that each template is only compiled once. """
+    import mako.lookup
+    # mako fixes unicode -> str on py3k
+    return mako.lookup.TemplateLookup(template_dir,
+                                      default_filters=list(template_filters))
+
+
 class Reporter(object):
     """ An SQLTap Reporter base class """
 
     REPORT_TITLE = "SQLTap Profiling Report"
 
     def __init__(self, stats, report_file=None, report_dir=".",
-                 template_file=None, template_dir=None, **kwargs):
+                 template_file=None, template_dir=None, params_table=None,
+                 max_groups=None, timeline_window=10.0, timeline_size=360,
+                 timeline_end=None, pool_stats=None, long_transaction=1.0, explain=None,
+                 duplicates_scope="context", session=None, indexes=None,
+                 cache_configs=DEFAULT_CACHE_CONFIGS, **kwargs):
         """ Create a new :class:`Reporter` object
 
         :param stats: An iterable of :class:`QueryStats` objects over
@@ -354,7 +2195,8 @@ class Reporter(object):
             a call to :func:`collect`.
 
         :param report_file: If present, additionally write the SQLTap report
-            out to a file at the specified file.
+            out to a file at the specified file. The file is gzip
+            compressed if its name ends with ``.gz``, e.g. ``report.html.gz``.
 
         :param report_dir: If present, additionally write the SQLTap report
             out to a file under the specified folder.
@@ -362,6 +2204,47 @@ class Reporter(object):
         :param template_file: filename of the template to generate the report.
 
         :param template_dir: folder of the template to generate the report.
+
+        :param params_table: A :class:`ParamsTable` used to number parameter
+            sets. Reuse one table across reports to keep the ids stable.
+
+        :param max_groups: If set, group queries by :func:`fingerprint`
+            with a :class:`HeavyHitters` tracker of this capacity instead of
+            keeping a group for every distinct query text. The long tail is
+            reported as a single "other" group.
+
+        :param timeline_window: The width, in seconds, of the windows of
+            the :class:`TimeSeries` built for every group.
+
+        :param timeline_size: The number of windows in each timeline. The
+            default of 360 windows of 10 seconds covers the last hour.
+
+        :param timeline_end: The time, from :func:`time.time`, at which the
+            timelines end. Defaults to the end of the last query, so that
+            the report of an old capture still shows its queries. The
+            dashboard passes the current time.
+
+        :param pool_stats: The :class:`PoolStats` of the profiling session,
+            to be reported alongside the queries.
+
+        :param long_transaction: Transactions lasting at least this many
+            seconds are flagged as long in the report.
+
+        :param explain: An :class:`sqltap.explain.ExplainCapture` used to
+            request and show the plans of the heaviest groups.
+
+        :param duplicates_scope: The unit of work within which identical
+            queries are reported as duplicates, see :func:`find_duplicates`.
+
+        :param session: The :class:`ProfilingSession` which captured the
+            queries, whose overhead is reported.
+
+        :param indexes: An :class:`sqltap.indexes.IndexAdvisor` suggesting
+            indexes for the heaviest groups.
+
+        :param cache_configs: The ``(size, ttl)`` of the application caches
+            simulated with :func:`simulate_cache`, or None to skip the
+            simulation.
         """
         self.duration = ((stats[-1].end_time - stats[0].start_time)
                          if stats else 0)
@@ -370,21 +2253,56 @@ class Reporter(object):
         self.report_dir = report_dir
         self.template_file = template_file
         self.template_dir = template_dir
+        self.params_table = (params_table if params_table is not None
+                             else ParamsTable())
+        self.max_groups = max_groups
+        self.timeline_window = timeline_window
+        self.timeline_size = timeline_size
+        if timeline_end is None:
+            timeline_end = (max(q.end_time for q in stats) if stats
+                            else time.time())
+        self.timeline_end = timeline_end
+        self.pool_stats = pool_stats
+        self.long_transaction = long_transaction
+        self.explain = explain
+        self.duplicates_scope = duplicates_scope
+        self.session = session
+        self.indexes = indexes
+        self.cache_configs = cache_configs
         self.kwargs = kwargs
 
         self._process_stats()
 
-    def render(self, ex_handler=mako.exceptions.html_error_template):
+    def render(self, ex_handler=None):
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if self.explain is not None:
+            for group in self._query_groups:
+                group.plan = self.explain.get(group)
         try:
             result = self.template.render(
                 query_groups=self._query_groups,
                 all_group=self._all_group,
+                other_group=self._other_group,
+                top_callers=self._top_callers,
+                pool_stats=self.pool_stats,
+                session=self.session,
+                transactions=self._transactions,
+                transactions_by_caller=self._transactions_by_caller,
+                long_transaction=self.long_transaction,
+                duplicates=self._duplicates,
+                index_suggestions=self._index_suggestions,
+                cache_simulations=self._cache_simulations,
+                call_tree=self._call_tree,
                 report_title=self.REPORT_TITLE,
                 report_time=current_time,
+                report_timestamp=time.time(),
+                timeline_end=self.timeline_end,
                 duration=self.duration,
                 **self.kwargs)
         except Exception:
+            if ex_handler is None:
+                import mako.exceptions
+                ex_handler = mako.exceptions.html_error_template
             return ex_handler().render()
         return result
 
@@ -395,7 +2313,7 @@ class Reporter(object):
             report_file = os.path.join(self.report_dir, self.report_file)
             if _py2:
                 content = content.encode('utf8')
-            with open(report_file, log_mode) as f:
+            with _open_report(report_file, log_mode) as f:
                 f.write(content)
 
         return content
@@ -410,45 +2328,93 @@ class Reporter(object):
             self.template_dir = os.path.join(os.path.dirname(__file__),
                                              "templates")
 
-        # mako fixes unicode -> str on py3k
-        lookup = mako.lookup.TemplateLookup(self.template_dir,
-                                            default_filters=template_filters)
+        lookup = _template_lookup(self.template_dir, tuple(template_filters))
         self.template = lookup.get_template(self.template_file)
 
     def _process_stats(self):
         """ Process query statistics
 
         Generate sorted :class:`QueryGroup` in :param:self._query_groups and
-        all-in-one :class:`QueryGroup` in :param:self._all_group
+        all-in-one :class:`QueryGroup` in :param:self._all_group. When
+        grouping is bounded by `max_groups`, the queries of the groups that
+        were left out are summarized in :param:self._other_group.
         """
-        query_groups = collections.defaultdict(QueryGroup)
-        all_group = QueryGroup()
+        all_group = QueryGroup(self.params_table)
+        self._other_group = None
+        self._top_callers = []
+
+        if self.max_groups:
+            # the report holds every query anyway, keep them all
+            tracker = HeavyHitters(self.max_groups, self.params_table,
+                                   sample_size=None)
+            for qstats in self.stats:
+                tracker.add(qstats)
+                all_group.add(qstats)
+            query_groups = tracker.top_groups()
+            self._other_group = tracker.other
+            self._top_callers = tracker.top_callers(self.max_groups)
+        else:
+            query_groups = collections.defaultdict(
+                lambda: QueryGroup(self.params_table))
 
-        # group together statistics for the same query
-        for qstats in self.stats:
-            qstats.stack_text = \
-                ''.join(traceback.format_list(qstats.stack)).strip()
+            # group together statistics for the same query
+            for qstats in self.stats:
+                qstats.stack_text = \
+                    ''.join(traceback.format_list(qstats.stack)).strip()
 
-            group = query_groups[str(qstats.text)]
-            group.add(qstats)
-            all_group.add(qstats)
+                group = query_groups[str(qstats.text)]
+                group.add(qstats)
+                all_group.add(qstats)
 
-        query_groups = sorted(query_groups.values(), key=lambda g: g.sum,
-                              reverse=True)
+            query_groups = sorted(query_groups.values(), key=lambda g: g.sum,
+                                  reverse=True)
 
         # calculate the median for each group
         for g in query_groups:
             g.calc_median()
 
+        for g in query_groups + [all_group]:
+            g.timeline = TimeSeries(self.timeline_window, self.timeline_size)
+            for q in g.queries:
+                g.timeline.add(q.end_time, q.duration)
+
         self._query_groups = query_groups
         self._all_group = all_group
+        self._transactions, self._transactions_by_caller = \
+            analyze_transactions(self.stats)
+        self._duplicates = find_duplicates(self.stats, self.duplicates_scope)
+        self._cache_simulations = []
+        if self.cache_configs:
+            self._cache_simulations = simulate_cache(self.stats,
+                                                     self.cache_configs)
+        self._call_tree = CallTree.from_stats(self.stats)
+
+        self._index_suggestions = []
+        if self.indexes is not None:
+            self._index_suggestions = self.indexes.suggest(query_groups)
+        if self.explain is not None:
+            self.explain.submit_groups(query_groups)
+
+
+@functools.lru_cache(maxsize=None)
+def _static_asset(name):
+    path = os.path.join(os.path.dirname(__file__), "templates", "static", name)
+    with open(path) as f:
+        return f.read()
 
 
 class HTMLReporter(Reporter):
-    """ A SQLTap Reporter that generates HTML format reports """
+    """ A SQLTap Reporter that generates HTML format reports
+
+    The script of the report is always inlined. Bootstrap's stylesheet is
+    loaded from its CDN, unless `offline` is True, in which case the
+    subset of it used by the report is inlined, so that the report works
+    without internet access.
+    """
 
     def __init__(self, stats, report_file=None, report_dir=".",
-                 template_file="html.mako", template_dir=None, **kwargs):
+                 template_file="html.mako", template_dir=None, offline=False,
+                 **kwargs):
         super(HTMLReporter, self).__init__(
             stats,
             report_file=report_file,
@@ -457,6 +2423,9 @@ class HTMLReporter(Reporter):
             template_dir=template_dir,
             **kwargs)
 
+        self.kwargs["script"] = _static_asset("sqltap.js")
+        self.kwargs["offline_css"] = (_static_asset("bootstrap-pruned.css")
+                                      if offline else None)
         self._init_template(template_filters=['unicode', 'h'])
 
 
@@ -490,6 +2459,7 @@ class TextReporter(Reporter):
         self._init_template(template_filters=['unicode'])
 
     def render(self):
+        import mako.exceptions
         return super(TextReporter, self).render(
             ex_handler=mako.exceptions.text_error_template)
 
@@ -497,8 +2467,217 @@ class TextReporter(Reporter):
         return super(TextReporter, self).report(log_mode='a')
 
 
+#: The fields of the per-query records of the streaming reporters
+QUERY_FIELDS = ("start_time", "end_time", "duration", "fingerprint",
+                "statement", "params", "rows", "rows_fetched",
+                "rows_returned", "bytes_returned", "caller", "user_context",
+                "transaction", "executed_statement", "executed_params")
+
+
+def query_record(q, fields=QUERY_FIELDS):
+    """ Return the fields of a :class:`QueryStats` as an ordered dict of
+    JSON serializable values, except for `params`, `executed_params` and
+    `user_context` which are left as they are. """
+    record = collections.OrderedDict()
+    for field in fields:
+        if field == "statement":
+            value = str(q.text)
+        elif field == "fingerprint":
+            value = fingerprint(str(q.text))
+        elif field == "caller":
+            frame = QueryGroup.find_user_fn(q.stack) if q.stack else None
+            value = None if frame is None else "%s:%s %s" % (
+                frame[0], frame[1], frame[2])
+        elif field == "transaction":
+            value = None if q.transaction is None else q.transaction.id
+        else:
+            value = getattr(q, field)
+        record[field] = value
+    return record
+
+
+class _GroupTotals(object):
+    """ The aggregates of a group kept by :class:`JSONReporter`, which
+    unlike :class:`QueryGroup` does not keep the queries. """
+
+    def __init__(self, key, text):
+        self.fingerprint = key
+        self.text = text
+        words = text.split(None, 1)
+        self.first_word = words[0] if words else ""
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = 0.0
+        self.rows = 0
+        self.rows_fetched = 0
+        self.rows_returned = 0
+        # a single window spanning the whole capture
+        self.latency = TimeSeries(window=float("inf"), size=1)
+
+    def add(self, q):
+        self.count += 1
+        self.sum += q.duration
+        self.max = max(self.max, q.duration)
+        self.min = q.duration if self.min is None else min(self.min,
+                                                           q.duration)
+        self.rows += q.rows
+        self.rows_fetched += q.rows_fetched
+        self.rows_returned += q.rows_returned
+        self.latency.add(0, q.duration)
+
+    def to_dict(self):
+        return collections.OrderedDict((
+            ("fingerprint", self.fingerprint),
+            ("statement", self.text),
+            ("first_word", self.first_word),
+            ("count", self.count),
+            ("sum", self.sum),
+            ("mean", self.sum / self.count if self.count else 0.0),
+            ("min", self.min or 0.0),
+            ("max", self.max),
+            ("p50", self.latency.quantile(0.5, now=0)),
+            ("p95", self.latency.quantile(0.95, now=0)),
+            ("rows", self.rows),
+            ("rows_fetched", self.rows_fetched),
+            ("rows_returned", self.rows_returned),
+        ))
+
+
+class StreamReporter(object):
+    """ Base class of the reporters exporting one record per query.
+
+    The statistics are iterated over once and each record is written as
+    soon as it is built, so captures of any size are exported in constant
+    memory. `stats` may be a generator.
+
+    :param stats: An iterable of :class:`QueryStats`.
+
+    :param report_file: The file to write the report to, a path relative
+        to `report_dir` (gzip compressed if it ends with ``.gz``) or a file
+        object. :meth:`report` returns the
+        report as a string when it is not given.
+
+    :param fields: The fields of each query, see :data:`QUERY_FIELDS`.
+    """
+
+    def __init__(self, stats, report_file=None, report_dir=".",
+                 fields=QUERY_FIELDS, **kwargs):
+        self.stats = stats
+        self.report_file = report_file
+        self.report_dir = report_dir
+        self.fields = fields
+        self.kwargs = kwargs
+
+    def records(self):
+        for q in self.stats:
+            yield q, query_record(q, self.fields)
+
+    def write(self, f):
+        """ Write the report to the text file `f` """
+        raise NotImplementedError
+
+    def render(self):
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
+
+    def report(self):
+        """ Write the report to `report_file` and return its path (or the
+        file object), or return the report if there is no `report_file`.
+        """
+        if not self.report_file:
+            return self.render()
+        if hasattr(self.report_file, "write"):
+            self.write(self.report_file)
+            return self.report_file
+        path = os.path.join(self.report_dir, self.report_file)
+        with _open_report(path, "w", newline="") as f:
+            self.write(f)
+        return path
+
+
+class NDJSONReporter(StreamReporter):
+    """ A SQLTap Reporter writing a JSON object per query and per line """
+
+    def write(self, f):
+        for q, record in self.records():
+            f.write(json.dumps(record, default=str))
+            f.write("\n")
+
+
+class CSVReporter(StreamReporter):
+    """ A SQLTap Reporter writing a CSV row per query. The parameters are
+    JSON encoded. """
+
+    def write(self, f):
+        writer = csv.writer(f)
+        writer.writerow(self.fields)
+        for q, record in self.records():
+            for field in ("params", "executed_params"):
+                if field in record:
+                    record[field] = json.dumps(record[field], default=str)
+            writer.writerow(list(record.values()))
+
+
+class JSONReporter(StreamReporter):
+    """ A SQLTap Reporter writing the aggregates of each query group, by
+    :func:`fingerprint`, as a JSON document.
+
+    :param include_queries: If True, the document also lists every query.
+        They are written while the groups are aggregated, so the memory
+        used only depends on the number of groups.
+    """
+
+    def __init__(self, stats, report_file=None, report_dir=".",
+                 fields=QUERY_FIELDS, include_queries=False, **kwargs):
+        super(JSONReporter, self).__init__(
+            stats, report_file=report_file, report_dir=report_dir,
+            fields=fields, **kwargs)
+        self.include_queries = include_queries
+
+    def records(self):
+        for q in self.stats:
+            yield q, (query_record(q, self.fields)
+                      if self.include_queries else None)
+
+    def write(self, f):
+        groups = {}
+        all_group = _GroupTotals(None, "all")
+        f.write('{"title": %s, "report_timestamp": %s'
+                % (json.dumps(Reporter.REPORT_TITLE), json.dumps(time.time())))
+        if self.include_queries:
+            f.write(', "queries": [')
+        separator = "\n"
+        for q, record in self.records():
+            if record is not None:
+                f.write(separator)
+                f.write(json.dumps(record, default=str))
+                separator = ",\n"
+            text = str(q.text)
+            key = fingerprint(text)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _GroupTotals(key, text)
+            group.add(q)
+            all_group.add(q)
+        if self.include_queries:
+            f.write("\n]")
+
+        groups = sorted(groups.values(), key=lambda g: g.sum, reverse=True)
+        f.write(', "all": ')
+        f.write(json.dumps(all_group.to_dict()))
+        f.write(', "groups": [')
+        separator = "\n"
+        for group in groups:
+            f.write(separator)
+            f.write(json.dumps(group.to_dict()))
+            separator = ",\n"
+        f.write("\n]}\n")
+
+
 def start(engine=sqlalchemy.engine.Engine, user_context_fn=None,
-          collect_fn=None):
+          collect_fn=None, **kwargs):
     """ Create a new :class:`ProfilingSession` and call start on it.
 
     This is a convenience method. See :class:`ProfilingSession`'s
@@ -506,7 +2685,7 @@ def start(engine=sqlalchemy.engine.Engine, user_context_fn=None,
 
     :return: A new :class:`ProfilingSession`
     """
-    session = ProfilingSession(engine, user_context_fn, collect_fn)
+    session = ProfilingSession(engine, user_context_fn, collect_fn, **kwargs)
     session.start()
     return session
 
@@ -519,7 +2698,7 @@ def report(statistics, filename=None, template="html.mako", **kwargs):
         a call to :func:`collect`.
 
     :param filename: If present, additionally write the report out to a file at
-        the specified path.
+        the specified path. Names ending with ``.gz`` are gzip compressed.
 
     :param template: The name of the file in the sqltap/templates directory to
         render for the report. This is mostly intended for extensions to sqltap
@@ -527,13 +2706,19 @@ def report(statistics, filename=None, template="html.mako", **kwargs):
         specified.
 
     :param report_format: (Optional) Choose the format for SQLTap report,
-        candidates are ["html", "wsgi", "text"]
+        candidates are ["html", "wsgi", "text", "json", "csv", "ndjson"].
+        The last three are written incrementally by a
+        :class:`StreamReporter`, and `statistics` may then be a generator.
 
-    :return: The generated SQLTap Report.
+    :return: The generated SQLTap Report. For the streaming formats with a
+        `filename`, the path of the written file.
     """
     REPORTER_MAPPING = {REPORT_HTML: HTMLReporter,
                         REPORT_WSGI: WSGIReporter,
-                        REPORT_TEXT: TextReporter}
+                        REPORT_TEXT: TextReporter,
+                        REPORT_JSON: JSONReporter,
+                        REPORT_CSV: CSVReporter,
+                        REPORT_NDJSON: NDJSONReporter}
 
     report_format = kwargs.get('report_format')
     if report_format:
@@ -0,0 +1,59 @@
+<%
+    def fmt_change(change):
+        if change is None:
+            return 'new'
+        return '%+.0f%%' % (change * 100)
+
+    def short(text, width=72):
+        text = ' '.join(text.split())
+        return text if len(text) <= width else text[:width - 3] + '...'
+%>\
+========================================================================
+${"======{TITLE: ^60}======".format(TITLE=report_title)}
+========================================================================
+New statements: ${len(diff.new)}
+Disappeared statements: ${len(diff.removed)}
+Common statements: ${len(diff.changed)}
+Regressions: ${len(diff.regressions)}
+% if diff.regressions:
+
+========================================================================
+${"======{0: ^60}======".format("Regressions")}
+========================================================================
+% for d in diff.regressions:
+[${', '.join(d.regressions)}] ${short(d.text)}
+% if d.before is None:
+  count ${d.after.count}, total ${'%.3f' % d.after.sum}s, p95 ${'%.3f' % d.after.p95}s, rows ${d.after.rows}
+% else:
+  count ${d.before.count} -> ${d.after.count} (${fmt_change(d.change('count'))}), total ${'%.3f' % d.before.sum}s -> ${'%.3f' % d.after.sum}s (${fmt_change(d.change('sum'))})
+  p95 ${'%.3f' % d.before.p95}s -> ${'%.3f' % d.after.p95}s (${fmt_change(d.change('p95'))}), rows ${d.before.rows} -> ${d.after.rows} (${fmt_change(d.change('rows'))})
+% endif
+% endfor
+% endif
+% if diff.new:
+
+========================================================================
+${"======{0: ^60}======".format("New statements")}
+========================================================================
+% for d in diff.new:
+${d.after.count} x ${short(d.text)} (${'%.3f' % d.after.sum}s)
+% endfor
+% endif
+% if diff.removed:
+
+========================================================================
+${"======{0: ^60}======".format("Disappeared statements")}
+========================================================================
+% for d in diff.removed:
+${d.before.count} x ${short(d.text)} (${'%.3f' % d.before.sum}s)
+% endfor
+% endif
+% if diff.changed:
+
+========================================================================
+${"======{0: ^60}======".format("Common statements")}
+========================================================================
+% for d in diff.changed:
+${'%5s' % fmt_change(d.change('sum'))} time, ${'%5s' % fmt_change(d.change('count'))} count: ${short(d.text)}
+% endfor
+% endif
@@ -1,3 +1,6 @@
+<%!
+    from sqltap.sqltap import highlight_sql
+%>\
 <!DOCTYPE html>
 <html lang="en">
   <head>
@@ -10,11 +13,21 @@
     <title>${report_title}</title>
 
     <!-- Bootstrap core CSS -->
+    % if offline_css:
+    <style type="text/css">${offline_css | n}</style>
+    % else:
     <link href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.5/css/bootstrap.min.css" rel="stylesheet">
+    % endif
 
-    <!-- syntax highlighting -->
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/8.8.0/styles/default.min.css" rel="stylesheet">
     <style type="text/css">
+      /* syntax highlighting, done when rendering the report */
+      .hljs { display: block; overflow-x: auto; background: #f0f0f0; color: #444; }
+      .hljs-keyword { color: #00a; font-weight: bold; }
+      .hljs-built_in { color: #0086b3; }
+      .hljs-string { color: #a31515; }
+      .hljs-number { color: #099; }
+      .hljs-variable { color: #880; }
+      .hljs-comment { color: #888; font-style: italic; }
       body { padding-top: 60px; }
       #query-groups {
         border-right: 1px solid #ccc;
@@ -27,6 +40,13 @@
       #total-time .count { color: #0f0; font-size: 16px; }
       a.toggle { cursor: pointer }
       a.toggle strong { color: red; }
+      .icicle { position: relative; }
+      .icicle-node {
+        position: absolute; height: 17px; overflow: hidden; cursor: pointer;
+        white-space: nowrap; font-size: 11px; line-height: 17px; padding: 0 2px;
+        background: #f0ad4e; border: 1px solid #fff; color: #333;
+      }
+      .icicle-node.leaf { background: #5bc0de; }
     </style>
   </head>
 
@@ -46,6 +66,12 @@
             <span class="count">${len(all_group.queries)}</span> queries spent
             <span class="sum">${'%.2f' % all_group.sum}</span> seconds
             over <span class="sum">${'%.2f' % duration}</span> seconds of profiling
+            % if session is not None:
+            <span id="overhead"
+                  title="time spent by sqltap recording the queries${'' if session.governor is None else ', capturing ' + session.governor.description}">
+              (overhead <span class="sum">${'%.2f' % (session.overhead * 100)}</span>%)
+            </span>
+            % endif
           </p>
           <%block name="header_extra"></%block>
         </div>
@@ -60,8 +86,9 @@
             <li class="${'active' if i==0 else ''}">
               <a href="#query-${i}" data-toggle="tab">
                 <span class="label label-default pull-right"
-                      style="margin-right: 5px; width: 8ex; text-align: right;">
-                    ${group.rowcounts}r
+                      style="margin-right: 5px; width: 8ex; text-align: right;"
+                      title="${group.rows_fetched} rows fetched, ${group.rows_returned} returned">
+                    ${group.rows}r
                 </span>
                 <span class="label label-warning pull-right" style="margin-right: 5px;">
                     ${'%.3f' % group.sum}s
@@ -69,12 +96,127 @@
                 <span class="label label-info pull-right" style="margin-right: 5px;">
                   ${len(group.queries)}q
                 </span>
+                % if group.plan is not None and group.plan.full_scans:
+                <span class="label label-danger pull-right" style="margin-right: 5px;"
+                      title="full table scan of ${', '.join(group.plan.full_scans)}">
+                  scan
+                </span>
+                % endif
 ${group.first_word}
               </a>
             </li>
           % endfor
           </ul>
 
+          % if other_group is not None and other_group.count:
+          <ul class="nav nav-pills nav-stacked">
+            <li class="disabled">
+              <a title="queries outside of the ${len(query_groups)} heaviest groups">
+                <span class="label label-warning pull-right" style="margin-right: 5px;">
+                    ${'%.3f' % other_group.sum}s
+                </span>
+                <span class="label label-info pull-right" style="margin-right: 5px;">
+                  ${other_group.count}q
+                </span>
+                other
+              </a>
+            </li>
+          </ul>
+          % endif
+
+          <ul class="nav nav-pills nav-stacked" id="analysisTabs">
+            % if pool_stats is not None:
+            <li>
+              <a href="#pool" data-toggle="tab">
+                <span class="label label-warning pull-right" style="margin-right: 5px;">
+                    ${'%.3f' % pool_stats.checkout_wait.sum}s
+                </span>
+                <span class="label label-info pull-right" style="margin-right: 5px;">
+                  ${pool_stats.checkouts}c
+                </span>
+                Connection pool
+              </a>
+            </li>
+            % endif
+            % if transactions:
+            <li>
+              <a href="#transactions" data-toggle="tab">
+                <span class="label label-warning pull-right" style="margin-right: 5px;">
+                    ${'%.3f' % transactions[0].duration}s
+                </span>
+                <span class="label label-info pull-right" style="margin-right: 5px;">
+                  ${len(transactions)}t
+                </span>
+                Transactions
+              </a>
+            </li>
+            % endif
+            % if call_tree.root.time:
+            <li>
+              <a href="#call-tree" data-toggle="tab">
+                <span class="label label-warning pull-right" style="margin-right: 5px;">
+                    ${'%.3f' % call_tree.root.time}s
+                </span>
+                Call tree
+              </a>
+            </li>
+            % endif
+            % if duplicates:
+            <li>
+              <a href="#duplicates" data-toggle="tab">
+                <span class="label label-warning pull-right" style="margin-right: 5px;">
+                    ${'%.3f' % sum(d.wasted_time for d in duplicates)}s
+                </span>
+                <span class="label label-info pull-right" style="margin-right: 5px;">
+                  ${sum(d.count - 1 for d in duplicates)}q
+                </span>
+                Duplicate queries
+              </a>
+            </li>
+            % endif
+            <% best_cache = max(cache_simulations, key=lambda c: c.saved_time) if cache_simulations else None %>
+            % if best_cache is not None and best_cache.hits:
+            <li>
+              <a href="#cache" data-toggle="tab">
+                <span class="label label-warning pull-right" style="margin-right: 5px;">
+                    ${'%.3f' % best_cache.saved_time}s
+                </span>
+                <span class="label label-info pull-right" style="margin-right: 5px;">
+                  ${'%d' % (best_cache.hit_rate * 100)}%
+                </span>
+                Cache simulation
+              </a>
+            </li>
+            % endif
+            <% missing_indexes = [s for s in index_suggestions if s.existing is None] %>
+            % if index_suggestions:
+            <li>
+              <a href="#indexes" data-toggle="tab">
+                <span class="label label-warning pull-right" style="margin-right: 5px;">
+                    ${'%.3f' % sum(s.time for s in missing_indexes)}s
+                </span>
+                <span class="label label-info pull-right" style="margin-right: 5px;">
+                  ${len(missing_indexes)}i
+                </span>
+                Index suggestions
+              </a>
+            </li>
+            % endif
+          </ul>
+
+          % if top_callers:
+          <hr />
+          <h5>Heaviest call sites</h5>
+          <ul class="list-unstyled small">
+            % for (filename, lineno, fn), total, error in top_callers[:10]:
+            <li title="${filename}:${lineno}">
+              <span class="label label-warning">${'%.3f' % total}s</span>
+              <strong>${fn}</strong> @${filename.split()[-1]}:${lineno}
+            </li>
+            % endfor
+          </ul>
+          % endif
+
           <hr />
 
             <div>
@@ -97,8 +239,24 @@ ${group.first_word}
                     </li>
                     <li>
                       <dt>Row Count</dt>
-                      <dd>${'%d' % group.rowcounts}</dd>
+                      <dd>${'%d' % group.rows}</dd>
+                    </li>
+                    % if group.rows_fetched:
+                    <li>
+                      <dt>Rows Fetched</dt>
+                      <dd>${'%d' % group.rows_fetched}</dd>
+                    </li>
+                    <li>
+                      <dt>Rows Returned</dt>
+                      <dd class="${'text-danger' if group.rows_fetched > group.rows_returned else ''}">${'%d' % group.rows_returned}</dd>
                     </li>
+                    % endif
+                    % if group.bytes_returned:
+                    <li>
+                      <dt>Bytes Returned</dt>
+                      <dd>${'%d' % group.bytes_returned}</dd>
+                    </li>
+                    % endif
                     <li>
                       <dt>Total Time</dt>
                       <dd>${'%.3f' % group.sum}</dd>
@@ -122,10 +280,44 @@ ${group.first_word}
                   </ul>
               </h4>
 
+              % if group.timeline is not None:
+              <% timeline = group.timeline %>
+              <ul class="list-inline timeline"
+                  title="${'%d' % (timeline.window * timeline.size)}s in ${'%g' % timeline.window}s windows">
+                <li>
+                  <dt>Queries/s</dt>
+                  <dd>${timeline.sparkline(timeline.rates(timeline_end)) | n}</dd>
+                </li>
+                <li>
+                  <dt>Total Time</dt>
+                  <dd>${timeline.sparkline(timeline.totals(timeline_end)) | n}</dd>
+                </li>
+                <li>
+                  <dt>p95 (${'%.3f' % timeline.quantile(0.95, timeline_end)})</dt>
+                  <dd>${timeline.sparkline(timeline.quantiles(0.95, timeline_end)) | n}</dd>
+                </li>
+              </ul>
+              % endif
+
               <hr />
-              <pre><code class="sql">${group.formatted_text}</code></pre>
+              <pre><code class="sql hljs">${highlight_sql(group.formatted_text) | n}</code></pre>
               <hr />
 
+              % if group.plan is not None:
+              <h4>
+                Query Plan
+                % for table in group.plan.full_scans:
+                <span class="label label-danger">full scan of ${table}</span>
+                % endfor
+              </h4>
+              % if group.plan.error:
+              <pre class="text-danger">${group.plan.error}</pre>
+              % else:
+              <pre>${'\n'.join(group.plan.rows)}</pre>
+              % endif
+              <hr />
+              % endif
+
               <%
                 params = group.get_param_names()
               %>
@@ -145,10 +337,10 @@ ${group.first_word}
                 <tr class="${'hidden' if idx >= 3 else ''}">
                     <td>${'%.3f' % query.duration}</td>
                     % for param_name in params:
-                    <td>${query.params.get(param_name, '')}</td>
+                    <td>${(query.params or {}).get(param_name, '')}</td>
                     % endfor
-                    <td>${'%d' % query.rowcount}</td>
-                    <td>${'%d' % query.params_id}</td>
+                    <td>${'%d' % query.rows}</td>
+                    <td>${'%d' % query.params_id if query.params_id is not None else '-'}</td>
                 </tr>
                 % endfor
               </table>
@@ -216,35 +408,266 @@ ${group.first_word}
             <!-- ================================================== -->
 
             % endfor
+
+            % if pool_stats is not None:
+            <div id="pool" class="tab-pane">
+              <h4>
+                  <ul class="list-inline">
+                    <li>
+                      <dt>Connects</dt>
+                      <dd>${pool_stats.connects}</dd>
+                    </li>
+                    <li>
+                      <dt>Checkouts</dt>
+                      <dd>${pool_stats.checkouts}</dd>
+                    </li>
+                    <li>
+                      <dt>Checkins</dt>
+                      <dd>${pool_stats.checkins}</dd>
+                    </li>
+                    <li>
+                      <dt>Invalidations</dt>
+                      <dd>${pool_stats.invalidations}</dd>
+                    </li>
+                  </ul>
+              </h4>
+              <hr />
+              <table class="table">
+                <tr>
+                  <th></th>
+                  <th>Count</th>
+                  <th>Total Time</th>
+                  <th>Mean</th>
+                  <th>Max</th>
+                </tr>
+                % for label, timing in [('Checkout wait', pool_stats.checkout_wait), ('Connection hold', pool_stats.hold)]:
+                <tr>
+                  <th>${label}</th>
+                  <td>${timing.count}</td>
+                  <td>${'%.3f' % timing.sum}</td>
+                  <td>${'%.3f' % timing.mean}</td>
+                  <td>${'%.3f' % timing.max}</td>
+                </tr>
+                % endfor
+              </table>
+              % if pool_stats.hold_by_context:
+              <hr />
+              <h4>Connection hold time by context</h4>
+              <table class="table">
+                <tr>
+                  <th>Context</th>
+                  <th>Checkouts</th>
+                  <th>Total Time</th>
+                  <th>Mean</th>
+                  <th>Max</th>
+                </tr>
+                % for ctx, timing in sorted(pool_stats.hold_by_context.items(), key=lambda item: item[1].sum, reverse=True):
+                <tr>
+                  <td><code>${ctx}</code></td>
+                  <td>${timing.count}</td>
+                  <td>${'%.3f' % timing.sum}</td>
+                  <td>${'%.3f' % timing.mean}</td>
+                  <td>${'%.3f' % timing.max}</td>
+                </tr>
+                % endfor
+              </table>
+              % endif
+            </div>
+            % endif
+
+            % if transactions:
+            <div id="transactions" class="tab-pane">
+              <% long_count = len([t for t in transactions if t.duration >= long_transaction]) %>
+              <h4>
+                  ${len(transactions)} transactions,
+                  ${long_count} lasting ${'%g' % long_transaction}s or more
+              </h4>
+              <table class="table">
+                <tr>
+                  <th>Duration</th>
+                  <th>Queries</th>
+                  <th>Query Time</th>
+                  <th>Idle Time</th>
+                  <th>Max Gap</th>
+                  <th>Outcome</th>
+                  <th>Started From</th>
+                </tr>
+                % for idx, t in enumerate(transactions):
+                <tr class="${'hidden' if idx >= 10 else ''} ${'danger' if t.duration >= long_transaction else ''}">
+                  <td>${'%.3f' % t.duration}</td>
+                  <td>${t.query_count}</td>
+                  <td>${'%.3f' % t.query_time}</td>
+                  <td>${'%.3f' % t.idle_time}</td>
+                  <td>${'%.3f' % t.max_gap}</td>
+                  <td>${t.transaction.outcome or 'open'}</td>
+                  <td>
+                    % if t.caller is not None:
+                    <strong>${t.caller[2]}</strong> @${t.caller[0].split()[-1]}:${t.caller[1]}
+                    % endif
+                  </td>
+                </tr>
+                % endfor
+              </table>
+              % if len(transactions) > 10:
+                <a href="#" class="morequeries">show ${len(transactions)-10} shorter transactions</a>
+              % endif
+              <hr />
+              <h4>Transactions by call site</h4>
+              <table class="table">
+                <tr>
+                  <th>Call Site</th>
+                  <th>Transactions</th>
+                  <th>Total Duration</th>
+                  <th>Max Duration</th>
+                  <th>Total Idle Time</th>
+                </tr>
+                % for caller, caller_transactions in transactions_by_caller:
+                <tr>
+                  <td>
+                    % if caller is not None:
+                    <strong>${caller[2]}</strong> @${caller[0].split()[-1]}:${caller[1]}
+                    % endif
+                  </td>
+                  <td>${len(caller_transactions)}</td>
+                  <td>${'%.3f' % sum(t.duration for t in caller_transactions)}</td>
+                  <td>${'%.3f' % max(t.duration for t in caller_transactions)}</td>
+                  <td>${'%.3f' % sum(t.idle_time for t in caller_transactions)}</td>
+                </tr>
+                % endfor
+              </table>
+            </div>
+            % endif
+
+            % if call_tree.root.time:
+            <div id="call-tree" class="tab-pane">
+              <% boxes = call_tree.icicle() %>
+              <h4>
+                Query time by call path
+                <small><a href="#" class="icicle-reset">reset zoom</a></small>
+              </h4>
+              <div class="icicle" style="height: ${18 * (max(b[0] for b in boxes) + 1) if boxes else 0}px;">
+                % for depth, offset, width, node in boxes:
+                <div class="icicle-node ${'leaf' if node.frame is None else ''}"
+                     data-depth="${depth}" data-x="${'%.6f' % offset}" data-w="${'%.6f' % width}"
+                     style="top: ${18 * depth}px; left: ${'%.4f' % (offset * 100)}%; width: ${'%.4f' % (width * 100)}%;"
+                     title="${node.name}: ${'%.3f' % node.time}s in ${node.count} queries">${node.name}</div>
+                % endfor
+              </div>
+            </div>
+            % endif
+
+            % if duplicates:
+            <div id="duplicates" class="tab-pane">
+              <h4>
+                  ${len(duplicates)} statements were run more than once with
+                  the same parameters in the same unit of work
+              </h4>
+              <ul class="details">
+                % for idx, dup in enumerate(duplicates):
+                <li class="${'hidden' if idx >= 20 else ''}">
+                  <h5>
+                    <span class="label label-warning">${'%.3f' % dup.wasted_time}s wasted</span>
+                    ${dup.count} calls in <code>${dup.scope}</code> with
+                    <tt>${", ".join(["%s=%r" % (k, dup.params[k]) for k in sorted(dup.params.keys())])}</tt>
+                  </h5>
+                  <pre><code class="sql hljs">${highlight_sql(dup.text) | n}</code></pre>
+                  <ul class="list-unstyled">
+                    % for filename, lineno, fn in dup.callers:
+                    <li>from <strong>${fn}</strong> @${filename.split()[-1]}:${lineno}</li>
+                    % endfor
+                  </ul>
+                </li>
+                % endfor
+              </ul>
+              % if len(duplicates) > 20:
+                <a href="#" class="moreparams">show ${len(duplicates)-20} more duplicates</a>
+              % endif
+            </div>
+            % endif
+
+            % if best_cache is not None and best_cache.hits:
+            <div id="cache" class="tab-pane">
+              <h4>
+                  Read queries answered by an application cache in front of
+                  the database, invalidated on writes to their tables
+              </h4>
+              <table class="table">
+                <tr>
+                  <th>Entries</th>
+                  <th>TTL</th>
+                  <th>Lookups</th>
+                  <th>Hit Rate</th>
+                  <th>Invalidations</th>
+                  <th>Time Saved</th>
+                </tr>
+                % for c in cache_simulations:
+                <tr class="${'success' if c is best_cache else ''}">
+                  <td>${c.size}</td>
+                  <td>${'%gs' % c.ttl if c.ttl is not None else 'none'}</td>
+                  <td>${c.lookups}</td>
+                  <td>${'%.1f' % (c.hit_rate * 100)}%</td>
+                  <td>${c.invalidations}</td>
+                  <td>${'%.3f' % c.saved_time}</td>
+                </tr>
+                % endfor
+              </table>
+              <hr />
+              <h4>Queries worth caching, with ${best_cache.size} entries</h4>
+              <ul class="details">
+                % for group in best_cache.top_groups(20):
+                % if group.hits:
+                <li>
+                  <h5>
+                    <span class="label label-warning">${'%.3f' % group.saved_time}s saved</span>
+                    ${group.hits} hits out of ${group.lookups} lookups (${'%.1f' % (group.hit_rate * 100)}%)
+                  </h5>
+                  <pre><code class="sql hljs">${highlight_sql(group.text) | n}</code></pre>
+                </li>
+                % endif
+                % endfor
+              </ul>
+            </div>
+            % endif
+
+            % if index_suggestions:
+            <div id="indexes" class="tab-pane">
+              <h4>
+                  ${len(missing_indexes)} indexes missing for the columns
+                  filtered and joined on by the heaviest queries
+              </h4>
+              <table class="table">
+                <tr>
+                  <th>Table</th>
+                  <th>Columns</th>
+                  <th>Query Time</th>
+                  <th>Rows</th>
+                  <th>Queries</th>
+                  <th>Index</th>
+                </tr>
+                % for s in index_suggestions:
+                <tr class="${'warning' if s.existing is None else ''}">
+                  <td>${s.table}</td>
+                  <td>${", ".join(s.columns)}</td>
+                  <td>${'%.3f' % s.time}</td>
+                  <td>${s.rows}</td>
+                  <td title="${len(s.fingerprints)} statements">${s.count}</td>
+                  <td>
+                    % if s.existing is None:
+                    <code>${s.ddl()}</code>
+                    % else:
+                    ${s.existing}
+                    % endif
+                  </td>
+                </tr>
+                % endfor
+              </table>
+            </div>
+            % endif
           </div>
         </div>
     </div><!-- /.container -->
 
 
-    <script src="https://ajax.googleapis.com/ajax/libs/jquery/1.11.0/jquery.min.js"></script>
-    <script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.5/js/bootstrap.min.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/8.8.0/highlight.min.js"></script>
-    <script>hljs.initHighlightingOnLoad();</script>
-    <script type="text/javascript">
-        jQuery(function($) {
-            $(".toggle").click(function() {
-                $(this).siblings(".trace").toggleClass("hidden");
-            });
-            $('#myTabs a').click(function (e) {
-                $(this).tab('show');
-                e.preventDefault();
-            });
-            $(".morequeries").click(function(e) {
-                e.preventDefault();
-                $(this).hide();
-                $(this).prev("table").find("tr.hidden").removeClass("hidden");
-            });
-            $(".moreparams").click(function(e) {
-                e.preventDefault();
-                $(this).hide();
-                $(this).prev("ul").find("li.hidden").removeClass("hidden");
-            });
-        });
-    </script>
+    <script type="text/javascript">${script | n}</script>
   </body>
 </html>
@@ -0,0 +1,71 @@
+(function() {
+    function each(selector, root, fn) {
+        Array.prototype.forEach.call((root || document).querySelectorAll(selector), fn);
+    }
+    function on(selector, fn) {
+        each(selector, null, function(el) { el.addEventListener("click", fn); });
+    }
+    function prev(el, tag) {
+        el = el.previousElementSibling;
+        while (el && el.tagName.toLowerCase() !== tag) {
+            el = el.previousElementSibling;
+        }
+        return el;
+    }
+    function closest(el, selector) {
+        while (el && !el.matches(selector)) {
+            el = el.parentElement;
+        }
+        return el;
+    }
+    function showMore(tag, hidden) {
+        return function(e) {
+            e.preventDefault();
+            this.style.display = "none";
+            each(hidden, prev(this, tag), function(el) { el.classList.remove("hidden"); });
+        };
+    }
+    function place(el, left, width, visible) {
+        el.style.display = visible ? "" : "none";
+        el.style.left = left * 100 + "%";
+        el.style.width = width * 100 + "%";
+    }
+
+    document.addEventListener("DOMContentLoaded", function() {
+        on(".toggle", function() {
+            each(":scope > .trace", this.parentNode, function(el) {
+                el.classList.toggle("hidden");
+            });
+        });
+        on("#myTabs a, #analysisTabs a", function(e) {
+            e.preventDefault();
+            each("#query-groups li.active", null, function(li) { li.classList.remove("active"); });
+            this.parentNode.classList.add("active");
+            var pane = document.getElementById(this.getAttribute("href").slice(1));
+            each(":scope > .tab-pane.active", pane.parentNode, function(el) {
+                el.classList.remove("active");
+            });
+            pane.classList.add("active");
+        });
+        on(".morequeries", showMore("table", "tr.hidden"));
+        on(".moreparams", showMore("ul", "li.hidden"));
+        on(".icicle-node", function() {
+            var x0 = +this.dataset.x, w0 = +this.dataset.w, d0 = +this.dataset.depth;
+            var eps = 1e-6;
+            each(".icicle-node", closest(this, ".icicle"), function(el) {
+                var x = +el.dataset.x, w = +el.dataset.w, d = +el.dataset.depth;
+                if (d < d0) {
+                    place(el, 0, 1, x <= x0 + eps && x + w >= x0 + w0 - eps);
+                } else {
+                    place(el, (x - x0) / w0, w / w0, x >= x0 - eps && x + w <= x0 + w0 + eps);
+                }
+            });
+        });
+        on(".icicle-reset", function(e) {
+            e.preventDefault();
+            each(".icicle-node", closest(this, ".tab-pane"), function(el) {
+                place(el, +el.dataset.x, +el.dataset.w, true);
+            });
+        });
+    });
+})();
@@ -9,7 +9,110 @@ ${"======{0: ^60}======".format("Summary")}
 Total queries: ${len(all_group.queries)}
 Total time: ${'%.2f' % all_group.sum} second(s)
 Total profiling time: ${'%.2f' % duration} second(s)
+% if session is not None:
+Profiling overhead: ${'%.2f' % (session.overhead * 100)}% of the query time
+% if session.governor is not None:
+Capturing: ${session.governor.description} (budget ${'%.2f' % (session.governor.budget * 100)}%)
+% endif
+% endif
+% if other_group is not None and other_group.count:
+Other queries (outside the ${len(query_groups)} heaviest groups): ${other_group.count} in ${'%.2f' % other_group.sum} second(s)
+% endif
+% if top_callers:
 
+Heaviest call sites:
+% for (filename, lineno, fn), total, error in top_callers[:10]:
+  ${'%.3f' % total} second(s) (+/- ${'%.3f' % error}) from ${fn} @${filename.split()[-1]}:${lineno}
+% endfor
+% endif
+
+% if pool_stats is not None:
+========================================================================
+${"======{0: ^60}======".format("Connection pool")}
+========================================================================
+Connects: ${pool_stats.connects}
+Checkouts: ${pool_stats.checkouts}
+Checkins: ${pool_stats.checkins}
+Invalidations: ${pool_stats.invalidations}
+% for label, timing in [('Checkout wait', pool_stats.checkout_wait), ('Connection hold', pool_stats.hold)]:
+${label}: ${timing.count} in ${'%.3f' % timing.sum} second(s), mean ${'%.3f' % timing.mean}, max ${'%.3f' % timing.max}
+% endfor
+% for ctx, timing in sorted(pool_stats.hold_by_context.items(), key=lambda item: item[1].sum, reverse=True):
+  Held by ${ctx}: ${timing.count} checkout(s) in ${'%.3f' % timing.sum} second(s), max ${'%.3f' % timing.max}
+% endfor
+
+% endif
+% if transactions:
+========================================================================
+${"======{0: ^60}======".format("Transactions")}
+========================================================================
+Total transactions: ${len(transactions)}
+Long transactions (>= ${'%g' % long_transaction}s): ${len([t for t in transactions if t.duration >= long_transaction])}
+% for t in transactions[:10]:
+  ${'%.3f' % t.duration} second(s), ${t.query_count} queries, ${'%.3f' % t.idle_time} second(s) idle (max gap ${'%.3f' % t.max_gap}), ${t.transaction.outcome or 'open'}\
+% if t.caller is not None:
+ from ${t.caller[2]} @${t.caller[0].split()[-1]}:${t.caller[1]}
+% else:
+
+% endif
+% endfor
+
+By call site:
+% for caller, caller_transactions in transactions_by_caller:
+  ${len(caller_transactions)} transaction(s) in ${'%.3f' % sum(t.duration for t in caller_transactions)} second(s), max ${'%.3f' % max(t.duration for t in caller_transactions)}\
+% if caller is not None:
+ from ${caller[2]} @${caller[0].split()[-1]}:${caller[1]}
+% else:
+
+% endif
+% endfor
+
+% endif
+% if duplicates:
+========================================================================
+${"======{0: ^60}======".format("Duplicate queries")}
+========================================================================
+% for dup in duplicates:
+${dup.count} calls in ${dup.scope}, ${'%.3f' % dup.wasted_time} second(s) wasted:
+  ${dup.text}
+  Params: ${", ".join(["%s=%r" % (k, dup.params[k]) for k in sorted(dup.params.keys())])}
+% for filename, lineno, fn in dup.callers:
+  from ${fn} @${filename.split()[-1]}:${lineno}
+% endfor
+% endfor
+
+% endif
+<% best_cache = max(cache_simulations, key=lambda c: c.saved_time) if cache_simulations else None %>\
+% if best_cache is not None and best_cache.hits:
+========================================================================
+${"======{0: ^60}======".format("Cache simulation")}
+========================================================================
+% for c in cache_simulations:
+${c.size} entries, TTL ${'%gs' % c.ttl if c.ttl is not None else 'none'}: ${'%.1f' % (c.hit_rate * 100)}% of ${c.lookups} lookups hit, ${'%.3f' % c.saved_time} second(s) saved
+% endfor
+
+Queries worth caching, with ${best_cache.size} entries:
+% for group in best_cache.top_groups(10):
+% if group.hits:
+  ${'%.3f' % group.saved_time} second(s) saved, ${group.hits}/${group.lookups} hits: ${group.text}
+% endif
+% endfor
+
+% endif
+% if index_suggestions:
+========================================================================
+${"======{0: ^60}======".format("Index suggestions")}
+========================================================================
+% for s in index_suggestions:
+${s.table} (${", ".join(s.columns)}): ${s.count} queries, ${'%.3f' % s.time} second(s), ${s.rows} rows
+% if s.existing is None:
+  ${s.ddl()}
+% else:
+  covered by ${s.existing}
+% endif
+% endfor
+
+% endif
 ========================================================================
 ${"======{0: ^60}======".format("Details")}
 ========================================================================
@@ -18,23 +121,46 @@ ${"======{0: ^60}======".format("Details")}
 ${"============{0: ^48}============".format("QueryGroup %d" % i)}
 ${"------------{0: ^48}------------".format("QueryGroup %d summary" % i)}
 Query count: ${len(group.queries)}
+% if group.count_error:
+Query count error bound: ${group.count_error}
+% endif
 Query max time: ${'%.3f' % group.max} second(s)
 Query min time: ${'%.3f' % group.min} second(s)
 Query mean time: ${'%.3f' % group.mean} second(s)
 Query median time: ${'%.3f' % group.median} second(s)
+% if group.rows_fetched:
+Rows fetched: ${group.rows_fetched}
+Rows returned: ${group.rows_returned}
+% endif
+% if group.bytes_returned:
+Bytes returned: ${group.bytes_returned}
+% endif
 
 ${"------------{0: ^48}------------".format("QueryGroup %d SQL pattern" % i)}
 ${group.formatted_text}
+% if group.plan is not None:
+
+${"------------{0: ^48}------------".format("QueryGroup %d query plan" % i)}
+% for table in group.plan.full_scans:
+WARNING: full scan of ${table}
+% endfor
+% if group.plan.error:
+Error: ${group.plan.error}
+% endif
+% for line in group.plan.rows:
+${line}
+% endfor
+% endif
 
 ${"------------{0: ^48}------------".format("QueryGroup %d breakdown" % i)}
 % for j, query in enumerate(reversed(group.queries)):
 ${"Query %d:" % j}
   Query duration: ${'%.3f' % query.duration} second(s)
-  Query params:
-    % for key, value in query.params.items():
+  Query params:${' not captured' if query.params is None else ''}
+    % for key, value in (query.params or {}).items():
     ${key}: ${value}
     % endfor
-  Query rowcount: ${'%d' % query.rowcount}
+  Query rowcount: ${'%d' % query.rows}
 % endfor ## end for j, query in enumerate(reversed(group.queries))
 
 ${"------------{0: ^48}------------".format("QueryGroup %d stacks" % i)}
@@ -1,19 +1,9 @@
 from __future__ import absolute_import
 
-try:
-    import urllib.parse as urlparse
-except ImportError:
-    import urlparse
-from . import sqltap
-try:
-    import queue
-except ImportError:
-    import Queue as queue
+from . import dashboard
 
-from werkzeug.wrappers import Response
 
-
-class SQLTapMiddleware(object):
+class SQLTapMiddleware(dashboard.Dashboard):
     """ SQLTap dashboard middleware for WSGI applications.
 
     For example, if you are using Flask::
@@ -25,73 +15,44 @@ class SQLTapMiddleware(object):
 
     :param app: A WSGI application object to be wrap.
     :param path: A path prefix for access. Default is `'/__sqltap__'`
+    :param pool_events: Also report connection pool statistics.
+    :param refresh_interval: The minimum number of seconds between two
+        renders of the dashboard, see :class:`sqltap.dashboard.Dashboard`.
+    :param offline: Inline the stylesheet of the dashboard instead of
+        loading it from a CDN.
     """
 
-    def __init__(self, app, path='/__sqltap__'):
+    def __init__(self, app, path='/__sqltap__', pool_events=False,
+                 refresh_interval=5.0, offline=False):
+        super(SQLTapMiddleware, self).__init__(path, pool_events,
+                                               refresh_interval, offline)
         self.app = app
-        self.path = path.rstrip('/')
-        self.on = False
-        self.collector = queue.Queue(0)
-        self.stats = []
-        self.profiler = sqltap.ProfilingSession(collect_fn=self.collector.put)
 
     def __call__(self, environ, start_response):
-        path = environ.get('PATH_INFO', '')
-        if path == self.path or path == self.path + '/':
+        if self.matches(environ.get('PATH_INFO', '')):
             return self.render(environ, start_response)
         return self.app(environ, start_response)
 
-    def start(self):
-        if not self.on:
-            self.on = True
-            self.profiler.start()
-
-    def stop(self):
-        if self.on:
-            self.on = False
-            self.profiler.stop()
-
     def render(self, environ, start_response):
-        verb = environ.get('REQUEST_METHOD', 'GET').strip().upper()
-        if verb not in ('GET', 'POST'):
-            response = Response('405 Method Not Allowed', status=405,
-                                mimetype='text/plain')
-            response.headers['Allow'] = 'GET, POST'
-            return response(environ, start_response)
-
-        # handle on/off switch
-        if verb == 'POST':
+        verb = environ.get('REQUEST_METHOD', 'GET')
+        body = b''
+        if verb.strip().upper() == 'POST':
             try:
                 clen = int(environ.get('CONTENT_LENGTH', '0'))
             except ValueError:
                 clen = 0
-            body = environ['wsgi.input'].read(clen).decode('utf-8')
-            body = urlparse.parse_qs(body)
-            clear = body.get('clear', None)
-            if clear:
-                del self.stats[:]
-                return self.render_response(environ, start_response)
-
-            turn = body.get('turn', ' ')[0].strip().lower()
-            if turn not in ('on', 'off'):
-                response = Response('400 Bad Request: parameter '
-                                    '"turn=(on|off)" required',
-                                    status='400', mimetype='text/plain')
-                return response(environ, start_response)
-            if turn == 'on':
-                self.start()
-            else:
-                self.stop()
-
-        try:
-            while True:
-                self.stats.append(self.collector.get(block=False))
-        except queue.Empty:
-            pass
-
-        return self.render_response(environ, start_response)
+            body = environ['wsgi.input'].read(clen)
+        headers = dict((key[5:].replace('_', '-').lower(), value)
+                       for key, value in environ.items()
+                       if key.startswith('HTTP_'))
+        return self._respond(self.handle(verb, body, headers), environ,
+                             start_response)
 
     def render_response(self, environ, start_response):
-        html = sqltap.report(self.stats, middleware=self, report_format="wsgi")
-        response = Response(html.encode('utf-8'), mimetype="text/html")
+        return self._respond(self.report_response(), environ, start_response)
+
+    def _respond(self, result, environ, start_response):
+        from werkzeug.wrappers import Response
+        status, headers, body = result
+        response = Response(body, status=status, headers=headers)
         return response(environ, start_response)
@@ -1,9 +1,20 @@
 # -*- encoding: utf8 -*-
 from __future__ import print_function
 
+import asyncio
 import collections
+import csv
+import gzip
+import json
+import logging
 import os
+import subprocess
+import sys
 import tempfile
+import textwrap
+import threading
+import time
+import traceback
 import uuid
 import warnings
 
@@ -17,6 +28,13 @@ from werkzeug.test import Client
 from werkzeug.wrappers import Response
 
 import sqltap
+import sqltap.asgi
+import sqltap.dashboard
+import sqltap.diff
+import sqltap.explain
+import sqltap.indexes
+import sqltap.replay
+import sqltap.slowlog
 import sqltap.wsgi
 
 warnings.simplefilter(os.environ.get('WARNING_ACTION', 'error'))
@@ -224,6 +242,977 @@ class TestSQLTap(object):
         self.assertEqual(2, gilliam_movie_queries[0])
         self.assertEqual(gilliam, gilliam_movie_queries[2])
 
+    def test_params_ids_per_report(self):
+        """ Params ids start from 1 in every report and are reused when a
+        :class:`sqltap.ParamsTable` is shared between reports. """
+        stack = traceback.extract_stack()
+        stats = [sqltap.QueryStats('SELECT 1', stack, 1, 2, None,
+                                   {'x': x}, MockResults(1))
+                 for x in (1, 2, 1)]
+
+        for _ in range(2):
+            sqltap.report(stats, report_format="text")
+            self.assertEqual([1, 2, 1], [q.params_id for q in stats])
+
+        table = sqltap.ParamsTable()
+        sqltap.report(stats[1:], report_format="text", params_table=table)
+        self.assertEqual([1, 2], [q.params_id for q in stats[1:]])
+        sqltap.report(stats, report_format="text", params_table=table)
+        self.assertEqual([2, 1, 2], [q.params_id for q in stats])
+        self.assertEqual(2, len(table))
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            sqltap.fingerprint("SELECT * FROM t1 WHERE a = 'x' AND b IN "
+                               "(1, 2, 3) -- comment"),
+            sqltap.fingerprint("SELECT *  FROM t1\nWHERE a = 'it''s' "
+                               "AND b IN (4)"))
+        self.assertEqual("INSERT INTO t VALUES (?)",
+                         sqltap.fingerprint("INSERT INTO t VALUES (1, 'a'), "
+                                            "(2, 'b')"))
+
+    def test_space_saving(self):
+        summary = sqltap.SpaceSaving(4)
+        for key in 'aaaaabbbbccdefg':
+            summary.add(key)
+        top = summary.top(2)
+        self.assertEqual(['a', 'b'], [k for k, _, _ in top])
+        self.assertEqual(4, len(summary))
+        for key, count, error in summary.top():
+            # the error bound never exceeds total / capacity
+            assert error <= summary.total / summary.capacity
+
+    def test_heavy_hitters_memory(self):
+        """ The groups, stacks, parameter sets and params ids kept by a
+        :class:`sqltap.HeavyHitters` tracker are bounded. """
+        tracker = sqltap.HeavyHitters(capacity=10, sample_size=5)
+        for i in range(2000):
+            stack = [("app%d.py" % (i % 50), i, "fn", None)]
+            tracker.add(sqltap.QueryStats(
+                "SELECT * FROM t%d WHERE id = %d" % (i % 400, i), stack,
+                i, i + 0.001 * (i % 7), None, {"id": i}, MockResults(1)))
+
+        assert len(tracker.groups) <= 20
+        assert len(tracker.params_table) <= 2 * 10 * 5
+        for group in tracker.groups.values():
+            assert len(group.queries) <= 5
+            assert len(group.stacks) <= 5
+            assert len(group.callers) <= 5
+            assert len(group.params_hashes) <= 5
+        self.assertEqual(2000, tracker.other.count + sum(
+            g.count for g in tracker.groups.values()))
+
+    def test_report_max_groups(self):
+        """ Dynamic SQL is grouped by fingerprint and the long tail is
+        folded into the "other" group. """
+        profiler = sqltap.start(self.engine)
+        conn = self.engine.connect()
+        for i in range(20):
+            conn.execute("SELECT * FROM a WHERE id = %d" % i)
+        for i in range(5):
+            conn.execute("SELECT %d, * FROM a" % i + " AS a%d" % i)
+        conn.close()
+        stats = profiler.collect()
+        profiler.stop()
+
+        reporter = sqltap.sqltap.TextReporter(stats, max_groups=2)
+        groups = reporter._query_groups
+        assert len(groups) <= 4
+        self.assertEqual(20, max(g.count for g in groups))
+        self.assertEqual(
+            len(stats),
+            sum(g.count for g in groups) + reporter._other_group.count)
+        report = reporter.report()
+        assert "Other queries" in report
+        assert "Heaviest call sites" in report
+
+    def test_time_series(self):
+        series = sqltap.TimeSeries(window=10, size=6)
+        for t in range(0, 60, 2):
+            series.add(1000 + t, 0.001 if t < 40 else 0.1)
+
+        self.assertEqual([5] * 6, series.counts(now=1059))
+        self.assertEqual([0.5] * 6, series.rates(now=1059))
+        self.assertEqual([5, 5, 0, 0, 0, 0], series.counts(now=1099))
+        p95 = series.quantiles(0.95, now=1059)
+        assert 0.0008 < p95[0] < 0.0012, p95
+        assert 0.08 < p95[-1] < 0.12, p95
+        assert 0.08 < series.quantile(0.5, now=1059, last=2) < 0.12
+
+        # samples older than the ring are dropped
+        series.add(900, 1)
+        self.assertEqual([5] * 6, series.counts(now=1059))
+        assert series.sparkline(series.rates(now=1059)).startswith('<svg')
+
+    def test_report_timeline(self):
+        profiler = sqltap.start(self.engine)
+        self.Session().query(self.A).all()
+        reporter = sqltap.sqltap.HTMLReporter(profiler.collect())
+        profiler.stop()
+
+        group = reporter._query_groups[0]
+        self.assertEqual(1, sum(group.timeline.counts()))
+        report = reporter.report()
+        self.check_report(report)
+        assert 'class="sparkline"' in report
+
+    def test_report_timeline_old_capture(self):
+        """ The timelines of a static report end with its last query, so
+        that an old capture does not show empty sparklines. """
+        stack = traceback.extract_stack()
+        day = 24 * 3600
+        stats = [sqltap.QueryStats('SELECT 1', stack, t, t + 0.5, None, {},
+                                   MockResults(1))
+                 for t in (time.time() - 2 * day, time.time() - day)]
+        reporter = sqltap.sqltap.TextReporter(stats)
+        self.assertEqual(stats[1].end_time, reporter.timeline_end)
+        timeline = reporter._query_groups[0].timeline
+        self.assertEqual(1, sum(timeline.counts(reporter.timeline_end)))
+
+        reporter = sqltap.sqltap.TextReporter(stats, timeline_end=time.time())
+        timeline = reporter._query_groups[0].timeline
+        self.assertEqual(0, sum(timeline.counts(reporter.timeline_end)))
+
+    def test_pool_events(self):
+        profiler = sqltap.start(self.engine, pool_events=True,
+                                pool_context_fn=lambda: 'ctx')
+        sess = self.Session()
+        sess.query(self.A).all()
+        sess.close()
+        profiler.stop()
+
+        pool_stats = profiler.pool_stats
+        self.assertEqual(1, pool_stats.checkouts)
+        self.assertEqual(1, pool_stats.checkins)
+        self.assertEqual(1, pool_stats.checkout_wait.count)
+        self.assertEqual(1, pool_stats.hold_by_context['ctx'].count)
+        assert 'connect' not in self.engine.pool.__dict__
+
+        report = sqltap.report(profiler.collect(), report_format="text",
+                               pool_stats=pool_stats)
+        assert 'Held by ctx: 1 checkout(s)' in report
+        report = sqltap.report(profiler.collect(), pool_stats=pool_stats)
+        self.check_report(report)
+        assert 'Connection pool' in report
+
+    def test_track_transactions(self):
+        profiler = sqltap.start(self.engine, track_transactions=True)
+        sess = self.Session()
+        sess.query(self.A).all()
+        sess.add(self.A())
+        sess.commit()
+        sess.query(self.A).all()
+        sess.close()
+        self.engine.connect().execute("SELECT 1")
+        stats = profiler.collect()
+        profiler.stop()
+
+        transactions, by_caller = sqltap.analyze_transactions(stats)
+        self.assertEqual(2, len(transactions))
+        self.assertEqual(['commit', 'rollback'],
+                         sorted(t.transaction.outcome for t in transactions))
+        self.assertEqual([1, 2],
+                         sorted(t.query_count for t in transactions))
+        for t in transactions:
+            assert t.duration >= t.query_time
+            assert t.max_gap <= t.idle_time + 1e-9
+        self.assertEqual(2, sum(len(ts) for _, ts in by_caller))
+
+        report = sqltap.report(stats, report_format="text")
+        assert 'Total transactions: 2' in report
+        report = sqltap.report(stats, long_transaction=0)
+        self.check_report(report)
+        assert '2 transactions,\n                  2 lasting' in report
+
+    def test_explain(self):
+        """ Plans of the heaviest groups are captured in the background
+        and full table scans are flagged. """
+        fd, temp_path = tempfile.mkstemp()
+        os.close(fd)
+        engine = create_engine('sqlite:///%s' % temp_path)
+        self.A.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+
+        profiler = sqltap.start(engine)
+        sess = Session()
+        sess.query(self.A).filter(self.A.name == 'x').all()
+        sess.query(self.A).filter(self.A.id == 1).all()
+        # IN lists are expanded when the statement is executed
+        sess.query(self.A.id).filter(self.A.id.in_([1, 2, 3])).all()
+        sess.add(self.A())
+        sess.flush()
+        stats = profiler.collect()
+
+        explain = sqltap.explain.ExplainCapture(engine, min_interval=0)
+        sqltap.report(stats, explain=explain)
+        explain.wait()
+        report = sqltap.report(stats, report_format="text", explain=explain)
+        profiler.stop()
+        sess.close()
+        engine.dispose()
+        os.remove(temp_path)
+
+        # the EXPLAIN queries themselves are not profiled
+        self.assertEqual([], profiler.collect())
+        self.assertEqual(3, len(explain.plans))
+        self.assertEqual([None] * 3,
+                         [p.error for p in explain.plans.values()])
+        scans = [p.full_scans for p in explain.plans.values()]
+        self.assertEqual([[], [], ['a']], sorted(scans))
+        assert 'WARNING: full scan of a' in report
+        self.assertEqual(3, report.count('query plan'))
+
+    def test_fetch_counts(self):
+        sess = self.Session()
+        sess.add_all([self.A(name='a' * 10) for _ in range(5)])
+        sess.commit()
+
+        profiler = sqltap.start(self.engine, fetch_bytes=True)
+        conn = self.engine.connect()
+        conn.execute("SELECT name FROM a").fetchall()
+        result = conn.execute("SELECT name FROM a")
+        result.fetchone()
+        result.close()
+        # buffered rows are fetched but not returned
+        result = conn.execute("SELECT name FROM a").yield_per(2)
+        result.fetchone()
+        sess.query(self.A).all()
+        conn.close()
+        stats = profiler.collect()
+        profiler.stop()
+
+        self.assertEqual([5, 1, 1, 5], [q.rows_returned for q in stats])
+        self.assertEqual([5, 1, 2, 5], [q.rows_fetched for q in stats])
+        self.assertEqual(50, stats[0].bytes_returned)
+        self.assertEqual(5, stats[0].rows)
+
+        report = sqltap.report(stats, report_format="text")
+        assert "Rows fetched: 5" in report
+
+    def test_fetch_counts_sessions(self):
+        """ Each session counts the fetches of a query once, with its own
+        options. """
+        sess = self.Session()
+        sess.add_all([self.A(name='a' * 10) for _ in range(5)])
+        sess.commit()
+        sess.close()
+
+        first = sqltap.start(self.engine, fetch_bytes=True)
+        second = sqltap.start(self.engine)
+        conn = self.engine.connect()
+        result = conn.execute("SELECT name FROM a").yield_per(2)
+        result.fetchone()
+        result.close()
+        conn.close()
+        first.stop()
+        second.stop()
+
+        a, b = first.collect()[0], second.collect()[0]
+        self.assertEqual((2, 1, 10), (a.rows_fetched, a.rows_returned,
+                                      a.bytes_returned))
+        self.assertEqual((2, 1, None), (b.rows_fetched, b.rows_returned,
+                                        b.bytes_returned))
+
+    def test_find_duplicates(self):
+        request = {'id': 1}
+        profiler = sqltap.start(self.engine, lambda *args: request['id'],
+                                track_transactions=True)
+        for request['id'] in (1, 2):
+            sess = self.Session()
+            sess.query(self.A).filter(self.A.id == 1).all()
+            sess.query(self.A).filter(self.A.id == 1).all()
+            sess.query(self.A).filter(self.A.id == 2).all()
+            sess.close()
+        stats = profiler.collect()
+        profiler.stop()
+
+        for scope in ("context", "transaction"):
+            duplicates = sqltap.find_duplicates(stats, scope=scope)
+            self.assertEqual(2, len(duplicates))
+            self.assertEqual([2, 2], [d.count for d in duplicates])
+            self.assertEqual({'id_1': 1}, duplicates[0].params)
+            # issued from two different lines
+            self.assertEqual(2, len(duplicates[0].callers))
+        self.assertEqual(
+            [], sqltap.find_duplicates(stats, scope=lambda q: None))
+        # distinct contexts are not merged, even when their hashes are
+        # equal (-1 and -2 on CPython)
+        duplicates = sqltap.find_duplicates(
+            stats, scope=lambda q: -q.user_context)
+        self.assertEqual([2, 2], [d.count for d in duplicates])
+        self.assertEqual([-1, -2], sorted((d.scope for d in duplicates),
+                                          reverse=True))
+
+        report = sqltap.report(stats, report_format="text")
+        assert "2 calls in 1" in report
+        report = sqltap.report(stats)
+        self.check_report(report)
+        assert "Duplicate queries" in report
+
+    def test_extract_stack(self):
+        def inner():
+            return sqltap.sqltap.extract_stack()
+
+        stack = inner()
+        self.assertEqual('inner', stack[-1][2])
+        self.assertEqual('test_extract_stack', stack[-2][2])
+        self.assertEqual(len(traceback.extract_stack()) + 1, len(stack))
+        self.assertEqual(['test_extract_stack'],
+                         [f[2] for f in sqltap.sqltap.extract_stack(depth=1)])
+
+    def test_stack_options(self):
+        profiler = sqltap.start(self.engine, stack_depth=2,
+                                stack_exclude=['sqlalchemy'])
+        self.Session().query(self.A).all()
+        stats = profiler.collect()
+        profiler.stop()
+
+        stack = stats[0].stack
+        self.assertEqual(2, len(stack))
+        self.assertEqual('test_stack_options', stack[-1][2])
+        report = sqltap.report(stats, report_format="text")
+        assert "self.Session().query(self.A).all()" in report
+
+        profiler = sqltap.start(self.engine, stack_include=['test_sqltap'])
+        self.Session().query(self.A).all()
+        stats = profiler.collect()
+        profiler.stop()
+        self.assertEqual(['test_stack_options'],
+                         [f[2] for f in stats[0].stack])
+
+    def test_call_tree(self):
+        def load_a():
+            self.Session().query(self.A).all()
+
+        profiler = sqltap.start(self.engine)
+        for _ in range(2):
+            load_a()
+        self.Session().query(self.A).get(1)
+        stats = profiler.collect()
+        profiler.stop()
+
+        tree = sqltap.CallTree.from_stats(stats)
+        self.assertEqual(3, tree.root.count)
+        assert abs(tree.root.time - sum(q.duration for q in stats)) < 1e-9
+
+        lines = tree.collapsed(weight="count").splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual([1, 2], sorted(int(line.split()[-1]) for line in lines))
+        assert any(';load_a (test_sqltap.py:' in line for line in lines)
+
+        profile = json.loads(json.dumps(tree.speedscope()))
+        self.assertEqual(2, len(profile['profiles'][0]['samples']))
+        frames = profile['shared']['frames']
+        for sample in profile['profiles'][0]['samples']:
+            assert frames[sample[-1]]['name'].startswith('SELECT')
+
+        boxes = tree.icicle(min_width=0)
+        self.assertEqual(1, len([b for b in boxes if b[0] == 0]))
+        for depth, offset, width, node in boxes:
+            assert 0 <= offset and offset + width <= 1 + 1e-9
+
+        report = sqltap.report(stats)
+        self.check_report(report)
+        assert 'class="icicle-node' in report
+
+    def test_diff(self):
+        profiler = sqltap.start(self.engine)
+        self.Session().query(self.A).all()
+        before = profiler.collect()
+        self.Session().query(self.A).all()
+        self.Session().query(self.A).all()
+        self.Session().query(self.A).get(1)
+        after = profiler.collect()
+        profiler.stop()
+
+        assert not sqltap.diff.compare(before, before)
+        diff = sqltap.diff.compare(before, after)
+        self.assertEqual(1, len(diff.new))
+        self.assertEqual(0, len(diff.removed))
+        self.assertEqual(1, len(diff.changed))
+        self.assertEqual(1.0, diff.changed[0].change('count'))
+        assert 'count' in diff.changed[0].regressions
+        self.assertEqual(2, len(diff.regressions))
+        assert not sqltap.diff.compare(
+            before, after, count=None, rows=None, new_groups=False)
+        nose.tools.assert_raises(
+            AssertionError, sqltap.diff.assert_no_regressions, before, after)
+        nose.tools.assert_raises(
+            TypeError, sqltap.diff.compare, before, after, typo=1)
+
+        report = diff.report()
+        assert "Regressions: 2" in report
+        assert "[count" in report
+        reverse = sqltap.diff.compare(after, before)
+        self.assertEqual(1, len(reverse.removed))
+
+        tmpdir = tempfile.mkdtemp()
+        before_path = os.path.join(tmpdir, "before.json")
+        after_path = os.path.join(tmpdir, "after.json")
+        sqltap.diff.CaptureSummary.from_stats(before).save(before_path)
+        sqltap.diff.CaptureSummary.from_stats(after).save(after_path)
+        loaded = sqltap.diff.compare(before_path, after_path)
+        self.assertEqual(len(diff.regressions), len(loaded.regressions))
+        self.assertEqual(1, sqltap.diff.main([before_path, after_path]))
+        self.assertEqual(0, sqltap.diff.main([after_path, after_path]))
+
+    def test_count_only(self):
+        collected = []
+        profiler = sqltap.start(self.engine, collect_fn=collected.append,
+                                count_only=True)
+        self.Session().query(self.A).all()
+        self.Session().query(self.A).all()
+        profiler.stop()
+        self.assertEqual([], collected)
+        self.assertEqual(2, profiler.query_count)
+        assert profiler.query_time >= 0
+
+    def test_pytest_plugin(self):
+        try:
+            import pytest  # noqa
+        except ImportError:
+            raise nose.SkipTest("pytest is not installed")
+
+        tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(tmpdir, "test_queries.py"), "w") as f:
+            f.write(textwrap.dedent("""
+                import pytest
+                from sqlalchemy import create_engine, text
+
+                engine = create_engine("sqlite://")
+
+                def run(n):
+                    with engine.connect() as conn:
+                        for _ in range(n):
+                            conn.execute(text("SELECT 1"))
+
+                @pytest.mark.max_queries(2)
+                def test_within_limit():
+                    run(2)
+
+                @pytest.mark.max_queries(2)
+                def test_too_many():
+                    run(3)
+
+                def test_unmarked():
+                    run(5)
+
+                @pytest.mark.max_queries(2)
+                def test_error():
+                    run(1)
+                    assert False
+
+                def test_fixtures(sqltap_profiler, assert_max_queries):
+                    with assert_max_queries(1):
+                        run(1)
+                    assert len(sqltap_profiler.collect()) == 1
+            """))
+        report_file = os.path.join(tmpdir, "report.html")
+        env = dict(os.environ, PYTEST_DISABLE_PLUGIN_AUTOLOAD="1",
+                   PYTHONPATH=os.path.dirname(os.path.dirname(
+                       os.path.abspath(sqltap.__file__))))
+        process = subprocess.Popen(
+            [sys.executable, "-m", "pytest", "-p", "sqltap.pytest_plugin",
+             "-p", "no:cacheprovider", "--sqltap",
+             "--sqltap-report", report_file, "test_queries.py"],
+            cwd=tmpdir, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode("utf8")
+
+        self.assertEqual(1, process.returncode, output)
+        assert "2 failed, 3 passed" in output, output
+        assert "test_too_many issued 3 queries, expected at most 2" in output
+        assert "slowest tests by query time" in output
+        assert "      5 queries  test_queries.py::test_unmarked" in output
+        assert "      1 queries  test_queries.py::test_error" in output
+        assert os.path.exists(report_file)
+
+    def test_shared_dispatcher(self):
+        first = sqltap.start(self.engine, stack_depth=1)
+        second = sqltap.start(self.engine, lambda *args: 'second',
+                              track_transactions=True)
+        dispatcher = sqltap.sqltap._Dispatcher.get(self.engine)
+        self.assertEqual((first, second), dispatcher.sessions)
+
+        self.Session().query(self.A).all()
+        first.stop()
+        self.Session().query(self.A).all()
+        second.stop()
+        self.assertEqual((), dispatcher.sessions)
+
+        a, b = first.collect(), second.collect()
+        self.assertEqual(1, len(a))
+        self.assertEqual(2, len(b))
+        # the query was compiled once for both sessions
+        assert a[0] is not b[0]
+        assert a[0].text is b[0].text
+        self.assertEqual(1, len(a[0].stack))
+        assert len(b[0].stack) > 1
+        self.assertEqual(None, a[0].user_context)
+        self.assertEqual('second', b[0].user_context)
+        self.assertEqual(None, a[0].transaction)
+        assert b[0].transaction is not None
+
+    def test_start_stop_threads(self):
+        profiler = sqltap.ProfilingSession(self.engine)
+        errors = []
+
+        def toggle():
+            for _ in range(200):
+                try:
+                    profiler.start()
+                except AssertionError:
+                    continue
+                try:
+                    profiler.stop()
+                except AssertionError as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=toggle) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        assert not profiler.started
+        self.assertEqual(
+            (), sqltap.sqltap._Dispatcher.get(self.engine).sessions)
+
+    def test_filters(self):
+        def run(**filters):
+            profiler = sqltap.start(self.engine, lambda *args: 'ctx',
+                                    **filters)
+            sess = self.Session()
+            sess.query(self.A).all()
+            sess.add(self.A(name='x'))
+            sess.commit()
+            with self.engine.connect() as conn:
+                conn.execute(sqlalchemy.text("SELECT name FROM a"))
+            profiler.stop()
+            return [str(q.text).split()[0] for q in profiler.collect()]
+
+        self.assertEqual(['SELECT', 'INSERT', 'SELECT'], run())
+        self.assertEqual(['SELECT', 'SELECT'],
+                         run(statement_types=['select']))
+        self.assertEqual(['SELECT', 'INSERT', 'SELECT'], run(tables=['A']))
+        self.assertEqual([], run(tables=['b']))
+        self.assertEqual(3, len(run(urls=['sqlite://*'])))
+        self.assertEqual([], run(urls=['postgresql://*']))
+        self.assertEqual([], run(min_duration=60))
+        self.assertEqual([], run(context_filter=lambda ctx: ctx != 'ctx'))
+        self.assertEqual(3, len(run(caller_modules=['test_sqltap'])))
+        self.assertEqual([], run(caller_modules=['sqltap.wsgi']))
+
+        profiler = sqltap.start(self.engine, count_only=True,
+                                statement_types=['INSERT'])
+        self.Session().query(self.A).all()
+        profiler.stop()
+        self.assertEqual(0, profiler.query_count)
+
+    def test_stream_reports(self):
+        profiler = sqltap.start(self.engine, track_transactions=True)
+        sess = self.Session()
+        sess.query(self.A).all()
+        sess.query(self.A).all()
+        sess.query(self.A).filter(self.A.id == 1).all()
+        sess.close()
+        stats = profiler.collect()
+        profiler.stop()
+
+        lines = sqltap.report(stats, report_format="ndjson").splitlines()
+        self.assertEqual(3, len(lines))
+        record = json.loads(lines[2])
+        self.assertEqual(list(sqltap.sqltap.QUERY_FIELDS), list(record))
+        self.assertEqual({'id_1': 1}, record['params'])
+        assert record['caller'].startswith(__file__.replace('.pyc', '.py'))
+        assert record['transaction'] is not None
+
+        tmpdir = tempfile.mkdtemp()
+        path = sqltap.report(iter(stats), "queries.csv", report_format="csv",
+                             report_dir=tmpdir)
+        self.assertEqual(os.path.join(tmpdir, "queries.csv"), path)
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(3, len(rows))
+        self.assertEqual({'id_1': 1}, json.loads(rows[2]['params']))
+
+        report = json.loads(sqltap.report(stats, report_format="json"))
+        assert 'queries' not in report
+        self.assertEqual(3, report['all']['count'])
+        self.assertEqual([1, 2], sorted(g['count'] for g in report['groups']))
+        report = json.loads(sqltap.report(stats, report_format="json",
+                                          include_queries=True))
+        self.assertEqual(3, len(report['queries']))
+
+    def test_async_engine(self):
+        try:
+            import aiosqlite  # noqa
+        except ImportError:
+            raise nose.SkipTest("aiosqlite is not installed")
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        async_engine = create_async_engine("sqlite+aiosqlite://")
+        # an AsyncEngine is profiled through its sync engine
+        profiler = sqltap.start(async_engine,
+                                caller_modules=['test_sqltap'])
+        self.assertEqual(async_engine.sync_engine, profiler.engine)
+
+        async def load_a():
+            async with async_engine.connect() as conn:
+                result = await conn.execute(sqlalchemy.text("SELECT 1"))
+                result.fetchall()
+            await async_engine.dispose()
+
+        asyncio.run(load_a())
+        stats = profiler.collect()
+        profiler.stop()
+        self.assertEqual(1, len(stats))
+        assert 'load_a' in [frame[2] for frame in stats[0].stack]
+
+    def test_report_gzip(self):
+        profiler = sqltap.start(self.engine)
+        self.Session().query(self.A).all()
+        stats = profiler.collect()
+        profiler.stop()
+
+        tmpdir = tempfile.mkdtemp()
+        html = sqltap.report(stats, "report.html.gz", report_dir=tmpdir)
+        with gzip.open(os.path.join(tmpdir, "report.html.gz"), "rt",
+                       encoding="utf-8") as f:
+            self.assertEqual(html, f.read())
+        sqltap.report(stats, "queries.csv.gz", report_format="csv",
+                      report_dir=tmpdir)
+        with gzip.open(os.path.join(tmpdir, "queries.csv.gz"), "rt") as f:
+            self.assertEqual(2, len(list(csv.reader(f))))
+
+    def test_offline_report(self):
+        profiler = sqltap.start(self.engine)
+        self.Session().query(self.A).all()
+        stats = profiler.collect()
+        profiler.stop()
+
+        report = sqltap.report(stats)
+        self.check_report(report)
+        assert 'bootstrapcdn' in report
+        assert '<span class="hljs-keyword">SELECT</span>' in report
+        for cdn in ('jquery', 'highlight.min.js'):
+            assert cdn not in report
+
+        report = sqltap.report(stats, offline=True)
+        self.check_report(report)
+        assert 'https://maxcdn' not in report
+        assert '.tab-content > .tab-pane' in report
+
+        self.assertEqual(
+            '<span class="hljs-keyword">SELECT</span> '
+            '<span class="hljs-number">1</span> &lt; '
+            '<span class="hljs-string">\'&amp;\'</span>',
+            sqltap.sqltap.highlight_sql("SELECT 1 < '&'"))
+
+    def test_overhead_governor_levels(self):
+        governor = sqltap.OverheadGovernor(budget=0.01, interval=1.0)
+        self.assertEqual("full", governor.description)
+        # 10% overhead tightens one level per interval
+        for now in range(4):
+            governor.add(0.1, 0.01, now)
+        self.assertEqual(3, governor.level)
+        assert not governor.capture_stack
+        assert not governor.capture_params
+        self.assertEqual(0.1, round(governor.overhead, 6))
+        # sampling one query out of 2
+        captured = [governor.sample() for _ in range(10)]
+        self.assertEqual(5, captured.count(True))
+        self.assertEqual(5, governor.skipped)
+        # the top level is the last one
+        for now in range(4, 20):
+            governor.add(0.1, 0.01, now)
+        self.assertEqual(len(governor.LEVELS) - 1, governor.level)
+        # a low overhead relaxes back to full capture
+        for now in range(20, 40):
+            governor.add(0.1, 0.0001, now)
+        self.assertEqual(0, governor.level)
+
+    def test_overhead_governor_session(self):
+        collected = []
+        profiler = sqltap.start(self.engine, collect_fn=collected.append,
+                                governor=0.01)
+        profiler.governor.level = len(profiler.governor.LEVELS) - 1
+        profiler.governor.interval = float("inf")
+        session = self.Session()
+        for _ in range(64):
+            session.query(self.A).all()
+        session.close()
+        profiler.stop()
+        self.assertEqual(64, profiler.query_count)
+        self.assertEqual(1, len(collected))
+        self.assertEqual(None, collected[0].params)
+        self.assertEqual(1, len(collected[0].stack))
+        self.assertEqual("test_sqltap.py",
+                         os.path.basename(collected[0].stack[0].filename))
+        assert profiler.overhead > 0
+
+        report = sqltap.report(collected, report_format="text",
+                               session=profiler)
+        assert "Profiling overhead: " in report
+        assert "Capturing: 1/64 of the queries" in report
+        report = sqltap.report(collected, session=profiler)
+        assert 'id="overhead"' in report
+
+    def test_overhead_governor_no_params(self):
+        """ Queries captured without their parameters are not taken for
+        duplicates or cache hits. """
+        profiler = sqltap.start(self.engine, lambda *args: "request",
+                                governor=0.01)
+        level, = [i for i, level in enumerate(profiler.governor.LEVELS)
+                  if level[0] == 1 and not level[2]]
+        profiler.governor.level = level
+        profiler.governor.interval = float("inf")
+        session = self.Session()
+        for i in range(5):
+            session.query(self.A).filter(self.A.id == i).all()
+        session.close()
+        stats = profiler.collect()
+        profiler.stop()
+
+        self.assertEqual(5, len(stats))
+        self.assertEqual([None] * 5, [q.params_hash for q in stats])
+        self.assertEqual([], sqltap.find_duplicates(stats))
+        simulation, = sqltap.simulate_cache(stats, [(10, None)])
+        self.assertEqual(0, simulation.hits)
+        report = sqltap.report(stats, report_format="text")
+        assert "Query params: not captured" in report
+        self.check_report(sqltap.report(stats))
+
+    def test_slow_query_log(self):
+        records = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        logger = logging.getLogger("sqltap.slowlog.test")
+        logger.propagate = False
+        handler = ListHandler()
+        logger.addHandler(handler)
+        collected = []
+        slow_log = sqltap.slowlog.SlowQueryLog(
+            threshold=0, logger=logger, max_param_length=5,
+            collect_fn=collected.append)
+        profiler = sqltap.start(self.engine, collect_fn=slow_log)
+        session = self.Session()
+        for name in ("a" * 10, "b", "c"):
+            session.query(self.A).filter(self.A.name == name).all()
+        session.close()
+        profiler.stop()
+        slow_log.close()
+        logger.removeHandler(handler)
+
+        self.assertEqual(3, len(collected))
+        first, summary = records
+        self.assertEqual(logging.WARNING, first.levelno)
+        self.assertEqual(collected[0].duration, first.duration)
+        self.assertEqual(
+            sqltap.fingerprint(str(collected[0].text)), first.fingerprint)
+        self.assertEqual(["aaaaa..."], list(first.params.values()))
+        assert "test_sqltap.py" in first.caller
+        self.assertEqual(0, first.suppressed)
+        self.assertEqual(2, summary.suppressed)
+        assert summary.getMessage().startswith("2 more slow queries from ")
+
+    def test_slow_query_log_expiry(self):
+        """ The rate limit of a fingerprint is forgotten, and its dropped
+        records summarized, when its period ends, even if the fingerprint
+        is never seen again. """
+        records = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        logger = logging.getLogger("sqltap.slowlog.test_expiry")
+        logger.propagate = False
+        handler = ListHandler()
+        logger.addHandler(handler)
+        slow_log = sqltap.slowlog.SlowQueryLog(threshold=0, logger=logger,
+                                               period=10)
+        for text, t in (("SELECT * FROM a", 100), ("SELECT * FROM a", 101),
+                        ("SELECT * FROM a", 102), ("SELECT * FROM b", 120)):
+            slow_log(sqltap.QueryStats(text, [], t - 1, t, None, {},
+                                       MockResults(1)))
+        self.assertEqual(["SELECT * FROM b"], list(slow_log._limits))
+        slow_log.close()
+        logger.removeHandler(handler)
+
+        first, summary, second = records
+        self.assertEqual("SELECT * FROM a", first.fingerprint)
+        self.assertEqual((2, 100, 110), (summary.suppressed,
+                                         summary.period_start,
+                                         summary.period_end))
+        assert summary.getMessage().startswith("2 more slow queries from ")
+        self.assertEqual("SELECT * FROM b", second.fingerprint)
+
+    def test_extract_predicates(self):
+        self.assertEqual(
+            (("a", "id", "join"), ("b", "a_id", "join"),
+             ("a", "name", "eq"), ("b", "kind", "eq"),
+             ("a", "created", "range")),
+            sqltap.indexes.extract_predicates(
+                "SELECT a.id FROM a JOIN b AS bb ON a.id = bb.a_id "
+                "WHERE a.name = ? AND bb.kind IN (?, ?) AND a.created > ? "
+                "AND a.flag IS NOT NULL AND lower(a.x) = ?"))
+        self.assertEqual(
+            (("a", "id", "eq"),),
+            sqltap.indexes.extract_predicates(
+                "UPDATE a SET name=? WHERE id = ?"))
+
+    def test_index_suggestions(self):
+        profiler = sqltap.start(self.engine)
+        session = self.Session()
+        session.query(self.A).filter(self.A.name == "x").all()
+        session.query(self.A).filter(self.A.name == "y").all()
+        session.query(self.A).filter(self.A.id == 1).all()
+        session.close()
+        stats = profiler.collect()
+        profiler.stop()
+
+        advisor = sqltap.indexes.IndexAdvisor(self.engine)
+        by_name, by_id = advisor.suggest_stats(stats)
+        self.assertEqual(("a", ("name",)), (by_name.table, by_name.columns))
+        self.assertEqual(2, by_name.count)
+        self.assertEqual(None, by_name.existing)
+        self.assertEqual("CREATE INDEX ix_a_name ON a (name)", by_name.ddl())
+        self.assertEqual(("id",), by_id.columns)
+        assert by_id.existing is not None
+
+        report = sqltap.report(stats, report_format="text", indexes=advisor)
+        assert "CREATE INDEX ix_a_name ON a (name)" in report
+        report = sqltap.report(stats, indexes=advisor)
+        assert 'id="indexes"' in report
+
+    def test_simulate_cache(self):
+        profiler = sqltap.start(self.engine)
+        session = self.Session()
+        for name in ("x", "x", "y"):
+            session.query(self.A).filter(self.A.name == name).all()
+        session.execute(self.A.__table__.update().values(name="z"))
+        session.query(self.A).filter(self.A.name == "x").all()
+        session.close()
+        stats = profiler.collect()
+        profiler.stop()
+
+        large, small = sqltap.simulate_cache(stats, [(10, None), (1, None)])
+        self.assertEqual(4, large.lookups)
+        self.assertEqual(1, large.hits)
+        self.assertEqual(0.25, large.hit_rate)
+        self.assertEqual(2, large.invalidations)
+        self.assertEqual(1, small.invalidations)
+        group, = large.top_groups()
+        self.assertEqual(1, group.hits)
+        self.assertEqual(stats[1].duration, group.saved_time)
+
+        # statements differing by their literals return different rows
+        stack = traceback.extract_stack()
+        literal_stats = [
+            sqltap.QueryStats("SELECT name FROM a WHERE id = %d" % i, stack,
+                              t, t + 1, None, {}, MockResults(1))
+            for t, i in enumerate((1, 2, 1))]
+        simulation, = sqltap.simulate_cache(literal_stats, [(10, None)])
+        self.assertEqual((3, 1), (simulation.lookups, simulation.hits))
+        self.assertEqual(1, len(simulation.groups))
+
+        report = sqltap.report(stats, report_format="text",
+                               cache_configs=[(10, None), (10, 60.0)])
+        assert "10 entries, TTL 60s: 25.0% of 4 lookups hit" in report
+        report = sqltap.report(stats)
+        assert 'id="cache"' in report
+
+    def test_lazy_imports(self):
+        """ Capturing queries does not import the reporting dependencies,
+        which would slow down the startup of short-lived processes. Only
+        the absence of the modules is checked, timings are too noisy. """
+        script = textwrap.dedent("""
+            import sys
+
+            import sqltap
+            import sqltap.wsgi
+
+            from sqlalchemy import create_engine, text
+            engine = create_engine("sqlite://")
+            profiler = sqltap.start(engine)
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1")).fetchall()
+            assert len(profiler.collect()) == 1
+            profiler.stop()
+            print(" ".join(sorted(name for name in sys.modules
+                                  if name.split(".")[0] in
+                                  ("mako", "sqlparse", "werkzeug"))))
+        """)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(
+            os.path.abspath(sqltap.__file__))))
+        process = subprocess.Popen(
+            [sys.executable, "-c", script], env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode("utf8")
+        self.assertEqual(0, process.returncode, output)
+        self.assertEqual("", output.splitlines()[-1], output)
+
+    def test_replay(self):
+        tmpdir = tempfile.mkdtemp()
+        engine = create_engine("sqlite:///" + os.path.join(tmpdir, "db"))
+        self.A.__table__.create(engine)
+        table = self.A.__table__
+        profiler = sqltap.start(engine)
+        with engine.begin() as conn:
+            conn.execute(table.insert().values(name="x"))
+            conn.execute(table.select().where(table.c.name == "x")).fetchall()
+            conn.execute(table.select().where(table.c.id > 0)).fetchall()
+            # expanded IN lists, and a parameter used twice
+            conn.execute(table.select().where(
+                table.c.id.in_([1, 2, 3]))).fetchall()
+            conn.execute(table.select().where(
+                table.c.name == sqlalchemy.bindparam("n")).where(
+                table.c.description != sqlalchemy.bindparam("n")),
+                {"n": "x"}).fetchall()
+            # placeholder characters in a string literal
+            conn.execute(sqlalchemy.text(
+                r"SELECT * FROM a WHERE name != 'what? \:x' AND id = :id"),
+                {"id": 1}).fetchall()
+        stats = profiler.collect()
+        profiler.stop()
+        capture = os.path.join(tmpdir, "capture.ndjson")
+        sqltap.report(stats, capture, report_format="ndjson")
+
+        for capture in (capture, stats):
+            result = sqltap.replay.replay(capture, engine, speed=None,
+                                          concurrency=2)
+            self.assertEqual(6, result.count)
+            self.assertEqual([], result.errors)
+            self.assertEqual(6, len(result.stats))
+            executed = [(q.executed_statement, q.executed_params)
+                        for q in stats]
+            self.assertEqual(executed, sorted(
+                ((q.executed_statement, q.executed_params)
+                 for q in result.stats), key=executed.index))
+        session = self.Session(bind=engine)
+        self.assertEqual(3, session.query(self.A).filter(
+            self.A.name == "x").count())
+        session.close()
+
+        self.A.__table__.drop(engine)
+        result = sqltap.replay.replay(stats, engine, speed=1000,
+                                      statement_types=["select"],
+                                      profile=False)
+        self.assertEqual(5, result.count)
+        self.assertEqual(5, len(result.errors))
+        assert "no such table" in result.errors[0][1]
+        self.assertEqual([], result.stats)
+
+        query = sqltap.replay.ReplayQuery("SELECT ?, '?', ?", {"p0": 1}, 0)
+        result = sqltap.replay.replay([query], engine, speed=None)
+        self.assertEqual([(query, "the statement has more placeholders "
+                                  "than its 1 parameters")], result.errors)
+        engine.dispose()
+
     def test_query_stats_with_no_hashable_params(self):
         """Regression test for when sql query params contain un-hashable python
         object e.g. Postgres ARRAY -> list.
@@ -246,7 +1235,7 @@ class TestSQLTap(object):
         stats = profiler.collect()
         report = sqltap.report(stats, report_format="html")
         assert REPORT_TITLE in report
-        assert qtext in report
+        assert sqltap.sqltap.highlight_sql(qtext) in report
         report = sqltap.report(stats, report_format="text")
         assert REPORT_TITLE in report
         assert sqlparse.format(qtext, reindent=True) in report
@@ -278,7 +1267,7 @@ class TestSQLTap(object):
         stats = profiler.collect()
         report = sqltap.report(stats, report_format="html")
         assert REPORT_TITLE in report
-        assert sqltap.format_sql(sql) in report
+        assert sqltap.sqltap.highlight_sql(sqltap.format_sql(sql)) in report
         report = sqltap.report(stats, report_format="text")
         assert REPORT_TITLE in report
         assert sqlparse.format(sql, reindent=True) in report
@@ -562,3 +1551,142 @@ class TestSQLTapMiddleware(TestSQLTap):
         response = self.client.post(self.app.path, data='clear=1')
         assert response.status_code == 200
         assert 'text/html' in response.headers['content-type']
+
+    def _asgi_request(self, app, method, path, body=b''):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body,
+                    'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path}
+        asyncio.run(app(scope, receive, send))
+        start, response = messages
+        return (start['status'], dict(start['headers']),
+                response['body'])
+
+    def test_asgi_requests(self):
+        app_calls = []
+
+        async def inner_app(scope, receive, send):
+            app_calls.append(scope['path'])
+            await send({'type': 'http.response.start', 'status': 204,
+                        'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        app = sqltap.asgi.SQLTapMiddleware(inner_app)
+        status, headers, body = self._asgi_request(app, 'GET', '/')
+        self.assertEqual(204, status)
+        self.assertEqual(['/'], app_calls)
+
+        status, headers, body = self._asgi_request(app, 'GET', app.path)
+        self.assertEqual(200, status)
+        assert b'text/html' in headers[b'content-type']
+        assert b'SQLTap' in body
+
+        status, headers, body = self._asgi_request(
+            app, 'POST', app.path + '/', b'turn=on')
+        self.assertEqual(200, status)
+        assert app.on
+        self.Session().query(self.A).all()
+        self._asgi_request(app, 'POST', app.path, b'turn=off')
+        assert not app.on
+        self.assertEqual(1, len(app.stats))
+
+        status, headers, body = self._asgi_request(
+            app, 'POST', app.path, b'turn=invalid_string')
+        self.assertEqual(400, status)
+        status, headers, body = self._asgi_request(app, 'PUT', app.path)
+        self.assertEqual(405, status)
+        self.assertEqual(b'GET, POST', headers[b'allow'])
+
+    def test_dashboard_snapshot(self):
+        dashboard = sqltap.dashboard.Dashboard(refresh_interval=60)
+        renders = []
+        report = dashboard.report
+
+        def counting_report():
+            renders.append(dashboard.version)
+            return report()
+
+        dashboard.report = counting_report
+
+        first = dashboard.handle('GET')[2]
+        self.assertEqual(1, len(renders))
+        self.assertEqual(first, dashboard.handle('GET')[2])
+        self.assertEqual(1, len(renders))
+
+        # switching on waits for a fresh page
+        on = dashboard.handle('POST', b'turn=on')[2]
+        assert on != first
+        self.assertEqual(2, len(renders))
+
+        # new queries are rendered in the background, not before 60s
+        self.Session().query(self.A).all()
+        self.assertEqual(on, dashboard.handle('GET')[2])
+        assert dashboard._rendering
+        self.assertEqual(2, len(renders))
+
+        # concurrent views are served by a single render
+        dashboard.refresh_interval = 0
+        threads = [threading.Thread(target=dashboard.report_response,
+                                    kwargs={'wait': True})
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(renders))
+        assert b'FROM a' in dashboard.handle('GET')[2]
+        dashboard.stop()
+
+    def test_dashboard_render_error(self):
+        """ A page failing to render gets a 500 response, and is not
+        rendered again until the data changes. """
+        dashboard = sqltap.dashboard.Dashboard(refresh_interval=0)
+        renders = []
+
+        def failing_report():
+            renders.append(dashboard.version)
+            raise ValueError("broken report")
+
+        dashboard.report = failing_report
+        for _ in range(3):
+            status, headers, body = dashboard.handle('GET')
+            self.assertEqual(500, status)
+            assert b'broken report' in body
+        self.assertEqual(1, len(renders))
+
+        dashboard.invalidate()
+        self.assertEqual(500, dashboard.handle('GET')[0])
+        self.assertEqual(2, len(renders))
+
+    def test_dashboard_compression(self):
+        response = self.client.get(self.app.path,
+                                   headers={'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('gzip', response.headers['content-encoding'])
+        html = gzip.decompress(response.get_data())
+        assert b'SQLTap' in html
+        etag = response.headers['etag']
+
+        response = self.client.get(self.app.path)
+        assert 'content-encoding' not in response.headers
+        self.assertEqual(html, response.get_data())
+
+        response = self.client.get(self.app.path, headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.get_data())
+
+        # a new version of the page is rendered after switching on
+        response = self.client.post(self.app.path, data='turn=on')
+        self.assertEqual(200, response.status_code)
+        assert response.headers['etag'] != etag
+        response = self.client.get(self.app.path, headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.app.stop()